@@ -0,0 +1,238 @@
+# cache.py
+"""
+Two-tier cache for values that are expensive to compute and read on most requests.
+
+- Tier 1 is a small LRU inside each process. It holds an entry for at most LOCAL_TTL seconds,
+  so invalidations made by other processes are seen within that time.
+- Tier 2 is a Django cache shared by all workers (memcached, redis or a file-based cache). A
+  locmem cache is private to each process, so neither its values nor tag invalidations reach
+  other workers; unless CACHE_SINGLE_PROCESS says there is only one, entries kept in it are
+  held no longer than LOCAL_TTL, as in tier 1, whatever their timeout.
+
+get_or_compute(key, compute, timeout, stale, tags):
+- A value is fresh for `timeout` seconds (None: until a tag is invalidated). After that it may
+  be served for `stale` more seconds while one worker recomputes it (stale-while-revalidate).
+- Recomputing is single-flight. The worker that wins an add() on the key's lock recomputes.
+  Others serve the stale value, or, when there is none, wait up to WAIT_TIMEOUT for the
+  winner's result and then compute it themselves.
+- Entries carry tags such as "prototypes" or "facets". invalidate_tags() bumps a version per
+  tag (once the current transaction commits), and an entry stored under an older version
+  counts as expired. It is recomputed once
+  and served stale meanwhile, like any other expired entry.
+- Hit, miss, stale and recompute counters are kept per process and added to shared counters
+  every few seconds. stats() reads them; so does the cache_stats command.
+
+    TIERED_CACHE_ALIAS = 'default'
+    TIERED_CACHE_LOCAL_SIZE = 512
+    TIERED_CACHE_LOCAL_TTL = 5
+    TIERED_CACHE_LOCK_TIMEOUT = 30
+    TIERED_CACHE_WAIT_TIMEOUT = 2
+    CACHE_SINGLE_PROCESS = False      # True when one process serves every request
+"""
+
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+STAT_NAMES = ('local_hits', 'shared_hits', 'stale_hits', 'misses', 'waits', 'recomputes')
+STATS_FLUSH_SECONDS = 10
+WAIT_INTERVAL = 0.05
+
+
+def tiered_setting(name, default):
+    return getattr(settings, 'TIERED_CACHE_' + name, default)
+
+
+def process_local(cache):
+    """
+    True when writes to `cache` stay inside this process (locmem) and the deployment may run
+    several processes, so they can't be relied on to reach every worker.
+    """
+    return isinstance(cache, LocMemCache) and not getattr(settings, 'CACHE_SINGLE_PROCESS', False)
+
+
+class LocalLRU(object):
+    """ Thread-safe, size-bounded LRU of (expires_at, entry). """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, entry, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, predicate):
+        with self.lock:
+            for key in [k for k, (expires, entry) in self.entries.items() if predicate(entry)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TieredCache(object):
+    """ See the module docstring. Entries are dicts: value, fresh_until, tags ({tag: version}). """
+
+    def __init__(self, alias=None, prefix='tiered'):
+        self.alias = alias
+        self.prefix = prefix
+        self.local = LocalLRU(tiered_setting('LOCAL_SIZE', 512))
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+        self.flushed_at = time.time()
+
+    @property
+    def shared(self):
+        return caches[self.alias or tiered_setting('ALIAS', 'default')]
+
+    def _key(self, kind, name):
+        return '%s:%s:%s' % (self.prefix, kind, name)
+
+    def _count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+            if time.time() - self.flushed_at < STATS_FLUSH_SECONDS:
+                return
+            counts, self.counts, self.flushed_at = self.counts, Counter(), time.time()
+        self._flush_counts(counts)
+
+    def _flush_counts(self, counts):
+        for name, n in counts.items():
+            key = self._key('stats', name)
+            if not self.shared.add(key, n, None):
+                try:
+                    self.shared.incr(key, n)
+                except ValueError:
+                    self.shared.set(key, n, None)
+
+    def stats(self):
+        """ Counters summed over every process, including this one's unflushed counts. """
+        shared = self.shared.get_many([self._key('stats', name) for name in STAT_NAMES])
+        with self.counts_lock:
+            local = dict(self.counts)
+        return OrderedDict(
+            (name, shared.get(self._key('stats', name), 0) + local.get(name, 0)) for name in STAT_NAMES)
+
+    def tag_versions(self, tags):
+        """ Current {tag: version}; a tag seen for the first time starts at the clock. """
+        if not tags:
+            return {}
+        keys = {tag: self._key('tag', tag) for tag in tags}
+        found = self.shared.get_many(list(keys.values()))
+        versions = {}
+        for tag, key in keys.items():
+            if key not in found:
+                self.shared.add(key, int(time.time() * 1000), None)
+                found[key] = self.shared.get(key, 0)
+            versions[tag] = found[key]
+        return versions
+
+    def invalidate_tags(self, tags):
+        """
+        Expire every entry stored under any of tags, in every process (within LOCAL_TTL). Inside
+        a transaction this happens when it commits: expiring earlier would let a concurrent
+        request recompute from the old rows and store the result under the new tag version.
+        """
+        tags = set(tags)
+        transaction.on_commit(lambda: self._invalidate_now(tags))
+
+    def _invalidate_now(self, tags):
+        for tag in tags:
+            key = self._key('tag', tag)
+            try:
+                self.shared.incr(key)
+            except ValueError:
+                self.shared.set(key, int(time.time() * 1000), None)
+        self.local.discard(lambda entry: tags.intersection(entry['tags']))
+
+    def delete(self, key):
+        self.local.discard(lambda entry: entry['key'] == key)
+        self.shared.delete(self._key('value', key))
+
+    def _is_fresh(self, entry):
+        return entry['fresh_until'] > time.time() and (
+            not entry['tags'] or self.tag_versions(entry['tags']) == entry['tags'])
+
+    def _local_ttl(self, entry):
+        return min(entry['fresh_until'] - time.time(), tiered_setting('LOCAL_TTL', 5))
+
+    def _store(self, key, value, timeout, stale, tags):
+        # timeout=None keeps the value until one of its tags is invalidated, if invalidations are shared.
+        if process_local(self.shared):
+            timeout = min(tiered_setting('LOCAL_TTL', 5), float('inf') if timeout is None else timeout)
+        fresh_until = float('inf') if timeout is None else time.time() + timeout
+        entry = {'key': key, 'value': value, 'fresh_until': fresh_until, 'tags': tags}
+        self.shared.set(self._key('value', key), entry, None if timeout is None else timeout + stale)
+        self.local.set(key, entry, self._local_ttl(entry))
+        return entry
+
+    def _recompute(self, key, compute, timeout, stale, tags):
+        self._count('recomputes')
+        # Versions are read before computing; an invalidation during compute() leaves the result expired.
+        versions = self.tag_versions(tags)
+        return self._store(key, compute(), timeout, stale, versions)['value']
+
+    def get_or_compute(self, key, compute, timeout=300, stale=60, tags=()):
+        entry = self.local.get(key)
+        if entry is not None:
+            self._count('local_hits')
+            return entry['value']
+
+        entry = self.shared.get(self._key('value', key))
+        if entry is not None and self._is_fresh(entry):
+            self._count('shared_hits')
+            self.local.set(key, entry, self._local_ttl(entry))
+            return entry['value']
+        if entry is None:
+            self._count('misses')
+
+        lock_key, token = self._key('lock', key), uuid.uuid4().hex
+        lock_timeout = tiered_setting('LOCK_TIMEOUT', 30)
+        if self.shared.add(lock_key, token, lock_timeout):
+            try:
+                return self._recompute(key, compute, timeout, stale, tags)
+            finally:
+                if self.shared.get(lock_key) == token:
+                    self.shared.delete(lock_key)
+
+        if entry is not None:
+            self._count('stale_hits')
+            return entry['value']
+
+        # Nothing to serve: wait briefly for the worker holding the lock, then compute anyway.
+        self._count('waits')
+        deadline = time.time() + min(tiered_setting('WAIT_TIMEOUT', 2), lock_timeout)
+        while time.time() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            entry = self.shared.get(self._key('value', key))
+            if entry is not None:
+                return entry['value']
+            if self.shared.get(lock_key) is None:
+                break
+        return self._recompute(key, compute, timeout, stale, tags)
+
+
+tiered_cache = TieredCache()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core.cache import tiered_cache
+
+
+class Command(BaseCommand):
+    help = 'Print the tiered cache hit, miss and recompute counters summed over all workers.'
+
+    def handle(self, *args, **options):
+        stats = tiered_cache.stats()
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['stale_hits'] + stats['misses']
+        for name, value in stats.items():
+            self.stdout.write('%-12s %d' % (name, value))
+        if lookups:
+            hits = stats['local_hits'] + stats['shared_hits'] + stats['stale_hits']
+            self.stdout.write('%-12s %.1f%%' % ('hit_rate', 100.0 * hits / lookups))
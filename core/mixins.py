@@ -1,4 +1,12 @@
 # mixins.py
+import calendar
+import hashlib
+import time
+
+from django.contrib.messages import get_messages
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 
 
 class ListUserFilesMixin(object):
@@ -14,3 +22,71 @@ class ListUserFilesMixin(object):
             except:
                 pass
         return context
+
+
+class CachedObjectMixin(object):
+    """ Memoize get_object() so repeated calls within one request hit the database once. """
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super(CachedObjectMixin, self).get_object(queryset)
+        try:
+            return self._cached_object
+        except AttributeError:
+            self._cached_object = super(CachedObjectMixin, self).get_object()
+            return self._cached_object
+
+
+class ConditionalGetMixin(object):
+    """
+    Answer a GET with 304 Not Modified before any template work when the client's copy is current.
+
+    Views implement get_validators(), returning (version, last_modified) for the requested page,
+    or None to skip the check. `version` is a string that changes whenever the page content
+    does. The ETag also covers the full path, the user and the CSRF cookie, which pages embed.
+    With conditional_anonymous_only, signed-in users always get a full response; use it for
+    pages whose per-user content the validators don't cover.
+    """
+    conditional_anonymous_only = False
+
+    def get_validators(self):
+        return None
+
+    def _etag(self, version):
+        user = self.request.user
+        source = '|'.join((
+            version, self.request.get_full_path(), str(user.pk) if user.is_authenticated() else '',
+            self.request.META.get('CSRF_COOKIE', '')))
+        return quote_etag(hashlib.md5(source.encode('utf-8')).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        validators = None
+        # Pending flash messages are part of the page, so those requests always render.
+        if not (self.conditional_anonymous_only and request.user.is_authenticated()) and not len(get_messages(request)):
+            validators = self.get_validators()
+        if validators is None:
+            return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+
+        version, last_modified = validators
+        if last_modified is not None:
+            if timezone.is_aware(last_modified):
+                last_modified = calendar.timegm(last_modified.utctimetuple())
+            else:
+                last_modified = time.mktime(last_modified.timetuple())
+        not_modified = get_conditional_response(request, etag=self._etag(version), last_modified=last_modified)
+        if not_modified is not None:
+            not_modified['ETag'] = self._etag(version)
+            return not_modified
+
+        response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        if response.status_code == 200:
+            if hasattr(response, 'render'):
+                # Rendering may set the CSRF cookie the ETag depends on.
+                response.render()
+            response['ETag'] = self._etag(version)
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            if request.user.is_authenticated():
+                patch_cache_control(response, private=True)
+            patch_cache_control(response, max_age=0, must_revalidate=True)
+            patch_vary_headers(response, ('Cookie',))
+        return response
@@ -0,0 +1,183 @@
+# querybudget.py
+"""
+Per-request SQL query budgets and timing.
+
+QueryBudgetMiddleware records, for every request, the number of queries run, the total DB time,
+repeated query fingerprints (the usual N+1 signature) and template render time. Requests that
+exceed the budget configured for their URL name are logged as one structured line on the
+'pbllrepo.querybudget' logger. Enable it with:
+
+    MIDDLEWARE += ['core.querybudget.QueryBudgetMiddleware']
+    QUERY_BUDGETS = {'list_prototypes': 10, 'docview_prototype': {'queries': 15, 'db_time': 200}}
+    QUERY_BUDGET_DEFAULT = 30            # optional, applies to URL names not listed above
+
+Budgets are keyed by the url names in pbllrepo/urls.py; 'db_time' is in milliseconds.
+Query capture uses the connection's debug cursor, so it works the same on SQLite and PostgreSQL
+whether or not DEBUG is on. The middleware only turns it on for URL names that have a budget;
+other requests run as if it were not installed.
+
+Tests pin a page's budget with assert_within_budget(self.client, 'list_prototypes', budget=5).
+"""
+
+import logging
+import re
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.urls import reverse
+from django.utils.deprecation import MiddlewareMixin
+
+logger = logging.getLogger('pbllrepo.querybudget')
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK', 'COMMIT')
+
+
+def fingerprint(sql):
+    """ Normalize a statement so queries differing only in literal values compare equal. """
+    sql = _LITERALS.sub('?', sql)
+    return _IN_LISTS.sub('(...)', sql)
+
+
+def normalize_budget(budget):
+    """ Accepts a query count, a dict or None and returns {'queries': n, 'db_time': ms} (either may be None). """
+    if budget is None or isinstance(budget, dict):
+        budget = budget or {}
+        return {'queries': budget.get('queries'), 'db_time': budget.get('db_time')}
+    return {'queries': budget, 'db_time': None}
+
+
+def get_budget(url_name):
+    return normalize_budget(
+        getattr(settings, 'QUERY_BUDGETS', {}).get(url_name, getattr(settings, 'QUERY_BUDGET_DEFAULT', None)))
+
+
+class QueryRecorder(object):
+    """
+    Context manager that records the queries run on a connection while it is open:
+
+        with QueryRecorder() as recorder:
+            ...
+        recorder.count, recorder.db_time, recorder.duplicates
+    """
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.queries = []
+        self.template_time = 0.0
+
+    def __enter__(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        # Record into a log of our own: the connection's is capped, and once it wraps an index
+        # into it no longer marks where this recording started.
+        self.queries_log = self.connection.queries_log
+        self.connection.queries_log = deque()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.started
+        self.queries = list(self.connection.queries_log)
+        self.connection.queries_log = self.queries_log
+        self.queries_log.extend(self.queries)
+        self.connection.force_debug_cursor = self.force_debug_cursor
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def db_time(self):
+        """ Total time spent in the database, in milliseconds. """
+        return sum(float(q['time']) for q in self.queries) * 1000
+
+    @property
+    def duplicates(self):
+        """ {fingerprint: count} for statements run more than once. """
+        counts = Counter(
+            fingerprint(q['sql']) for q in self.queries if not q['sql'].upper().startswith(_TRANSACTION_CONTROL))
+        return {sql: n for sql, n in counts.items() if n > 1}
+
+    def over_budget(self, budget):
+        """ Returns a list of the budget keys that were exceeded. """
+        exceeded = []
+        if budget.get('queries') is not None and self.count > budget['queries']:
+            exceeded.append('queries')
+        if budget.get('db_time') is not None and self.db_time > budget['db_time']:
+            exceeded.append('db_time')
+        return exceeded
+
+    def summary(self):
+        return 'queries=%d db_time_ms=%.1f template_ms=%.1f duplicates=%d' % (
+            self.count, self.db_time, self.template_time * 1000, sum(self.duplicates.values()))
+
+
+def has_budget(budget):
+    return budget['queries'] is not None or budget['db_time'] is not None
+
+
+class QueryBudgetMiddleware(MiddlewareMixin):
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # The URL name is only known once the request is resolved; queries run by earlier
+        # middleware are not counted.
+        budget = get_budget(request.resolver_match.url_name)
+        if has_budget(budget):
+            request._query_budget = budget
+            request._query_recorder = QueryRecorder().__enter__()
+
+    def process_template_response(self, request, response):
+        recorder = getattr(request, '_query_recorder', None)
+        if recorder is not None:
+            render_started = time.time()
+
+            def rendered(response):
+                recorder.template_time += time.time() - render_started
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_query_recorder', None)
+        if recorder is None:
+            return response
+        recorder.__exit__(None, None, None)
+
+        url_name = request.resolver_match.url_name
+        exceeded = recorder.over_budget(request._query_budget)
+        if exceeded:
+            duplicates = sorted(recorder.duplicates.items(), key=lambda i: -i[1])
+            logger.warning(
+                'query_budget_exceeded url_name=%s path=%s status=%s exceeded=%s %s top_duplicate=%r',
+                url_name, request.path, response.status_code, ','.join(exceeded), recorder.summary(),
+                duplicates[0] if duplicates else None)
+        return response
+
+
+def assert_within_budget(client, url_name, args=None, kwargs=None, budget=None, **extra):
+    """
+    Test helper: GET the named url with a django.test.Client and raise AssertionError if it runs
+    more queries (or DB time) than its configured budget, or the explicit budget passed in.
+    Returns the response.
+    """
+    budget = get_budget(url_name) if budget is None else normalize_budget(budget)
+
+    # The client fires request_started, which would otherwise clear the query log mid-recording.
+    request_started.disconnect(reset_queries)
+    try:
+        with QueryRecorder() as recorder:
+            response = client.get(reverse(url_name, args=args, kwargs=kwargs), **extra)
+    finally:
+        request_started.connect(reset_queries)
+
+    exceeded = recorder.over_budget(budget)
+    if exceeded:
+        raise AssertionError('%s exceeded its %s budget (%s): %s\n%s' % (
+            url_name, ','.join(exceeded), budget, recorder.summary(),
+            '\n'.join('%dx %s' % (n, sql) for sql, n in recorder.duplicates.items())))
+    return response
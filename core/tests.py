@@ -1,3 +1,123 @@
-from django.test import TestCase
+import threading
+import time
 
-# Create your tests here.
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.db import connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import resolve
+
+from .cache import TieredCache
+from .querybudget import QueryBudgetMiddleware, QueryRecorder
+
+
+@override_settings(CACHE_SINGLE_PROCESS=True, TIERED_CACHE_WAIT_TIMEOUT=2)
+class TieredCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = TieredCache(prefix='tiered-tests')
+        self.calls = []
+
+    def compute(self, value, delay=0):
+        def compute():
+            self.calls.append(value)
+            time.sleep(delay)
+            return value
+        return compute
+
+    def hold_lock(self, key):
+        caches['default'].add(self.cache._key('lock', key), 'elsewhere', 30)
+
+    def test_single_flight(self):
+        results = []
+
+        def get():
+            results.append(self.cache.get_or_compute('k', self.compute(1, delay=0.2)))
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1, 1, 1, 1])
+        self.assertEqual(self.calls, [1])
+
+    def test_expired_value_is_served_stale_while_another_worker_recomputes(self):
+        self.cache.get_or_compute('k', self.compute(1), timeout=0, stale=60)
+        self.hold_lock('k')
+        self.assertEqual(self.cache.get_or_compute('k', self.compute(2), timeout=0, stale=60), 1)
+        self.assertEqual(self.calls, [1])
+
+    def test_wait_without_a_stale_value_is_bounded(self):
+        self.hold_lock('k')
+        started = time.time()
+        with self.settings(TIERED_CACHE_WAIT_TIMEOUT=0.1):
+            self.assertEqual(self.cache.get_or_compute('k', self.compute(1)), 1)
+        self.assertLess(time.time() - started, 1)
+
+    def test_invalidating_a_tag_expires_its_entries(self):
+        self.cache.get_or_compute('tagged', self.compute(1), timeout=None, tags=('a',))
+        self.cache.get_or_compute('other', self.compute(2), timeout=None, tags=('b',))
+        self.cache.invalidate_tags(['a'])
+        self.assertEqual(self.cache.get_or_compute('tagged', self.compute(3), timeout=None, tags=('a',)), 3)
+        self.assertEqual(self.cache.get_or_compute('other', self.compute(4), timeout=None, tags=('b',)), 2)
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_locmem_entries_expire_without_shared_invalidations(self):
+        with self.settings(CACHE_SINGLE_PROCESS=False):
+            self.cache.get_or_compute('k', self.compute(1), timeout=None, stale=0)
+        self.assertLess(caches['default'].get(self.cache._key('value', 'k'))['fresh_until'], float('inf'))
+        self.cache.get_or_compute('k2', self.compute(2), timeout=None, stale=0)
+        self.assertEqual(caches['default'].get(self.cache._key('value', 'k2'))['fresh_until'], float('inf'))
+
+
+@override_settings(CACHE_SINGLE_PROCESS=True)
+class InvalidateOnCommitTest(TransactionTestCase):
+
+    def test_invalidation_waits_for_the_commit(self):
+        caches['default'].clear()
+        cache = TieredCache(prefix='tiered-tests')
+        cache.get_or_compute('k', lambda: 'before', timeout=None, tags=('a',))
+        with transaction.atomic():
+            cache.invalidate_tags(['a'])
+            self.assertEqual(cache.get_or_compute('k', lambda: 'during', timeout=None, tags=('a',)), 'before')
+        self.assertEqual(cache.get_or_compute('k', lambda: 'after', timeout=None, tags=('a',)), 'after')
+
+
+class QueryBudgetTest(TestCase):
+
+    def run_query(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def test_recorder_counts_after_the_log_wraps(self):
+        with QueryRecorder() as outer:
+            for i in range(connection.queries_limit + 5):
+                self.run_query()
+            with QueryRecorder() as inner:
+                self.run_query()
+                self.run_query()
+        self.assertEqual(inner.count, 2)
+        self.assertEqual(outer.count, connection.queries_limit + 7)
+        self.assertEqual(len(connection.queries_log), connection.queries_limit)
+
+    def budgeted_request(self, path):
+        request = RequestFactory().get(path)
+        request.resolver_match = resolve(path)
+        return request
+
+    @override_settings(QUERY_BUDGETS={'home': 0})
+    def test_middleware_only_records_budgeted_urls(self):
+        middleware = QueryBudgetMiddleware()
+        request = self.budgeted_request('/prototypes/')
+        middleware.process_view(request, None, (), {})
+        self.assertFalse(connection.force_debug_cursor)
+
+        request = self.budgeted_request('/')
+        middleware.process_view(request, None, (), {})
+        self.assertTrue(connection.force_debug_cursor)
+        self.run_query()
+        with self.assertLogs('pbllrepo.querybudget', 'WARNING'):
+            middleware.process_response(request, HttpResponse())
+        self.assertFalse(connection.force_debug_cursor)
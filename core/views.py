@@ -1,12 +1,26 @@
 from django.shortcuts import render, redirect
-from django.views.generic import TemplateView
-from django.core import management
+from django.views.generic import TemplateView, View
 from django.contrib import messages
 
+from braces.views import JSONResponseMixin, StaffuserRequiredMixin
+
+from reposite.indexing import enqueue_rebuild, queue_status
+
+
 class UpdateIndexView(TemplateView):
     template_name = 'search.html'
 
     def get(self, request, *args, **kwargs):
-        management.call_command('update_index')
-        messages.info(request, 'Index has been updated.')
+        enqueue_rebuild()
+        messages.info(request, 'Index rebuild has been queued.')
         return redirect('haystack_search')
+
+
+class IndexStatusView(StaffuserRequiredMixin, JSONResponseMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        status = queue_status()
+        for i in ('oldest', 'newest'):
+            if status[i]:
+                status[i] = status[i].isoformat()
+        return self.render_json_response(status)
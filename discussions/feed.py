@@ -0,0 +1,163 @@
+# feed.py
+"""
+Change feed for discussion threads.
+
+Listeners ask for the replies of one thread created, edited or removed since a cursor: the
+(modified, id) of the newest change they have seen, written "<iso timestamp>~<id>". The id breaks
+ties between replies stamped the same instant. A reply whose transaction commits after a later
+stamped one has been served would still fall behind the cursor, so every answer also repeats the
+changes of the OVERLAP seconds before it; clients de-duplicate by id and modified. Post views publish to an in-process hub once their transaction
+commits, which wakes listeners in the same process straight away. Listeners also re-check the
+database every DISCUSSION_FEED_POLL_INTERVAL seconds, which picks up changes made by other
+processes. The DB connection is released before every wait, so idle listeners don't hold one.
+
+A waiting listener does hold its worker, though: with gunicorn's default sync workers every open
+page would pin one for up to TIMEOUT seconds (STREAM_LIMIT for event streams). Live updates are
+therefore off unless DISCUSSION_FEED_LIVE is set, which should only be done when the site runs
+async workers (e.g. gunicorn -k gevent). Even then only logged-in users viewing a thread listen.
+With the feed off, the changes endpoint answers at once instead of waiting.
+
+    DISCUSSION_FEED_LIVE = False          # page scripts listen for changes; needs async workers
+    DISCUSSION_FEED_TIMEOUT = 25          # seconds a long-poll request waits before returning empty
+    DISCUSSION_FEED_POLL_INTERVAL = 5     # seconds between DB checks while waiting
+    DISCUSSION_FEED_STREAM_LIMIT = 300    # seconds an event stream stays open before the client reconnects
+    DISCUSSION_FEED_OVERLAP = 10          # seconds before the cursor that are sent again
+"""
+
+import datetime
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import Post
+
+
+def feed_setting(name, default):
+    return getattr(settings, 'DISCUSSION_FEED_' + name, default)
+
+
+class ThreadHub(object):
+    """ Per-thread change counters; waiters block on one condition until their thread's counter moves. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def version(self, thread_id):
+        with self._condition:
+            return self._versions.get(thread_id, 0)
+
+    def publish(self, thread_id):
+        with self._condition:
+            self._versions[thread_id] = self._versions.get(thread_id, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, thread_id, version, timeout):
+        """ Block until thread_id changes past `version` or timeout runs out; True if it changed. """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._versions.get(thread_id, 0) == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+hub = ThreadHub()
+
+
+def publish_thread(thread_id):
+    """ Wake listeners on thread_id once the current transaction (if any) commits. """
+    if thread_id:
+        transaction.on_commit(lambda: hub.publish(thread_id))
+
+
+def feed_live():
+    return feed_setting('LIVE', False)
+
+
+def wait_timeout(value):
+    """ Seconds a request asked to wait, clamped to [0, TIMEOUT]; TIMEOUT when missing or not a finite number. """
+    limit = feed_setting('TIMEOUT', 25) if feed_live() else 0
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return limit
+    if not math.isfinite(timeout):
+        return limit
+    return max(0, min(timeout, limit))
+
+
+def parse_cursor(value):
+    """ (modified, id) from a cursor; a bare timestamp, as older pages send, counts as id 0. None if invalid. """
+    stamp, sep, pk = (value or '').rpartition('~')
+    if not sep:
+        stamp, pk = value or '', '0'
+    try:
+        modified = parse_datetime(stamp)
+    except ValueError:
+        return None
+    if modified is None or not pk.isdigit():
+        return None
+    return modified, int(pk)
+
+
+def format_cursor(cursor):
+    return '%s~%d' % (cursor[0].isoformat(), cursor[1]) if cursor else ''
+
+
+def change_key(post):
+    return post.modified, post.pk
+
+
+def latest_cursor(thread_id):
+    """ The cursor of the thread's newest change, for listeners that join without one. """
+    return Post.objects.filter(parent_post_id=thread_id).order_by('-modified', '-id').values_list('modified', 'id').first()
+
+
+def changes_since(thread_id, cursor):
+    """
+    Replies of the thread touched after `cursor`, plus those of the OVERLAP seconds before it,
+    oldest change first; deleted ones included.
+    """
+    changes = Post.objects.filter(parent_post_id=thread_id).select_related('creator').order_by('modified', 'id')
+    if cursor is not None:
+        changes = changes.filter(modified__gte=cursor[0] - datetime.timedelta(seconds=feed_setting('OVERLAP', 10)))
+    return list(changes)
+
+
+def advance_cursor(cursor, changes):
+    """ The cursor after serving `changes`: the newest of them, or `cursor` if it is newer. """
+    if changes and (cursor is None or change_key(changes[-1]) > cursor):
+        return change_key(changes[-1])
+    return cursor
+
+
+def release_connection():
+    """ Hand the DB connection back before blocking, unless a transaction still needs it. """
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+def wait_for_changes(thread_id, cursor, timeout):
+    """
+    Long-poll: changes_since(cursor), as soon as one lies past the cursor or after `timeout`
+    seconds. On timeout only the overlap is returned, possibly nothing.
+    """
+    poll_interval = feed_setting('POLL_INTERVAL', 5)
+    deadline = time.time() + timeout
+    while True:
+        version = hub.version(thread_id)
+        changes = changes_since(thread_id, cursor)
+        if advance_cursor(cursor, changes) != cursor:
+            return changes
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return changes
+        release_connection()
+        hub.wait(thread_id, version, min(poll_interval, remaining))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from discussions.readmarkers import collapse_duplicate_markers
+
+
+class Command(BaseCommand):
+    help = 'Merge duplicate DiscussionLog rows so each (user, discussion) pair has one read marker.'
+
+    def handle(self, *args, **options):
+        removed = collapse_duplicate_markers()
+        self.stdout.write('Removed %d duplicate read marker(s).' % removed)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from discussions.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Recompute the reply counters (reply_count, last_reply_at, last_reply_by) on every discussion thread.'
+
+    def handle(self, *args, **options):
+        updated = Post.objects.filter(parent_post=None).refresh_reply_counters()
+        self.stdout.write('Recomputed reply counters for %d thread(s).' % updated)
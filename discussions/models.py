@@ -1,11 +1,84 @@
+import base64
+
 from django.db import models
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
 
 from model_utils.models import TimeStampedModel
 
 
+REPLY_PAGE_SIZE = 20
+
+
+def encode_reply_cursor(post):
+    """ Opaque, url-safe keyset position of a reply: its (created, id) pair. """
+    raw = '%s|%d' % (post.created.isoformat(), post.id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_reply_cursor(cursor):
+    """ (created, id) from encode_reply_cursor(), or None for a missing or malformed cursor. """
+    if not cursor:
+        return None
+    try:
+        created, pk = base64.urlsafe_b64decode(str(cursor).encode('ascii')).decode('utf-8').rsplit('|', 1)
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if created is None:
+        return None
+    return created, pk
+
+
+class PostQuerySet(models.QuerySet):
+
+    def threads_for(self, user):
+        """
+        Top-level posts annotated with unread_reply_count (live replies modified since the user's last
+        DiscussionLog visit, falling back to their last login), in one query. Reply totals come from
+        the reply_count counter on each thread.
+        """
+        last_visit = DiscussionLog.objects.filter(
+            user=user, discussion=OuterRef('pk')).order_by('-modified').values('modified')[:1]
+        return self.filter(parent_post=None).annotate(
+            last_visit=Coalesce(Subquery(last_visit), Value(user.last_login), output_field=models.DateTimeField())
+        ).annotate(
+            unread_reply_count=Sum(Case(
+                When(Q(replies__deleted=False) & Q(replies__modified__gt=F('last_visit')), then=1),
+                default=0, output_field=models.IntegerField())),
+        ).order_by('created')
+
+    def reply_page(self, cursor=None, limit=REPLY_PAGE_SIZE):
+        """
+        One page of live posts, newest first, seeking past `cursor` on (created, id) instead of using
+        OFFSET so older pages cost the same as the first. Returns (replies, next_cursor); next_cursor
+        is None on the last page.
+        """
+        replies = self.filter(deleted=False).select_related('creator').order_by('-created', '-id')
+        position = decode_reply_cursor(cursor)
+        if position:
+            created, pk = position
+            replies = replies.filter(Q(created__lt=created) | Q(created=created, id__lt=pk))
+        page = list(replies[:limit + 1])
+        next_cursor = encode_reply_cursor(page[limit - 1]) if len(page) > limit else None
+        return page[:limit], next_cursor
+
+    def refresh_reply_counters(self):
+        """ Recompute reply_count / last_reply_at / last_reply_by for the threads in this queryset with one UPDATE. """
+        live = Post.objects.filter(parent_post=OuterRef('pk'), deleted=False)
+        return self.update(
+            reply_count=Coalesce(Subquery(
+                live.order_by().values('parent_post').annotate(n=Count('id')).values('n'),
+                output_field=models.IntegerField()), Value(0)),
+            last_reply_at=Subquery(live.order_by('-created', '-id').values('created')[:1]),
+            last_reply_by=Subquery(live.order_by('-created', '-id').values('creator')[:1]))
+
+
 class Post(TimeStampedModel):
     text = models.TextField()
     creator = models.ForeignKey(User)
@@ -14,10 +87,35 @@ class Post(TimeStampedModel):
     deleted = models.BooleanField(default=False)
     slug = models.SlugField(max_length=128, null=True, blank=True)
 
+    # Counter cache for top-level posts (threads). Maintained by the discussion views;
+    # see refresh_reply_counters() and the repair_thread_counters command.
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    last_reply_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_reply_by = models.ForeignKey(User, null=True, blank=True, editable=False, related_name='+', on_delete=models.SET_NULL)
+
+    objects = PostQuerySet.as_manager()
+
+    COUNTER_FIELDS = ('reply_count', 'last_reply_at', 'last_reply_by')
+
+    class Meta:
+        indexes = [models.Index(fields=['parent_post', 'created', 'id'])]
+
     def save(self, *args, **kwargs):
         self.slug = slugify(str(self.subject))
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # Leave the counter cache to the queryset updates so a stale instance can't overwrite it.
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.COUNTER_FIELDS]
         super(Post, self).save(*args, **kwargs)
 
+    def record_reply(self, reply):
+        """ Count a newly created reply against this thread. """
+        Post.objects.filter(pk=self.pk).update(
+            reply_count=F('reply_count') + 1, last_reply_at=reply.created, last_reply_by=reply.creator)
+
+    def refresh_reply_counters(self):
+        Post.objects.filter(pk=self.pk).refresh_reply_counters()
+
     def __unicode__(self):
         return self.subject
 
@@ -26,6 +124,9 @@ class DiscussionLog(TimeStampedModel):
     user = models.ForeignKey(User)
     discussion = models.ForeignKey(Post)
 
+    class Meta:
+        unique_together = ('user', 'discussion')
+
     def __unicode__(self):
         return str(self.modified)
 
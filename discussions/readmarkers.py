@@ -0,0 +1,186 @@
+# readmarkers.py
+"""
+Read markers: one DiscussionLog row per (user, thread) whose `modified` is the last visit.
+
+Views call mark_read(); markers are coalesced in memory (a later visit to the same thread
+replaces an earlier one) and written as one batched upsert once READ_MARKER_BATCH_SIZE markers
+are pending or the oldest has waited READ_MARKER_FLUSH_SECONDS. A timer started with the first
+pending marker enforces the deadline even when the worker goes idle.
+
+The buffer is per process, so markers are eventually consistent across workers: a visit shows up
+in other workers' reads within READ_MARKER_FLUSH_SECONDS, and one killed outright (SIGKILL, an
+OOM kill) loses at most that much. A clean exit or worker recycle flushes. Views that read a
+user's markers call flush(user) first so that requests served by the same worker always see
+their own visits; set READ_MARKER_FLUSH_SECONDS = 0 to write through instead.
+
+    READ_MARKER_FLUSH_SECONDS = 5     # 0 writes every marker through immediately
+    READ_MARKER_BATCH_SIZE = 200
+"""
+
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils.timezone import now
+
+from .models import DiscussionLog, Post
+
+
+def marker_setting(name, default):
+    return getattr(settings, 'READ_MARKER_' + name, default)
+
+
+def _upsert_sql():
+    """
+    INSERT ... ON CONFLICT for backends that have it (PostgreSQL, SQLite >= 3.24), else None.
+    A marker only ever moves forward, so an older visit flushed late by another worker can't
+    make replies already read show as unread again.
+    """
+    if connection.vendor == 'postgresql':
+        latest = 'GREATEST'
+    elif connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 24, 0):
+        latest = 'MAX'
+    else:
+        return None
+    opts = DiscussionLog._meta
+    qn = connection.ops.quote_name
+    columns = [opts.get_field(name).column for name in ('created', 'modified', 'user', 'discussion')]
+    return ('INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s) ON CONFLICT (%s, %s) '
+            'DO UPDATE SET %s = %s(%s.%s, excluded.%s)') % (
+        qn(opts.db_table), ', '.join(qn(c) for c in columns), qn(columns[2]), qn(columns[3]),
+        qn(columns[1]), latest, qn(opts.db_table), qn(columns[1]), qn(columns[1]))
+
+
+def write_markers(markers):
+    """ Upsert {(user_id, thread_id): visited_at} in one batch, never moving a marker back. """
+    if not markers:
+        return
+    sql = _upsert_sql()
+    if sql:
+        adapt = connection.ops.adapt_datetimefield_value
+        rows = [(adapt(when), adapt(when), user_id, thread_id) for (user_id, thread_id), when in markers.items()]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        return
+
+    with transaction.atomic():
+        missing = []
+        for (user_id, thread_id), when in markers.items():
+            logs = DiscussionLog.objects.filter(user_id=user_id, discussion_id=thread_id)
+            if not logs.filter(modified__lt=when).update(modified=when) and not logs.exists():
+                missing.append(DiscussionLog(user_id=user_id, discussion_id=thread_id, created=when, modified=when))
+        DiscussionLog.objects.bulk_create(missing)
+        # bulk_create stamps 'modified' with the insert time (model_utils); put the visit back.
+        for log in missing:
+            DiscussionLog.objects.filter(user_id=log.user_id, discussion_id=log.discussion_id).update(
+                modified=markers[(log.user_id, log.discussion_id)])
+
+
+class ReadMarkerBuffer(object):
+    """ Pending markers for this process, keyed by (user_id, thread_id). """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._since = None
+        self._timer = None
+
+    def mark(self, user_id, thread_id, when):
+        with self._lock:
+            key = (user_id, thread_id)
+            if self._pending.get(key) is None or self._pending[key] < when:
+                self._pending[key] = when
+            if self._since is None:
+                self._since = time.time()
+                self._schedule()
+            due = (len(self._pending) >= marker_setting('BATCH_SIZE', 200) or
+                   time.time() - self._since >= marker_setting('FLUSH_SECONDS', 5))
+        if due:
+            self.flush()
+
+    def _schedule(self):
+        delay = marker_setting('FLUSH_SECONDS', 5)
+        if delay <= 0 or (self._timer is not None and self._timer.is_alive()):
+            return
+        self._timer = threading.Timer(delay, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
+        finally:
+            connection.close()  # the timer thread's own connection
+        with self._lock:
+            self._timer = None
+            if self._pending:
+                self._schedule()
+
+    def flush(self, user_id=None):
+        """ Write pending markers, or only those of user_id. """
+        with self._lock:
+            if user_id is None:
+                batch, self._pending = self._pending, {}
+            else:
+                batch = dict((k, v) for k, v in self._pending.items() if k[0] == user_id)
+                for key in batch:
+                    del self._pending[key]
+            if not self._pending:
+                self._since = None
+        write_markers(batch)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+
+buffer = ReadMarkerBuffer()
+
+
+def _flush_at_exit():
+    try:
+        buffer.flush()
+    except Exception:
+        pass
+
+atexit.register(_flush_at_exit)
+
+
+def mark_read(user, thread_id, when=None):
+    """ Record that user has seen thread_id as of `when` (default now). """
+    if user.is_authenticated() and thread_id:
+        buffer.mark(user.pk, thread_id, when or now())
+
+
+def flush(user=None):
+    buffer.flush(user.pk if user is not None else None)
+
+
+def mark_all_read(user, when=None):
+    """ Mark every thread read for user with one batched upsert. """
+    when = when or now()
+    buffer.flush(user.pk)
+    thread_ids = Post.objects.filter(parent_post=None).values_list('pk', flat=True)
+    write_markers(dict(((user.pk, pk), when) for pk in thread_ids))
+
+
+def collapse_duplicate_markers():
+    """
+    Keep one DiscussionLog per (user, discussion), carrying the latest visit, so the unique
+    constraint can be applied. Returns the number of rows removed.
+    """
+    removed = 0
+    duplicates = (DiscussionLog.objects.values('user', 'discussion')
+                  .annotate(n=Count('id'), last_visit=Max('modified')).filter(n__gt=1))
+    with transaction.atomic():
+        for dup in duplicates:
+            logs = DiscussionLog.objects.filter(user=dup['user'], discussion=dup['discussion']).order_by('id')
+            keep = logs.first()
+            removed += logs.exclude(pk=keep.pk).delete()[0]
+            DiscussionLog.objects.filter(pk=keep.pk).update(modified=dup['last_visit'])
+    return removed
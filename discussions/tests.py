@@ -1,3 +1,216 @@
-from django.test import TestCase
+import datetime
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+
+from reposite.models import ProjectPrototype
+
+from .feed import format_cursor, wait_timeout
+from .models import DiscussionLog, Post
+from .readmarkers import ReadMarkerBuffer, write_markers
+
+
+class ReplyAccessTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'pw')
+        prototype = ProjectPrototype.objects.create(
+            title='Prototype', creator=self.user, description='d', driving_question='q', active=True)
+        self.project_thread = prototype.project_discussion.get().thread
+        self.private_thread = Post.objects.create(subject='Staff room', text='t', creator=self.user)
+        for thread in (self.project_thread, self.private_thread):
+            Post.objects.create(subject='<b>Re</b>', text='reply', creator=self.user, parent_post=thread)
+
+    def replies(self, thread):
+        return self.client.get(reverse('list_replies', args=[thread.pk]))
+
+    def test_anonymous_reads_only_project_comments(self):
+        self.assertEqual(self.replies(self.project_thread).status_code, 200)
+        self.assertEqual(self.replies(self.private_thread).status_code, 404)
+
+    def test_logged_in_reads_any_thread(self):
+        self.client.force_login(self.user)
+        response = self.replies(self.private_thread)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['subject'] for r in response.json()['replies']], ['<b>Re</b>'])
+
+
+class ThreadsForTest(TestCase):
+
+    def setUp(self):
+        self.start = now() - datetime.timedelta(days=10)
+        self.reader = User.objects.create_user('reader', 'reader@example.com', 'pw', last_login=self.day(1))
+        self.other = User.objects.create_user('other', 'other@example.com', 'pw', last_login=self.day(9))
+        self.busy = self.thread('Busy', replies=(2, 4, 6), deleted=(7,))
+        self.quiet = self.thread('Quiet')
+        self.unvisited = self.thread('Unvisited', replies=(3, 5))
+        self.visit(self.reader, self.busy, 5)
+        self.visit(self.reader, self.quiet, 5)
+        self.visit(self.other, self.busy, 1)
+
+    def day(self, n):
+        return self.start + datetime.timedelta(days=n)
+
+    def thread(self, subject, replies=(), deleted=()):
+        thread = Post.objects.create(subject=subject, text='t', creator=self.other)
+        for day in replies + deleted:
+            reply = Post.objects.create(
+                subject='Re', text='r', creator=self.other, parent_post=thread, deleted=day in deleted)
+            Post.objects.filter(pk=reply.pk).update(modified=self.day(day))
+        return thread
+
+    def visit(self, user, thread, day):
+        log = DiscussionLog.objects.create(user=user, discussion=thread)
+        DiscussionLog.objects.filter(pk=log.pk).update(modified=self.day(day))
+
+    def unread(self, user):
+        with self.assertNumQueries(1):
+            return dict(Post.objects.threads_for(user).values_list('subject', 'unread_reply_count'))
+
+    def test_unread_counts_follow_each_users_visits(self):
+        # Deleted replies never count; a thread never visited counts from the last login.
+        self.assertEqual(self.unread(self.reader), {'Busy': 1, 'Quiet': 0, 'Unvisited': 2})
+        self.assertEqual(self.unread(self.other), {'Busy': 3, 'Quiet': 0, 'Unvisited': 0})
+
+    def test_replies_are_not_threads(self):
+        self.assertEqual(Post.objects.threads_for(self.reader).count(), 3)
+
+
+class ReplyCountersTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'pw')
+        self.first = Post.objects.create(subject='First', text='t', creator=self.user)
+        self.second = Post.objects.create(subject='Second', text='t', creator=self.user)
+        self.client.force_login(self.user)
+
+    def counters(self, thread):
+        return Post.objects.values_list(*Post.COUNTER_FIELDS).get(pk=thread.pk)
+
+    def reply(self, thread, text='reply'):
+        response = self.client.post(
+            reverse('create_post'), {'subject': 'Re', 'text': text, 'creator': self.user.pk, 'parent_post': thread.pk},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return Post.objects.get(pk=response.json()['id'])
+
+    def test_create_delete_and_move(self):
+        older = self.reply(self.first, 'older')
+        newer = self.reply(self.first, 'newer')
+        self.assertEqual(self.counters(self.first), (2, newer.created, self.user.pk))
+
+        self.client.post(reverse('delete_post'), {'post': newer.pk}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(self.counters(self.first), (1, older.created, self.user.pk))
+
+        self.client.post(reverse('edit_post', args=[older.pk]), {
+            'subject': 'Re', 'text': 'moved', 'creator': self.user.pk, 'parent_post': self.second.pk})
+        self.assertEqual(Post.objects.get(pk=older.pk).parent_post_id, self.second.pk)
+        self.assertEqual(self.counters(self.first), (0, None, None))
+        self.assertEqual(self.counters(self.second), (1, older.created, self.user.pk))
+
+    def test_refresh_repairs_drifted_counters(self):
+        reply = self.reply(self.first)
+        Post.objects.filter(pk__in=[self.first.pk, self.second.pk]).update(
+            reply_count=7, last_reply_at=now(), last_reply_by=None)
+        self.assertEqual(Post.objects.filter(parent_post=None).refresh_reply_counters(), 2)
+        self.assertEqual(self.counters(self.first), (1, reply.created, self.user.pk))
+        self.assertEqual(self.counters(self.second), (0, None, None))
+
+        Post.objects.filter(pk=self.first.pk).update(reply_count=0)
+        self.first.refresh_reply_counters()
+        self.assertEqual(self.counters(self.first), (1, reply.created, self.user.pk))
+
+
+@override_settings(DISCUSSION_FEED_LIVE=True, DISCUSSION_FEED_TIMEOUT=0.2, DISCUSSION_FEED_POLL_INTERVAL=0.05)
+class ThreadChangesTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'pw')
+        self.thread = Post.objects.create(subject='Thread', text='t', creator=self.user)
+        self.reply = Post.objects.create(subject='Secret', text='gone', creator=self.user, parent_post=self.thread)
+        self.client.force_login(self.user)
+
+    def changes(self, **params):
+        return self.client.get(reverse('thread_changes', args=[self.thread.pk]), params)
+
+    def test_wait_timeout_is_clamped(self):
+        for value, expected in (('nan', 0.2), ('inf', 0.2), ('-inf', 0.2), ('x', 0.2), (None, 0.2),
+                                ('-3', 0), ('0.1', 0.1), ('90', 0.2)):
+            self.assertEqual(wait_timeout(value), expected, value)
+        with self.settings(DISCUSSION_FEED_LIVE=False):
+            self.assertEqual(wait_timeout('20'), 0)
+
+    def test_nan_timeout_returns(self):
+        cursor = format_cursor((self.reply.modified, self.reply.pk))
+        response = self.changes(timeout='nan', since=cursor)
+        self.assertEqual(response.json()['cursor'], cursor)
+
+    def test_reply_stamped_with_the_cursor_instant_is_served(self):
+        twin = Post.objects.create(subject='Twin', text='t', creator=self.user, parent_post=self.thread)
+        Post.objects.filter(pk=twin.pk).update(modified=self.reply.modified)
+        response = self.changes(since=format_cursor((self.reply.modified, self.reply.pk))).json()
+        self.assertIn(twin.pk, [r['id'] for r in response['replies']])
+        self.assertEqual(response['cursor'], format_cursor((self.reply.modified, twin.pk)))
+
+    def test_late_commit_behind_the_cursor_is_served_within_the_overlap(self):
+        served = self.changes().json()['cursor']
+        late = Post.objects.create(subject='Late', text='t', creator=self.user, parent_post=self.thread)
+        Post.objects.filter(pk=late.pk).update(modified=self.reply.modified - datetime.timedelta(seconds=1))
+        response = self.changes(since=served).json()
+        self.assertIn(late.pk, [r['id'] for r in response['replies']])
+        self.assertEqual(response['cursor'], served)
+        with self.settings(DISCUSSION_FEED_OVERLAP=0):
+            self.assertNotIn(late.pk, [r['id'] for r in self.changes(since=served).json()['replies']])
+
+    def test_deleted_reply_carries_only_its_id(self):
+        Post.objects.filter(pk=self.reply.pk).update(deleted=True)
+        response = self.changes(since=self.thread.created.replace(year=2000).isoformat())
+        self.assertEqual(response.json()['replies'], [{'id': self.reply.pk, 'deleted': True}])
+
+    def test_login_required(self):
+        self.client.logout()
+        self.assertEqual(self.changes().status_code, 302)
+
+
+@override_settings(READ_MARKER_FLUSH_SECONDS=0.05)
+class ReadMarkerBufferTest(TestCase):
+
+    def test_idle_buffer_flushes_on_deadline(self):
+        written = []
+        marker_buffer = ReadMarkerBuffer()
+        with mock.patch('discussions.readmarkers.write_markers', written.append), \
+                mock.patch('discussions.readmarkers.connection'):
+            marker_buffer.mark(1, 2, 'visit')
+            self.assertEqual(written, [])
+            for i in range(40):
+                if written:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(written, [{(1, 2): 'visit'}])
+        self.assertEqual(marker_buffer.pending(), 0)
+
+
+class WriteMarkersTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'pw')
+        self.thread = Post.objects.create(subject='Thread', text='t', creator=self.user)
+        self.key = (self.user.pk, self.thread.pk)
+
+    def assertMarkersOnlyMoveForward(self):
+        newer = now()
+        older = newer - datetime.timedelta(minutes=5)
+        write_markers({self.key: older})
+        write_markers({self.key: newer})
+        write_markers({self.key: older})
+        self.assertEqual(list(DiscussionLog.objects.values_list('modified', flat=True)), [newer])
+
+    def test_upsert(self):
+        self.assertMarkersOnlyMoveForward()
+
+    def test_fallback(self):
+        with mock.patch('discussions.readmarkers._upsert_sql', return_value=None):
+            self.assertMarkersOnlyMoveForward()
@@ -1,39 +1,76 @@
+import json
+import time
+
 from django.views.generic import TemplateView, CreateView, ListView, DetailView, DeleteView, UpdateView, FormView, View
+from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.urlresolvers import reverse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
 
 from braces.views import CsrfExemptMixin, JSONResponseMixin, AjaxResponseMixin, LoginRequiredMixin, StaffuserRequiredMixin
 
+from .feed import (
+    advance_cursor, feed_live, feed_setting, format_cursor, latest_cursor, parse_cursor, publish_thread,
+    release_connection, wait_for_changes, wait_timeout)
 from .models import Post, DiscussionLog
+from .readmarkers import flush as flush_read_markers, mark_all_read, mark_read
 from .forms import PostForm, PostReplyForm
 from reposite.models import ProjectPrototype, ProjectComment
 
 
+def reply_data(reply, user, since, is_new=None):
+    """ JSON shape of a reply for the comment scripts. Removed replies carry nothing but their id. """
+    if reply.deleted:
+        return {'id': reply.id, 'deleted': True}
+    if is_new is None:
+        is_new = bool(since and reply.modified > since)
+    return {
+        'id': reply.id,
+        'subject': reply.subject,
+        'text': reply.text,
+        'deleted': False,
+        'creator': reply.creator.username,
+        'creator_name': reply.creator.get_full_name(),
+        'modified': reply.modified.strftime('%b %d %Y %H:%M'),
+        'is_new': is_new,
+        'is_owner': user == reply.creator,
+        'can_edit': user == reply.creator or user.is_staff,
+        'edit_url': reverse('edit_post', args=[reply.id])}
+
+
 class DiscussionListView(LoginRequiredMixin, TemplateView):
     template_name = 'discussions_index.html'
+    paginate_by = 25
 
     def get_context_data(self, **kwargs):
         context = super(DiscussionListView, self).get_context_data(**kwargs)
-        headers = Post.objects.filter(parent_post=None).order_by('created')
-        threads = []
+        flush_read_markers(self.request.user)
+        headers = Post.objects.threads_for(self.request.user).prefetch_related('project_thread__project')
 
-        for hdr in headers:
-
-            try:
-                project_comments = ProjectComment.objects.get(thread=hdr).project
-            except:
-                project_comments = None
-
-            try:
-                logger = DiscussionLog.objects.filter(user=self.request.user).get(discussion=hdr)
-                last_visit = logger.modified
-            except:
-                last_visit = self.request.user.last_login
+        paginator = Paginator(headers, self.paginate_by)
+        try:
+            page = paginator.page(self.request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
 
-            replies = hdr.replies.all().filter(deleted=False)
-            newmsgs = replies.filter(modified__gt=last_visit)
-            threads.append({'project': project_comments, 'header': hdr, 'reply_count': len(replies), 'unread_reply_count': len(newmsgs)})
+        threads = []
+        for hdr in page:
+            project_comments = hdr.project_thread.all()
+            threads.append({
+                'project': project_comments[0].project if project_comments else None,
+                'header': hdr,
+                'reply_count': hdr.reply_count,
+                'unread_reply_count': hdr.unread_reply_count})
 
         context['threads'] = threads
+        context['paginator'] = paginator
+        context['page_obj'] = page
+        context['is_paginated'] = page.has_other_pages()
         return context
 
 
@@ -41,25 +78,27 @@ class DiscussionView(LoginRequiredMixin,  DetailView):
     model = Post
     template_name = 'discussions.html'
 
+    def get_queryset(self):
+        # last_visit comes annotated on the thread itself, so read tracking costs no extra query.
+        flush_read_markers(self.request.user)
+        return Post.objects.threads_for(self.request.user)
+
     def get_context_data(self, **kwargs):
         context = super(DiscussionView, self).get_context_data(**kwargs)
 
         initial_post_data = {}
         initial_post_data['creator'] = self.request.user
-        thread_post = self.get_object()
+        thread_post = self.object
 
-        try:
-            logger = DiscussionLog.objects.filter(user=self.request.user).get(discussion=thread_post)
-        except:
-            logger = DiscussionLog(user=self.request.user, discussion=thread_post)
-            logger.save()
         try:
             project = ProjectComment.objects.get(thread=thread_post).project
         except:
             project = None
 
-        replies = thread_post.replies.all().filter(deleted=False).order_by('-created')
-        new_replies = replies.filter(modified__gt = logger.modified)
+        # Highlight against the visit marker as it was before this view; "load older" requests carry it along.
+        last_visit = thread_post.last_visit
+        replies, next_cursor = thread_post.replies.reply_page(self.request.GET.get('cursor'))
+        new_replies = [r for r in replies if last_visit and r.modified > last_visit]
 
 
         initial_post_data['subject'] = 'Re: %s'% thread_post.subject
@@ -72,11 +111,21 @@ class DiscussionView(LoginRequiredMixin,  DetailView):
         context['project'] = project
         context['replies'] = replies
         context['new_replies'] = new_replies
+        context['next_cursor'] = next_cursor
+        context['last_visit'] = last_visit.isoformat() if last_visit else ''
+        context['feed_cursor'] = format_cursor(latest_cursor(thread_post.pk))
         context['postform'] = form
 
-        logger.save()
+        mark_read(self.request.user, thread_post.pk)
         return context
 
+class MarkAllReadView(LoginRequiredMixin, View):
+
+    def post(self, request, *args, **kwargs):
+        mark_all_read(request.user)
+        return HttpResponseRedirect(reverse('discussion'))
+
+
 class PostView(LoginRequiredMixin, ListView):
     model = Post
     template_name = 'post.html'
@@ -93,6 +142,16 @@ class PostUpdateView(LoginRequiredMixin, CsrfExemptMixin, UpdateView):
             form_class = PostForm
         return form_class
 
+    def form_valid(self, form):
+        with transaction.atomic():
+            previous_thread = Post.objects.filter(pk=self.object.pk).values_list('parent_post', flat=True).first()
+            response = super(PostUpdateView, self).form_valid(form)
+            Post.objects.filter(pk__in=[previous_thread, self.object.parent_post_id]).refresh_reply_counters()
+            publish_thread(previous_thread)
+            if self.object.parent_post_id != previous_thread:
+                publish_thread(self.object.parent_post_id)
+        return response
+
     def get_success_url(self):
         thread = self.get_object().parent_post
         try:
@@ -114,7 +173,11 @@ class PostCreateView(LoginRequiredMixin, CsrfExemptMixin, JSONResponseMixin, Aja
         postform = PostReplyForm(request.POST)
         if postform.is_valid():
 
-            new_post = postform.save()
+            with transaction.atomic():
+                new_post = postform.save()
+                if new_post.parent_post:
+                    new_post.parent_post.record_reply(new_post)
+                    publish_thread(new_post.parent_post_id)
             data = {}
             data['id'] = new_post.id
             data['modified'] = new_post.modified.strftime('%b %d %Y %H:%M')
@@ -122,17 +185,86 @@ class PostCreateView(LoginRequiredMixin, CsrfExemptMixin, JSONResponseMixin, Aja
             data['creator'] = new_post.creator.username
             data['subject'] = new_post.subject
 
-            try:
-                logger = DiscussionLog.objects.get(user=request.user, discussion=new_post.parent_post)
-                logger.save()
-            except:
-                pass
+            mark_read(request.user, new_post.parent_post_id)
             # print self.render_json_response(data)
             return self.render_json_response(data)
         else:
             data = postform.errors
             return self.render_json_response(data)
 
+
+def readable_thread(request, pk):
+    """
+    The live top-level post pk if request.user may read it: any thread when logged in, as in
+    DiscussionView; otherwise only project comment threads, which the public document page shows.
+    """
+    threads = Post.objects.filter(parent_post=None, deleted=False)
+    if not request.user.is_authenticated():
+        threads = threads.filter(project_thread__isnull=False).distinct()
+    return get_object_or_404(threads, pk=pk)
+
+
+class ReplyPageView(JSONResponseMixin, View):
+    """ Older replies of a thread as JSON, one keyset page per request (see PostQuerySet.reply_page). """
+
+    def get(self, request, *args, **kwargs):
+        thread = readable_thread(request, kwargs['pk'])
+        replies, next_cursor = thread.replies.reply_page(request.GET.get('cursor'))
+
+        since = parse_datetime(request.GET.get('since', '') or '')
+        if since is None and request.user.is_authenticated():
+            flush_read_markers(request.user)
+            since = DiscussionLog.objects.filter(
+                user=request.user, discussion=thread).order_by('-modified').values_list('modified', flat=True).first()
+
+        data = {'next_cursor': next_cursor, 'replies': [reply_data(r, request.user, since) for r in replies]}
+        return self.render_json_response(data)
+
+
+class ThreadChangesView(LoginRequiredMixin, JSONResponseMixin, View):
+    """
+    Change feed for one thread: replies created, edited or removed after the `since` cursor.
+    Plain requests long-poll and return {'cursor', 'replies'}, replies repeating the overlap before
+    the cursor (see discussions.feed) and holding only that on timeout; requests that
+    accept text/event-stream get the same payloads as server-sent events. Without
+    DISCUSSION_FEED_LIVE nothing waits: see discussions.feed.
+    """
+
+    def get(self, request, *args, **kwargs):
+        thread = readable_thread(request, kwargs['pk'])
+        cursor = parse_cursor(request.GET.get('since') or request.META.get('HTTP_LAST_EVENT_ID'))
+        if cursor is None:
+            cursor = latest_cursor(thread.pk)
+        timeout = wait_timeout(request.GET.get('timeout'))
+
+        if feed_live() and 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+            response = StreamingHttpResponse(self.event_stream(thread.pk, cursor, timeout), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        changes = wait_for_changes(thread.pk, cursor, timeout)
+        return self.render_json_response(self.payload(changes, cursor))
+
+    def payload(self, changes, cursor):
+        return {
+            'cursor': format_cursor(advance_cursor(cursor, changes)) or None,
+            'replies': [reply_data(r, self.request.user, None, is_new=True) for r in changes]}
+
+    def event_stream(self, thread_id, cursor, timeout):
+        closes_at = time.time() + feed_setting('STREAM_LIMIT', 300)
+        yield 'retry: 3000\n\n'
+        while time.time() < closes_at:
+            changes = wait_for_changes(thread_id, cursor, max(0, min(timeout, closes_at - time.time())))
+            if advance_cursor(cursor, changes) == cursor:
+                # Only the overlap came back; repeating it on every keepalive would be noise.
+                yield ': keepalive\n\n'
+                continue
+            data = self.payload(changes, cursor)
+            cursor = advance_cursor(cursor, changes)
+            yield 'id: %s\ndata: %s\n\n' % (data['cursor'], json.dumps(data, cls=DjangoJSONEncoder))
+        release_connection()
+
+
 class PostDeleteView(LoginRequiredMixin, CsrfExemptMixin, JSONResponseMixin, AjaxResponseMixin, View):
 
     def post_ajax(self, request, *args, **kwargs):
@@ -141,8 +273,12 @@ class PostDeleteView(LoginRequiredMixin, CsrfExemptMixin, JSONResponseMixin, Aja
                 post = Post.objects.get(id=request.POST['post'])
 
                 if post.creator == request.user or request.user.is_staff:
-                    post.deleted = True
-                    post.save()
+                    with transaction.atomic():
+                        post.deleted = True
+                        post.save()
+                        if post.parent_post_id:
+                            Post.objects.filter(pk=post.parent_post_id).refresh_reply_counters()
+                            publish_thread(post.parent_post_id)
                     data = 'data removed'
                     return self.render_json_response(data)
                 else:
@@ -19,7 +19,7 @@ from django.contrib.auth import views as auth_view
 
 from filebrowser.sites import site
 
-from core.views import UpdateIndexView
+from core.views import UpdateIndexView, IndexStatusView
 from reposite.views import (
     HomeView,
     ProjectPrototypeCreateView, ProjectPrototypeDetailView,
@@ -27,16 +27,17 @@ from reposite.views import (
     ProjectPrototypeListView, CloneProjectView,
     ProjectTaskDetailView, ProjectTaskCreateView,
     ProjectTaskUpdateView, ProjectTaskDeleteView,
-    ProjectTaskListView, ProjectPrototypeDocumentView,
+    ProjectTaskListView, ProjectPrototypeDocumentView, ProjectPrototypeExportView,
     ProjectImplementationInfoItemView, ProjectImplementationInfoItemCreateView, 
     ProjectImplementationInfoItemUpdateView, ProjectImplementationInfoItemDeleteView,
     FileUploadView, ImplementationInfoFileUploadView, TaskFileUploadView,
+    ChunkedUploadStartView, ChunkedUploadView, ChunkedUploadCompleteView,
     ProjectFileDeleteView, TaskFileDeleteView, ImplementationFileDeleteView,
     SearchHaystackView,
     RepoPageView
 )
 
-from discussions.views import DiscussionListView, DiscussionView, PostCreateView, PostDeleteView, PostUpdateView
+from discussions.views import DiscussionListView, DiscussionView, MarkAllReadView, PostCreateView, PostDeleteView, PostUpdateView, ReplyPageView, ThreadChangesView
 
 urlpatterns = [
     # url('', include('social.apps.django_app.urls', namespace='social')),
@@ -49,6 +50,7 @@ urlpatterns = [
     # project prototypes
     url(r'^prototypes/$', ProjectPrototypeListView.as_view(), name='list_prototypes'),
     url(r'^prototype/doc/(?P<pk>[-\d]+)/$', ProjectPrototypeDocumentView.as_view(), name='docview_prototype'),
+    url(r'^prototype/export/(?P<pk>[-\d]+)/$', ProjectPrototypeExportView.as_view(), name='export_prototype'),
     url(r'^prototype/(?P<pk>[-\d]+)/$', ProjectPrototypeDetailView.as_view(), name='view_prototype'),
     url(r'^prototype/add/$', ProjectPrototypeCreateView.as_view(), name='create_prototype'),
     url(r'^prototype/edit/(?P<pk>[-\d]+)/$', ProjectPrototypeUpdateView.as_view(), name='update_prototype'),
@@ -76,6 +78,9 @@ urlpatterns = [
     url(r'^prototype/file-upload/(?P<proj_pk>[-\d]+)/$', FileUploadView.as_view(), name='upload_file'),
     url(r'^prototype/task-file-upload/(?P<task_pk>[-\d]+)/$', TaskFileUploadView.as_view(), name='upload_task_file'),
     url(r'^prototype/info-file-upload/(?P<info_pk>[-\d]+)/$', ImplementationInfoFileUploadView.as_view(), name='upload_info_file'),
+    url(r'^prototype/chunked-upload/$', ChunkedUploadStartView.as_view(), name='start_chunked_upload'),
+    url(r'^prototype/chunked-upload/(?P<upload_id>[-0-9a-f]+)/$', ChunkedUploadView.as_view(), name='chunked_upload'),
+    url(r'^prototype/chunked-upload/(?P<upload_id>[-0-9a-f]+)/complete/$', ChunkedUploadCompleteView.as_view(), name='complete_chunked_upload'),
     
     url(r'^prototype/project-file/delete/(?P<pk>[-\d]+)/$', ProjectFileDeleteView.as_view(), name='delete_file'),
     url(r'^prototype/task-file/delete/(?P<pk>[-\d]+)/$', TaskFileDeleteView.as_view(), name='delete_task_file'),
@@ -88,7 +93,10 @@ urlpatterns = [
     # discussions
     url(r'^discussions/(?P<slug>[-\w]+)/$', DiscussionView.as_view(), name='discussion_select'),
     url(r'^discussions/$', DiscussionListView.as_view(), name='discussion'),
+    url(r'^discussions/read/all/$', MarkAllReadView.as_view(), name='mark_all_read'),
     url(r'^discussions/post/add/$', PostCreateView.as_view(), name='create_post'),
+    url(r'^discussions/post/(?P<pk>\d+)/replies/$', ReplyPageView.as_view(), name='list_replies'),
+    url(r'^discussions/post/(?P<pk>\d+)/changes/$', ThreadChangesView.as_view(), name='thread_changes'),
     url(r'^discussions/post/delete/$', PostDeleteView.as_view(), name='delete_post'),
     url(r'^discussions/post/(?P<pk>[-\w]+)/edit/$', PostUpdateView.as_view(), name='edit_post'),
 
@@ -96,6 +104,7 @@ urlpatterns = [
     # url(r'^search/', include('haystack.urls'), name='haystack_search'),
     url(r'^search/', SearchHaystackView.as_view(), name='haystack_search'),
     url(r'^update_index/$', UpdateIndexView.as_view(), name='haystack_update_index'),
+    url(r'^update_index/status/$', IndexStatusView.as_view(), name='haystack_index_status'),
 
     # manual login
     url(r'^bdx/$', auth_view.login, name='login'),
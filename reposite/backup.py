@@ -0,0 +1,350 @@
+# backup.py
+"""
+Streaming backup and restore of prototypes and everything hanging off them.
+
+A backup is a JSON-lines file (gzip if the name ends in .gz):
+- The first line is a header.
+- Every other line is one row in Django's serializer shape ({"model", "pk", "fields"}).
+- Rows are written section by section in dependency order: prototypes, metadata, tasks,
+  implementation info, files, blobs, posts, comments. They are read with iterator() querysets
+  and written as they are read.
+
+Restore reads the file line by line and inserts rows with bulk_create in batches, inside one
+transaction, so a failed restore leaves nothing behind. A lineage restore first makes one
+extra pass over the file to collect the ids that belong to the lineage. Primary keys are kept.
+Prototype origins are re-linked after all prototypes are in, pointing only at prototypes that
+exist.
+Users referenced by the rows must already exist.
+
+Both directions can be limited to one origin lineage: a prototype and all of its flips,
+recursively.
+"""
+
+import datetime
+import gzip
+import io
+import json
+import sys
+import time
+from collections import OrderedDict, namedtuple
+
+from django.core import serializers
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.db.models import Case, Q, Value, When
+from django.utils.timezone import now
+
+FORMAT = 'pebbles-backup'
+FORMAT_VERSION = 1
+
+SectionReport = namedtuple('SectionReport', 'label rows elapsed')
+
+
+class BackupEncoder(DjangoJSONEncoder):
+    """ DjangoJSONEncoder, but datetimes keep their microseconds so restored rows compare equal. """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(BackupEncoder, self).default(o)
+
+
+def date_fields(model):
+    return [f for f in model._meta.concrete_fields if isinstance(f, models.DateField)]
+
+
+def restore_timestamps(model, objs):
+    """
+    Write back the date values objs carry to their rows, which bulk_create stamped through
+    auto_now / auto_now_add (and model_utils' modified field). One UPDATE per batch of rows,
+    each setting every date column with a CASE on the primary key.
+    """
+    fields = date_fields(model)
+    if not fields or not objs:
+        return
+    pk = model._meta.pk
+    size = max(1, connection.ops.bulk_batch_size([pk] + fields * 2, objs))
+    for i in range(0, len(objs), size):
+        batch = objs[i:i + size]
+        model._base_manager.filter(pk__in=[obj.pk for obj in batch]).update(**dict(
+            (field.attname, Case(*[When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                                   for obj in batch], output_field=field))
+            for field in fields))
+
+
+def bulk_insert(model, objs):
+    """ bulk_create rows exactly as given, timestamps included; objs must carry their primary keys. """
+    fields = date_fields(model)
+    # pre_save stamps the instances as well as the rows, so keep the given values aside.
+    stamps = [[getattr(obj, f.attname) for f in fields] for obj in objs]
+    created = model.objects.bulk_create(objs)
+    for obj, values in zip(objs, stamps):
+        for field, value in zip(fields, values):
+            setattr(obj, field.attname, value)
+    restore_timestamps(model, objs)
+    return created
+
+
+def open_backup(path, mode):
+    """ Text-mode handle on a backup file; '-' is stdin/stdout, *.gz is gzip. """
+    if path == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+def lineage_ids(origin_id, parents=None):
+    """
+    The prototype origin_id and every flip descending from it. Reads the database, or the
+    {id: origin_id} map in `parents` when one is given (restore).
+    """
+    from .models import ProjectPrototype
+
+    found, frontier = set([origin_id]), [origin_id]
+    while frontier:
+        if parents is None:
+            children = ProjectPrototype.objects.filter(origin__in=frontier).values_list('pk', flat=True)
+        else:
+            wanted = set(frontier)
+            children = [pk for pk, parent in parents.items() if parent in wanted]
+        frontier = [pk for pk in children if pk not in found]
+        found.update(frontier)
+    return found
+
+
+def sections(prototype_ids=None):
+    """ (label, queryset) pairs in restore order, limited to prototype_ids when given. """
+    from discussions.models import Post
+    from .models import (
+        ProjectPrototype, PrototypeMetaElement, ProjectTask, ProjectImplementationInfo, ProjectComment,
+        StoredBlob, ProjectFile, TaskFile, ImplementationFile)
+
+    def limit(queryset, lookup):
+        return queryset if prototype_ids is None else queryset.filter(**{lookup + '__in': prototype_ids})
+
+    files = (
+        limit(ProjectFile.objects.all(), 'project'),
+        limit(TaskFile.objects.all(), 'task__prototype_project'),
+        limit(ImplementationFile.objects.all(), 'implementation__prototype_project'),
+    )
+    blobs = StoredBlob.objects.all()
+    if prototype_ids is not None:
+        blobs = blobs.filter(Q(name__in=files[0].values('file')) | Q(name__in=files[1].values('file')) |
+                             Q(name__in=files[2].values('file')))
+    threads = limit(Post.objects.filter(parent_post=None), 'project_thread__project').distinct()
+    replies = limit(Post.objects.exclude(parent_post=None), 'parent_post__project_thread__project')
+
+    return (
+        ('prototypes', limit(ProjectPrototype.objects.all(), 'pk')),
+        ('metadata', limit(PrototypeMetaElement.objects.all(), 'prototype_project')),
+        ('tasks', limit(ProjectTask.objects.all(), 'prototype_project')),
+        ('implementation info', limit(ProjectImplementationInfo.objects.all(), 'prototype_project')),
+        ('project files', files[0]),
+        ('task files', files[1]),
+        ('implementation files', files[2]),
+        ('blobs', blobs),
+        ('threads', threads),
+        ('replies', replies),
+        ('comments', limit(ProjectComment.objects.all(), 'project')),
+    )
+
+
+def read_header(handle, expected=FORMAT):
+    """ The header line of a backup (or change segment) file; ValueError if it isn't one. """
+    try:
+        header = json.loads(handle.readline())
+    except ValueError:
+        header = {}
+    if not isinstance(header, dict) or header.get('format') != expected:
+        raise ValueError('Not a %s file.' % expected)
+    return header
+
+
+def write_backup(out, origin_id=None, batch_size=500, progress=None, extra=None):
+    """
+    Stream a backup into the text handle `out`. Returns a list of SectionReport.
+    `extra` is merged into the header.
+    """
+    prototype_ids = lineage_ids(origin_id) if origin_id is not None else None
+    header = {'format': FORMAT, 'version': FORMAT_VERSION, 'created': now(), 'origin': origin_id}
+    header.update(extra or {})
+    out.write(json.dumps(header, cls=BackupEncoder) + '\n')
+
+    reports = []
+    for label, queryset in sections(prototype_ids):
+        started, rows, batch = time.time(), 0, []
+        for obj in queryset.order_by('pk').iterator():
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                rows += _write_rows(out, batch)
+                batch = []
+        rows += _write_rows(out, batch)
+        reports.append(SectionReport(label, rows, time.time() - started))
+        if progress:
+            progress(reports[-1])
+    return reports
+
+
+def _write_rows(out, objs):
+    for row in serializers.serialize('python', objs):
+        out.write(json.dumps(row, cls=BackupEncoder) + '\n')
+    return len(objs)
+
+
+LineageSelection = namedtuple('LineageSelection', 'prototypes tasks infos blob_names threads')
+
+
+def scan_lineage(path, origin_id):
+    """
+    First pass over a backup for a lineage restore: which prototype, task, implementation item,
+    blob and thread ids belong to the lineage of origin_id. Only ids are kept in memory.
+    """
+    parents, keep = {}, None
+    tasks, infos, blob_names, threads = set(), set(), set(), set()
+    owner_fields = {
+        'reposite.projectfile': ('project', None),
+        'reposite.taskfile': ('task', tasks),
+        'reposite.implementationfile': ('implementation', infos),
+    }
+    with open_backup(path, 'r') as handle:
+        handle.readline()
+        for line in handle:
+            row = json.loads(line)
+            model, fields = row['model'], row['fields']
+            if model == 'reposite.projectprototype':
+                parents[row['pk']] = fields.get('origin')
+                continue
+            if keep is None:
+                keep = lineage_ids(origin_id, parents) if origin_id in parents else set()
+            if model == 'reposite.projecttask' and fields['prototype_project'] in keep:
+                tasks.add(row['pk'])
+            elif model == 'reposite.projectimplementationinfo' and fields['prototype_project'] in keep:
+                infos.add(row['pk'])
+            elif model in owner_fields:
+                field, owners = owner_fields[model]
+                if (fields[field] in keep) if owners is None else (fields[field] in owners):
+                    blob_names.add(fields['file'])
+            elif model == 'reposite.projectcomment' and fields['project'] in keep:
+                threads.add(fields['thread'])
+    if keep is None:
+        keep = lineage_ids(origin_id, parents) if origin_id in parents else set()
+    return LineageSelection(keep, tasks, infos, blob_names, threads)
+
+
+class Restorer(object):
+    """ Inserts deserialized rows model by model in bulk_create batches; see restore_backup(). """
+
+    def __init__(self, batch_size, selection=None):
+        self.batch_size = batch_size
+        self.selection = selection
+        self.pending = []
+        self.reports = OrderedDict()
+        self.origins = {}
+
+    def wants(self, obj):
+        """ Whether a row belongs to the lineage being restored (always, without one). """
+        sel = self.selection
+        if sel is None:
+            return True
+        label = obj._meta.label_lower
+        if label == 'reposite.projectprototype':
+            return obj.pk in sel.prototypes
+        if label in ('reposite.prototypemetaelement', 'reposite.projecttask', 'reposite.projectimplementationinfo'):
+            return obj.prototype_project_id in sel.prototypes
+        if label in ('reposite.projectfile', 'reposite.projectcomment'):
+            return obj.project_id in sel.prototypes
+        if label == 'reposite.taskfile':
+            return obj.task_id in sel.tasks
+        if label == 'reposite.implementationfile':
+            return obj.implementation_id in sel.infos
+        if label == 'reposite.storedblob':
+            return obj.name in sel.blob_names
+        if label == 'discussions.post':
+            return (obj.parent_post_id or obj.pk) in sel.threads
+        return False
+
+    def add(self, obj):
+        if self.pending and type(self.pending[0]) is not type(obj):
+            self.flush()
+        if obj._meta.label_lower == 'reposite.projectprototype':
+            # Origins are linked once every prototype is in; see link_origins().
+            self.origins[obj.pk] = obj.origin_id
+            obj.origin_id = None
+        self.pending.append(obj)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        model = type(self.pending[0])
+        started = time.time()
+        bulk_insert(model, self.pending)
+        label = str(model._meta.verbose_name_plural)
+        rows, elapsed = self.reports.get(label, (0, 0.0))
+        self.reports[label] = (rows + len(self.pending), elapsed + time.time() - started)
+        self.pending = []
+
+    def link_origins(self):
+        from .models import ProjectPrototype
+
+        present = set(ProjectPrototype.objects.filter(pk__in=set(self.origins.values())).values_list('pk', flat=True))
+        by_origin = {}
+        for pk, origin in self.origins.items():
+            if origin in present:
+                by_origin.setdefault(origin, []).append(pk)
+        for origin, pks in by_origin.items():
+            ProjectPrototype.objects.filter(pk__in=pks).update(origin=origin)
+
+
+def restore_backup(path, batch_size=500, origin_id=None):
+    """
+    Restore the backup at `path`. Returns [(label, rows, seconds)].
+    Raises ValueError for a file that is not a backup.
+    """
+    from discussions.models import Post
+    from .indexing import enqueue_prototypes
+    from .facets import invalidate_facet_counts
+    from .models import ProjectPrototype, PrototypeMetaElement, ProjectTask, ProjectImplementationInfo, \
+        ProjectComment, StoredBlob, ProjectFile, TaskFile, ImplementationFile
+    from .pagecache import bump_prototype_versions
+    from .storage import recount_blobs
+
+    if origin_id is not None and path == '-':
+        raise ValueError('A lineage restore reads the file twice and needs a path, not stdin.')
+    handle = open_backup(path, 'r')
+    try:
+        read_header(handle)
+    except ValueError:
+        handle.close()
+        raise
+
+    selection = scan_lineage(path, origin_id) if origin_id is not None else None
+    restorer = Restorer(batch_size, selection)
+    models = (ProjectPrototype, PrototypeMetaElement, ProjectTask, ProjectImplementationInfo, StoredBlob,
+              ProjectFile, TaskFile, ImplementationFile, Post, ProjectComment)
+
+    if origin_id is not None:
+        handle.close()
+        handle = open_backup(path, 'r')
+        handle.readline()
+    with transaction.atomic(), handle:
+        for line in handle:
+            for deserialized in serializers.deserialize('python', [json.loads(line)]):
+                if restorer.wants(deserialized.object):
+                    restorer.add(deserialized.object)
+        restorer.flush()
+        restorer.link_origins()
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+    recount_blobs()
+    invalidate_facet_counts()
+    if restorer.origins:
+        enqueue_prototypes(list(restorer.origins))
+        bump_prototype_versions(restorer.origins)
+    return [(label, rows, elapsed) for label, (rows, elapsed) in restorer.reports.items()]
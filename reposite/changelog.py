@@ -0,0 +1,319 @@
+# changelog.py
+"""
+Change capture and incremental snapshots for point-in-time recovery.
+
+Every insert, update and delete of the tracked models is appended to the ChangeRecord table:
+- Saves and deletes are recorded from the model signals.
+- Bulk writes and queryset updates (flips, metadata, 'modified' bumps) call record_rows() or
+  record_deletes() themselves.
+A record holds the model, the primary key, the action and, for inserts and updates, the row's
+fields in serializer shape.
+
+A snapshot directory holds two kinds of file:
+- base-<watermark>-<time>.jsonl.gz: a full backup (see reposite.backup). Its header records
+  the last change id it already contains.
+- changes-<first>-<last>.jsonl.gz: one segment of the log, a change record per line.
+The nightly job writes only a segment with the day's records, so its cost follows the number
+of edits, not the size of the repository.
+
+Restoring to a point in time picks the newest base taken before that time and restores it. It
+then replays the segments up to that time. Each segment is collapsed to the last action per
+row and applied in bulk: deletes children first, then inserts with bulk_create and updates
+parents first. Replay is idempotent, so records a base already contains can be applied again
+safely. Watermarks stay CHANGELOG_SETTLE_SECONDS behind the newest record. A transaction that is
+still open when a snapshot is cut is therefore not skipped.
+
+    CHANGELOG_SETTLE_SECONDS = 60
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core import serializers
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+
+from .backup import BackupEncoder, bulk_insert, open_backup, read_header, restore_backup, write_backup
+
+SEGMENT_FORMAT = 'pebbles-changes'
+
+# Replay order: a row's parents come before it.
+TRACKED_MODELS = (
+    'reposite.ProjectPrototype',
+    'reposite.PrototypeMetaElement',
+    'reposite.ProjectTask',
+    'reposite.ProjectImplementationInfo',
+    'reposite.StoredBlob',
+    'reposite.ProjectFile',
+    'reposite.TaskFile',
+    'reposite.ImplementationFile',
+    'discussions.Post',
+    'reposite.ProjectComment',
+)
+
+BASE_NAME = re.compile(r'^base-(\d+)-\w+\.jsonl\.gz$')
+SEGMENT_NAME = re.compile(r'^changes-(\d+)-(\d+)\.jsonl\.gz$')
+
+SnapshotReport = namedtuple('SnapshotReport', 'path rows elapsed')
+
+_capture = threading.local()
+
+
+@contextmanager
+def capture_paused():
+    """ Don't record changes made in this block on this thread (used while replaying). """
+    _capture.paused = True
+    try:
+        yield
+    finally:
+        _capture.paused = False
+
+
+def _fields(instance):
+    return json.dumps(serializers.serialize('python', [instance])[0]['fields'], cls=BackupEncoder)
+
+
+def capture_save(sender, instance, created, raw=False, **kwargs):
+    from .models import ChangeRecord
+
+    if raw or getattr(_capture, 'paused', False):
+        return
+    ChangeRecord.objects.create(
+        model=instance._meta.label_lower, object_id=instance.pk,
+        action=ChangeRecord.INSERT if created else ChangeRecord.UPDATE, data=_fields(instance))
+
+
+def capture_delete(sender, instance, **kwargs):
+    from .models import ChangeRecord
+
+    if getattr(_capture, 'paused', False):
+        return
+    ChangeRecord.objects.create(model=instance._meta.label_lower, object_id=instance.pk, action=ChangeRecord.DELETE)
+
+
+def record_rows(queryset):
+    """ Record the current state of every row in queryset; for writes that send no signals. """
+    from .models import ChangeRecord
+
+    if getattr(_capture, 'paused', False):
+        return
+    ChangeRecord.objects.bulk_create([
+        ChangeRecord(model=obj._meta.label_lower, object_id=obj.pk, action=ChangeRecord.UPDATE, data=_fields(obj))
+        for obj in queryset.iterator()])
+
+
+def record_deletes(model, pks):
+    """ Record deletes of the given rows; for deletes that send no signals. """
+    from .models import ChangeRecord
+
+    if getattr(_capture, 'paused', False):
+        return
+    ChangeRecord.objects.bulk_create([
+        ChangeRecord(model=model._meta.label_lower, object_id=pk, action=ChangeRecord.DELETE) for pk in pks])
+
+
+def settled_watermark():
+    """ Highest change id that is safe to cut a snapshot at. """
+    from .models import ChangeRecord
+
+    settle = getattr(settings, 'CHANGELOG_SETTLE_SECONDS', 60)
+    return ChangeRecord.objects.filter(
+        created__lte=now() - timedelta(seconds=settle)).aggregate(last=Max('id'))['last'] or 0
+
+
+def snapshot_files(directory):
+    """ ([(watermark, path)] of base snapshots, [(first, last, path)] of segments), both in order. """
+    bases, segments = [], []
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+        path = os.path.join(directory, name)
+        match = BASE_NAME.match(name)
+        if match:
+            bases.append((int(match.group(1)), path))
+        match = SEGMENT_NAME.match(name)
+        if match:
+            segments.append((int(match.group(1)), int(match.group(2)), path))
+    return sorted(bases), sorted(segments)
+
+
+def current_watermark(directory):
+    """ The last change id covered by the snapshots in directory, or None if it has no base. """
+    bases, segments = snapshot_files(directory)
+    if not bases:
+        return None
+    return max([bases[-1][0]] + [last for first, last, path in segments])
+
+
+def _write_atomically(path, write):
+    """ Call write(handle) on a temporary gzip file, renamed to path once write() returns. """
+    tmp_path = path + '.part.gz'
+    out = open_backup(tmp_path, 'w')
+    try:
+        with out:
+            result = write(out)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, path)
+    return result
+
+
+def write_base(directory, batch_size=500, progress=None):
+    """ Write a full base snapshot into directory. Returns a SnapshotReport. """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    started, watermark = time.time(), settled_watermark()
+    path = os.path.join(directory, 'base-%012d-%s.jsonl.gz' % (watermark, now().strftime('%Y%m%dT%H%M%S')))
+    reports = _write_atomically(path, lambda out: write_backup(
+        out, batch_size=batch_size, progress=progress, extra={'changes_through': watermark}))
+    return SnapshotReport(path, sum(r.rows for r in reports), time.time() - started)
+
+
+def write_segment(directory):
+    """
+    Write the change records since the last snapshot in directory as one segment. Returns a
+    SnapshotReport, or None when there is nothing new. Raises ValueError without a base.
+    """
+    from .models import ChangeRecord
+
+    first = current_watermark(directory)
+    if first is None:
+        raise ValueError('%s has no base snapshot.' % directory)
+    started, last = time.time(), settled_watermark()
+    if last <= first:
+        return None
+
+    def write(out):
+        header = {'format': SEGMENT_FORMAT, 'first': first + 1, 'last': last, 'created': now()}
+        out.write(json.dumps(header, cls=BackupEncoder) + '\n')
+        rows = 0
+        records = ChangeRecord.objects.filter(id__gt=first, id__lte=last).order_by('id')
+        for record in records.iterator():
+            # data is already JSON; splice it in rather than decoding and re-encoding it.
+            out.write('{"id": %d, "at": %s, "model": %s, "pk": %d, "action": %s, "fields": %s}\n' % (
+                record.id, json.dumps(record.created, cls=BackupEncoder), json.dumps(record.model),
+                record.object_id, json.dumps(record.action), record.data or 'null'))
+            rows += 1
+        return rows
+
+    path = os.path.join(directory, 'changes-%012d-%012d.jsonl.gz' % (first + 1, last))
+    rows = _write_atomically(path, write)
+    return SnapshotReport(path, rows, time.time() - started)
+
+
+def prune_changes(directory):
+    """ Delete change records already written to the snapshots in directory; returns the count. """
+    from .models import ChangeRecord
+
+    watermark = current_watermark(directory)
+    if not watermark:
+        return 0
+    return ChangeRecord.objects.filter(id__lte=watermark).delete()[0]
+
+
+def _apply(changes, batch_size):
+    """ Apply {label: {pk: (action, fields)}}; returns the number of rows touched. """
+    from .models import ChangeRecord
+
+    touched = 0
+    for label in reversed(TRACKED_MODELS):
+        model = apps.get_model(label)
+        deleted = [pk for pk, (action, fields) in changes.get(model._meta.label_lower, {}).items()
+                   if action == ChangeRecord.DELETE]
+        for start in range(0, len(deleted), batch_size):
+            model.objects.filter(pk__in=deleted[start:start + batch_size]).delete()
+        touched += len(deleted)
+
+    for label in TRACKED_MODELS:
+        model = apps.get_model(label)
+        rows = [{'model': model._meta.label_lower, 'pk': pk, 'fields': fields}
+                for pk, (action, fields) in changes.get(model._meta.label_lower, {}).items()
+                if action != ChangeRecord.DELETE]
+        for start in range(0, len(rows), batch_size):
+            objs = [d.object for d in serializers.deserialize('python', rows[start:start + batch_size])]
+            existing = set(model.objects.filter(pk__in=[o.pk for o in objs]).values_list('pk', flat=True))
+            bulk_insert(model, [o for o in objs if o.pk not in existing])
+            for obj in objs:
+                if obj.pk in existing:
+                    model.objects.filter(pk=obj.pk).update(**{
+                        f.attname: getattr(obj, f.attname) for f in model._meta.concrete_fields if not f.primary_key})
+        touched += len(rows)
+    return touched
+
+
+def replay_segment(path, after_id=0, until=None, batch_size=500):
+    """
+    Apply the records of a segment with id > after_id and time <= until.
+    Returns (records read, whether `until` was reached).
+    """
+    changes, read, reached = OrderedDict(), 0, False
+    with open_backup(path, 'r') as handle:
+        read_header(handle, SEGMENT_FORMAT)
+        for line in handle:
+            record = json.loads(line)
+            if record['id'] <= after_id:
+                continue
+            if until is not None and parse_datetime(record['at']) > until:
+                reached = True
+                break
+            # Later records for the same row replace earlier ones; only the final state is applied.
+            rows = changes.setdefault(record['model'], OrderedDict())
+            rows.pop(record['pk'], None)
+            rows[record['pk']] = (record['action'], record['fields'])
+            read += 1
+    _apply(changes, batch_size)
+    return read, reached
+
+
+def restore_to(directory, until=None, batch_size=500):
+    """
+    Restore the snapshots in directory into an empty database, as of `until` (an aware
+    datetime; None for the latest state). Returns [(label, rows, seconds)].
+    """
+    from discussions.models import Post
+    from .facets import invalidate_facet_counts
+    from .indexing import enqueue_rebuild
+    from .models import ProjectPrototype
+    from .pagecache import bump_prototype_versions
+    from .storage import recount_blobs
+
+    bases, segments = snapshot_files(directory)
+    for watermark, base_path in reversed(bases):
+        with open_backup(base_path, 'r') as handle:
+            created = parse_datetime(read_header(handle)['created'])
+        if until is None or created <= until:
+            break
+    else:
+        raise ValueError('No base snapshot in %s was taken before %s.' % (directory, until))
+
+    reports = restore_backup(base_path, batch_size)
+    started, replayed = time.time(), 0
+    with capture_paused(), transaction.atomic():
+        for first, last, path in segments:
+            if last <= watermark:
+                continue
+            read, reached = replay_segment(path, watermark, until, batch_size)
+            replayed += read
+            if reached:
+                break
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [apps.get_model(m) for m in TRACKED_MODELS]):
+                cursor.execute(sql)
+
+    Post.objects.filter(parent_post=None).refresh_reply_counters()
+    recount_blobs()
+    invalidate_facet_counts()
+    enqueue_rebuild()
+    bump_prototype_versions(ProjectPrototype.objects.values_list('pk', flat=True))
+    reports.append(('replayed changes', replayed, time.time() - started))
+    return reports
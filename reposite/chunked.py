@@ -0,0 +1,195 @@
+# chunked.py
+"""
+Resumable chunked uploads.
+
+A client declares the file (name, size and, optionally, sha256) and the project, task or
+implementation item it belongs to. It then sends the bytes in order, one chunk of at most
+UPLOAD_CHUNK_SIZE per request, each tagged with its offset. Chunks are copied from the request
+stream straight into a part file under MEDIA_ROOT/chunked/, in small buffers. Memory per upload
+stays constant however large the file is. After a dropped connection the client asks for the
+current offset and carries on from there. On completion the part file is checked against the
+declared size, and against the declared sha256 when the client sent one, then attached to its
+target as a file row. The part file is moved into blob storage only once that row is committed.
+The browser form (chunked_upload.js) declares no sha256: hashing a multi-gigabyte file in the
+page would mean reading all of it into memory first. Its uploads are checked by size and offset
+only; the digest computed here is what gets recorded.
+
+    UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+    UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+"""
+
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+
+from .storage import HASH_CHUNK_SIZE, blob_name, blob_storage
+
+CHUNKED_ROOT = 'chunked'
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def upload_setting(name, default):
+    return getattr(settings, 'UPLOAD_' + name, default)
+
+
+class UploadError(Exception):
+    """ The request can't be applied to the upload; the message is safe to show the client. """
+
+
+class OffsetMismatch(UploadError):
+    """ A chunk arrived for an offset other than the next expected byte. """
+
+    def __init__(self, expected):
+        super(OffsetMismatch, self).__init__('Expected a chunk at offset %d.' % expected)
+        self.expected = expected
+
+
+def part_path(upload):
+    return blob_storage.path(os.path.join(CHUNKED_ROOT, '%s.part' % upload.upload_id.hex))
+
+
+def resolve_target(target_type, target_id):
+    """ The ProjectPrototype, ProjectTask or ProjectImplementationInfo an upload attaches to. """
+    from .models import ProjectPrototype, ProjectTask, ProjectImplementationInfo
+
+    models = {'project': ProjectPrototype, 'task': ProjectTask, 'implementation': ProjectImplementationInfo}
+    try:
+        return models[target_type].objects.get(pk=target_id)
+    except (KeyError, ValueError, TypeError):
+        raise UploadError('Unknown upload target.')
+    except models[target_type].DoesNotExist:
+        raise UploadError('Upload target does not exist.')
+
+
+def start_upload(user, target_type, target_id, filename, size, sha256=''):
+    """ Validate the declaration, create the ChunkedUpload row and an empty part file. """
+    from .models import ChunkedUpload
+
+    resolve_target(target_type, target_id)
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Declared size must be an integer.')
+    if size <= 0 or size > upload_setting('MAX_SIZE', 2 * 1024 ** 3):
+        raise UploadError('Declared size is out of range.')
+    sha256 = (sha256 or '').lower()
+    if sha256 and (len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256)):
+        raise UploadError('Declared sha256 must be 64 hex digits.')
+    filename = os.path.basename(filename or '').strip()
+    if not filename:
+        raise UploadError('A file name is required.')
+
+    upload = ChunkedUpload.objects.create(
+        user=user, filename=filename[:255], size=size, sha256=sha256,
+        target_type=target_type, target_id=int(target_id))
+    path = part_path(upload)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream):
+    """
+    Write the chunk read from `stream` at `offset`, which must equal upload.received.
+    Returns the new offset.
+    """
+    from .models import ChunkedUpload
+
+    with transaction.atomic():
+        # The row stays locked while the chunk is copied, so a stale duplicate of an accepted chunk
+        # (a client retry racing the original request) is turned away before it touches the part file.
+        current = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        upload.status, upload.received = current.status, current.received
+        if upload.status != ChunkedUpload.OPEN:
+            raise UploadError('This upload is already complete.')
+        if offset != upload.received:
+            raise OffsetMismatch(upload.received)
+
+        limit = min(upload_setting('CHUNK_SIZE', 4 * 1024 * 1024), upload.size - offset)
+        written = 0
+        with open(part_path(upload), 'r+b') as part:
+            part.seek(offset)
+            part.truncate()
+            while True:
+                data = stream.read(min(COPY_BUFFER_SIZE, limit - written + 1))
+                if not data:
+                    break
+                written += len(data)
+                if written > limit:
+                    raise UploadError('Chunk is larger than %d bytes.' % limit)
+                part.write(data)
+        if not written:
+            raise UploadError('Empty chunk.')
+
+        ChunkedUpload.objects.filter(pk=upload.pk).update(received=offset + written, modified=now())
+    upload.received = offset + written
+    return upload.received
+
+
+def complete_upload(upload):
+    """ Verify the assembled part file, store it as a blob and attach it. Returns the new file row. """
+    from .models import ChunkedUpload, ProjectFile, TaskFile, ImplementationFile
+
+    if upload.status != ChunkedUpload.OPEN:
+        raise UploadError('This upload is already complete.')
+    path = part_path(upload)
+    if upload.received != upload.size or os.path.getsize(path) != upload.size:
+        raise UploadError('Received %d of %d bytes.' % (upload.received, upload.size))
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for block in iter(lambda: part.read(HASH_CHUNK_SIZE), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if upload.sha256 and digest != upload.sha256:
+        raise UploadError('Checksum mismatch: declared %s, received %s.' % (upload.sha256, digest))
+
+    target = resolve_target(upload.target_type, upload.target_id)
+    name = blob_name(digest, upload.filename)
+    with transaction.atomic():
+        if not ChunkedUpload.objects.filter(pk=upload.pk, status=ChunkedUpload.OPEN).update(
+                status=ChunkedUpload.COMPLETE, sha256=digest, modified=now()):
+            raise UploadError('This upload is already complete.')
+        # The row exists before the file row so its refcount is kept; the part file only moves on
+        # commit, so a rollback leaves the upload open with its bytes in place for a retry.
+        blob_storage.record(name, digest, upload.size)
+        transaction.on_commit(lambda: blob_storage.place(path, upload.filename, digest, upload.size))
+        if upload.target_type == 'project':
+            attached = ProjectFile.objects.create(file=name, project=target, user=upload.user, original_name=upload.filename)
+        elif upload.target_type == 'task':
+            attached = TaskFile.objects.create(file=name, task=target, user=upload.user, original_name=upload.filename)
+        else:
+            attached = ImplementationFile.objects.create(file=name, implementation=target, user=upload.user, original_name=upload.filename)
+    upload.status, upload.sha256 = ChunkedUpload.COMPLETE, digest
+    return attached
+
+
+def expire_uploads(older_than):
+    """ Drop open uploads untouched since `older_than` (a datetime) and their part files. """
+    from .models import ChunkedUpload
+
+    stale = ChunkedUpload.objects.filter(status=ChunkedUpload.OPEN, modified__lt=older_than)
+    count = 0
+    for upload in stale.iterator():
+        try:
+            os.remove(part_path(upload))
+        except OSError:
+            pass
+        count += 1
+    stale.delete()
+    return count
+
+
+def upload_state(upload):
+    """ What a client needs to resume: where to continue and how much to send at a time. """
+    return {
+        'upload_id': upload.upload_id.hex,
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': upload_setting('CHUNK_SIZE', 4 * 1024 * 1024),
+        'status': upload.status,
+    }
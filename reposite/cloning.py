@@ -0,0 +1,121 @@
+# cloning.py
+"""
+Bulk clone ("flip") engine for ProjectPrototype.
+
+A flip copies the prototype row, its metadata, tasks and implementation info items and,
+optionally, the file references attached to them. Each kind of row is written with a single
+bulk_create, and the whole flip runs inside one transaction so a failure leaves nothing behind.
+Uploaded files are shared by reference; nothing is copied on disk, the blobs' refcounts go up.
+"""
+
+import json
+import random
+import string
+import time
+from collections import OrderedDict, namedtuple
+
+from django.db import transaction
+
+from .changelog import record_rows
+from .storage import retain_blobs
+
+CloneReport = namedtuple('CloneReport', 'source clone rows elapsed')
+
+
+def _field_values(obj, exclude):
+    return {f.attname: getattr(obj, f.attname) for f in obj._meta.concrete_fields if f.name not in exclude}
+
+
+def _created(objs, queryset):
+    """
+    Returns the saved copies of objs in insertion order. bulk_create only sets primary keys on
+    backends that support RETURNING (PostgreSQL); elsewhere re-read the rows just inserted.
+    """
+    if all(o.pk is not None for o in objs):
+        return objs
+    return list(queryset.order_by('id'))
+
+
+def clone_title(prototype, user):
+    rstr = ''.join(
+        random.choice(string.ascii_lowercase + string.digits) for x in range(4))
+    return prototype.title + '-' + user.last_name + '-' + rstr
+
+
+def clone_prototype(prototype, user, include_files=False, title=None):
+    """ Flip prototype for user. Returns a CloneReport(source, clone, rows, elapsed). """
+    from .models import (
+        ProjectPrototype, PrototypeMetaElement, ProjectTask, ProjectImplementationInfo,
+        ProjectFile, TaskFile, ImplementationFile)
+
+    started = time.time()
+    rows = OrderedDict()
+
+    with transaction.atomic():
+        metadata = list(prototype.data.all())
+        tasks = prototype.tasks.order_by('id')
+        info_items = prototype.implementation_info.order_by('id')
+        if include_files:
+            tasks = tasks.prefetch_related('task_files')
+            info_items = info_items.prefetch_related('implementation_files')
+        tasks, info_items = list(tasks), list(info_items)
+
+        # Copy object attributes. The metadata snapshot is carried over as-is since the
+        # metadata rows below are exact copies.
+        clone = ProjectPrototype(
+            title=title or clone_title(prototype, user), creator=user, origin=prototype,
+            description=prototype.description, publisher=prototype.publisher, rights=prototype.rights,
+            metadata_snapshot=json.dumps(prototype.metadata), metadata_version=1)
+        clone.save()
+        rows['prototypes'] = 1
+
+        # Copy object metadata
+        PrototypeMetaElement.objects.bulk_create([
+            PrototypeMetaElement(
+                prototype_project=clone, element_type=i.element_type,
+                element_data=i.element_data, element_category=i.element_category)
+            for i in metadata])
+        rows['metadata'] = len(metadata)
+
+        # Copy object tasks
+        new_tasks = ProjectTask.objects.bulk_create([
+            ProjectTask(prototype_project=clone, **_field_values(i, ('id', 'prototype_project')))
+            for i in tasks])
+        rows['tasks'] = len(new_tasks)
+
+        # Copy implementation information items
+        new_info_items = ProjectImplementationInfo.objects.bulk_create([
+            ProjectImplementationInfo(prototype_project=clone, **_field_values(i, ('id', 'prototype_project')))
+            for i in info_items])
+        rows['implementation_info'] = len(new_info_items)
+
+        if include_files:
+            project_files = ProjectFile.objects.bulk_create([
+                ProjectFile(file=f.file.name, project=clone, user=user, original_name=f.original_name)
+                for f in prototype.project_files.all()])
+            rows['project_files'] = len(project_files)
+
+            new_tasks = _created(new_tasks, clone.tasks.all()) if tasks else []
+            task_files = TaskFile.objects.bulk_create([
+                TaskFile(file=f.file.name, task=new_t, user=user, original_name=f.original_name)
+                for old_t, new_t in zip(tasks, new_tasks) for f in old_t.task_files.all()])
+            rows['task_files'] = len(task_files)
+
+            new_info_items = _created(new_info_items, clone.implementation_info.all()) if info_items else []
+            info_files = ImplementationFile.objects.bulk_create([
+                ImplementationFile(file=f.file.name, implementation=new_i, user=user, original_name=f.original_name)
+                for old_i, new_i in zip(info_items, new_info_items) for f in old_i.implementation_files.all()])
+            rows['implementation_files'] = len(info_files)
+
+            # bulk_create sends no signals, so count the shared blob references here.
+            retain_blobs([f.file.name for f in project_files + task_files + info_files])
+
+        # The change log is not told about bulk-created rows either.
+        for copied in (clone.data.all(), clone.tasks.all(), clone.implementation_info.all()):
+            record_rows(copied)
+        if include_files:
+            for copied in (clone.project_files.all(), TaskFile.objects.filter(task__prototype_project=clone),
+                           ImplementationFile.objects.filter(implementation__prototype_project=clone)):
+                record_rows(copied)
+
+    return CloneReport(source=prototype, clone=clone, rows=rows, elapsed=time.time() - started)
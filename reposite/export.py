@@ -0,0 +1,179 @@
+# export.py
+"""
+Downloadable ZIP bundle of a prototype: index.html (the document view content), manifest.json
+and every project, task and implementation file.
+
+The archive is produced as a generator. Each piece zipfile writes is handed to the response as
+soon as it exists, and attached files are copied through in small blocks, so a bundle is never
+held in memory. The same bytes are teed into a cache file that is renamed into place only when
+the archive is complete. The cache key includes the prototype's `modified` timestamp, which
+every task, implementation item and file change bumps, so an unchanged prototype is served
+straight from disk.
+
+    EXPORT_CACHE_DIR = '/var/cache/pebbles/exports'    # default: MEDIA_ROOT/exports
+"""
+
+import glob
+import json
+import os
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template.loader import render_to_string
+from django.utils.crypto import salted_hmac
+from django.utils.text import slugify
+
+from .storage import blob_storage
+
+COPY_BUFFER_SIZE = 64 * 1024
+BUNDLE_LAYOUT = 2  # part of the cache key; bump when entry names or contents change
+
+
+def cache_dir():
+    return getattr(settings, 'EXPORT_CACHE_DIR', None) or blob_storage.path('exports')
+
+
+def cache_path(prototype):
+    """ Cached bundle location for this version of the prototype; the name is not guessable. """
+    version = salted_hmac('reposite.export', '%s:%s:%s' % (
+        BUNDLE_LAYOUT, prototype.pk, prototype.modified.isoformat())).hexdigest()
+    return os.path.join(cache_dir(), '%d-%s.zip' % (prototype.pk, version[:32]))
+
+
+def bundle_filename(prototype):
+    return '%s.zip' % (slugify(prototype.title) or 'prototype-%d' % prototype.pk)
+
+
+def bundle_entries(prototype):
+    """
+    (archive name, storage name) for every attached file, grouped the way the document view
+    lists them. Files are named as they were uploaded; a name already taken in its folder gets
+    a " (2)", " (3)", ... suffix. Expects a prototype loaded with profile('document').
+    """
+    entries, taken = [], set()
+
+    def add(folder, file_row):
+        name = file_row.file.name
+        if not name:
+            return
+        base, ext = os.path.splitext(os.path.basename(file_row.display_name.replace('\\', '/')) or 'file')
+        arcname, n = '%s/%s%s' % (folder, base, ext), 1
+        while arcname in taken:
+            n += 1
+            arcname = '%s/%s (%d)%s' % (folder, base, n, ext)
+        taken.add(arcname)
+        entries.append((arcname, name))
+
+    for f in prototype.project_files.all():
+        add('files', f)
+    for n, task in enumerate(prototype.tasks.all(), 1):
+        for f in task.task_files.all():
+            add('tasks/%02d-%s' % (n, slugify(task.title)), f)
+    for n, info in enumerate(prototype.implementation_info.all(), 1):
+        for f in info.implementation_files.all():
+            add('implementation/%02d-%s' % (n, slugify(info.title)), f)
+    return entries
+
+
+def bundle_manifest(prototype, entries):
+    files = []
+    for arcname, name in entries:
+        exists = blob_storage.exists(name)
+        files.append({'path': arcname, 'size': blob_storage.size(name) if exists else None, 'missing': not exists})
+    return {
+        'id': prototype.pk,
+        'title': prototype.title,
+        'creator': prototype.creator.get_full_name() or prototype.creator.username,
+        'origin': prototype.origin_id,
+        'modified': prototype.modified,
+        'description': prototype.description,
+        'driving_question': prototype.driving_question,
+        'metadata': prototype.get_data(),
+        'tasks': [{
+            'title': t.title,
+            'category': t.get_task_category_display(),
+            'short_description': t.short_description,
+            'description': t.description,
+        } for t in prototype.tasks.all()],
+        'implementation_info': [{'title': i.title, 'description': i.description} for i in prototype.implementation_info.all()],
+        'files': files,
+    }
+
+
+class _ArchiveSink(object):
+    """ Write-only target for zipfile; collects output until the generator hands it on. """
+
+    def __init__(self, tee=None):
+        self.chunks = []
+        self.tee = tee
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        if self.tee is not None:
+            self.tee.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_bundle(prototype, cache_to=None):
+    """ Yield the ZIP bundle piece by piece, optionally filling the cache file cache_to as it goes. """
+    entries = bundle_entries(prototype)
+    manifest = bundle_manifest(prototype, entries)
+    date_time = prototype.modified.timetuple()[:6]
+
+    tee = tmp_path = None
+    if cache_to:
+        if not os.path.isdir(os.path.dirname(cache_to)):
+            os.makedirs(os.path.dirname(cache_to))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_to), suffix='.part')
+        tee = os.fdopen(fd, 'wb')
+
+    sink = _ArchiveSink(tee)
+    complete = False
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for arcname, content in (
+                    ('index.html', render_to_string('prototype_export.html', {'project_prototype': prototype, 'manifest': manifest})),
+                    ('manifest.json', json.dumps(manifest, cls=DjangoJSONEncoder, indent=2))):
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, content)
+                yield sink.drain()
+
+            for (arcname, name), meta in zip(entries, manifest['files']):
+                if meta['missing']:
+                    continue
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.compress_type = zipfile.ZIP_STORED  # uploads are mostly media and documents that are already compressed
+                info.file_size = meta['size']
+                with blob_storage.open(name, 'rb') as src, archive.open(info, 'w', force_zip64=meta['size'] >= zipfile.ZIP64_LIMIT) as dst:
+                    for block in iter(lambda: src.read(COPY_BUFFER_SIZE), b''):
+                        dst.write(block)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                yield sink.drain()
+        yield sink.drain()
+        complete = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if complete:
+                for stale in glob.glob(os.path.join(os.path.dirname(cache_to), '%d-*.zip' % prototype.pk)):
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+                os.rename(tmp_path, cache_to)
+            else:
+                os.remove(tmp_path)
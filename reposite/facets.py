@@ -0,0 +1,52 @@
+# facets.py
+"""
+Facet counts over prototype metadata (language, subject, ACTFL/ILR levels, world readiness, ...).
+
+The histogram is computed with a single GROUP BY over PrototypeMetaElement and kept in the
+tiered cache (core.cache) under the "facets" tag until metadata is written again (see
+ProjectPrototype.rebuild_metadata_snapshot).
+"""
+
+from collections import OrderedDict
+
+from django.db.models import Count
+
+from core.cache import tiered_cache
+
+from .schema import METADATA_TYPES
+
+FACET_CACHE_KEY = 'reposite:facets:%s'
+FACET_CACHE_TIMEOUT = None  # cached until invalidated
+FACET_CACHE_TAG = 'facets'
+
+
+def _cache_key(active_only):
+    return FACET_CACHE_KEY % ('active' if active_only else 'all')
+
+
+def compute_facet_counts(active_only=True):
+    """ Returns an OrderedDict keyed by element_type (in schema order) of OrderedDict(element_data -> count). """
+    from .models import PrototypeMetaElement
+
+    facets = OrderedDict((element_type, OrderedDict()) for element_type, _ in METADATA_TYPES)
+
+    rows = PrototypeMetaElement.objects.all()
+    if active_only:
+        rows = rows.filter(prototype_project__active=True)
+    rows = rows.values_list('element_type', 'element_data').annotate(
+        count=Count('id')).order_by('element_type', 'element_data')
+
+    for element_type, element_data, count in rows:
+        facets.setdefault(element_type, OrderedDict())[element_data] = count
+    return facets
+
+
+def get_facet_counts(active_only=True):
+    """ Cached facet counts. Pass active_only=False to include unpublished prototypes (staff listings). """
+    return tiered_cache.get_or_compute(
+        _cache_key(active_only), lambda: compute_facet_counts(active_only),
+        timeout=FACET_CACHE_TIMEOUT, tags=(FACET_CACHE_TAG,))
+
+
+def invalidate_facet_counts():
+    tiered_cache.invalidate_tags([FACET_CACHE_TAG])
@@ -5,10 +5,12 @@ from datetime import datetime
 from django import forms
 from django.forms import ClearableFileInput
 
+from haystack.forms import FacetedSearchForm
+
 # from filebrowser.widgets import ClearableFileInput
 
-from .models import ProjectPrototype, PrototypeMetaElement, ProjectTask, ProjectImplementationInfo, ProjectFile, TaskFile, ImplementationFile
-from .schema import PrototypeMetadataForm
+from .models import ProjectPrototype, ProjectTask, ProjectImplementationInfo, ProjectFile, TaskFile, ImplementationFile
+from .schema import METADATA_SCHEMA
 
 
 class ProjectPrototypeForm(forms.ModelForm):
@@ -27,9 +29,7 @@ class ProjectPrototypeForm(forms.ModelForm):
         # E.g, self.fields['description'].label = 'Description'
 
         # Now set up the fields derived from the schema. 
-        metadata_form = PrototypeMetadataForm()
-        for i, j in metadata_form.fields.items():
-            self.fields[i] = j
+        self.fields.update(METADATA_SCHEMA.form_fields())
         
         # Assign the subject area field to the 'basic' group
         self.fields['subject'].label = 'Basic Properties'
@@ -37,6 +37,17 @@ class ProjectPrototypeForm(forms.ModelForm):
         # Specify the display order of the fields
         self.order_fields(['title', 'description', 'driving_question', 'subject', 'active', 'icon', 'creator', 'origin', 'publisher', 'publish_date', 'contributors'])
 
+    def metadata_elements(self):
+        """ (element_type, element_data) pairs from form data, skipping fields listed in self.Meta.fields (base fields) """
+        elements = []
+        for i, j in self.cleaned_data.items():
+            if i not in self.Meta.fields and j:
+                if type(j) == list:
+                    elements.extend((i, k) for k in j)
+                else:
+                    elements.append((i, j))
+        return elements
+
 
     class Meta:
         model = ProjectPrototype
@@ -99,18 +110,7 @@ class ProjectPrototypeCreateForm(ProjectPrototypeForm):
             self.instance.publish_date = None
 
 
-        """ Create metadata objects from form data skipping fields listed in self.Meta.fields (base fields) """
-        for i, j in self.cleaned_data.items():
-            if i not in self.Meta.fields and j:
-                if type(j) == list:
-                    for k in j:
-                        pm = PrototypeMetaElement(
-                            prototype_project=self.instance, element_type=i, element_data=k)
-                        pm.save()
-                else:
-                    pm = PrototypeMetaElement(
-                        prototype_project=self.instance, element_type=i, element_data=j)
-                    pm.save()
+        self.instance.set_metadata(self.metadata_elements())
         return self.instance
 
 
@@ -126,25 +126,7 @@ class ProjectPrototypeUpdateForm(ProjectPrototypeForm):
         # if self.changed_data: self.instance.modified = datetime.now()
         super(ProjectPrototypeUpdateForm, self).save()
 
-        prev_metadata = self.instance.data.all()
-
-        """ Clear all previously assigned metadata objects """
-        for i in prev_metadata:
-            i.delete()
-   
-        """ Reassign metadata objects from form data skipping fields listed in self.Meta.fields (base fields) """
-        for i, j in self.cleaned_data.items():
-
-            if i not in self.Meta.fields and j:
-                if type(j) == list:
-                    for k in j:
-                        pm = PrototypeMetaElement(
-                            prototype_project=self.instance, element_type=i, element_data=k)
-                        pm.save()
-                else:
-                    pm = PrototypeMetaElement(
-                        prototype_project=self.instance, element_type=i, element_data=j)
-                    pm.save()
+        self.instance.set_metadata(self.metadata_elements())
 
         return self.instance
 
@@ -239,3 +221,25 @@ class ImplementationFileUploadForm(forms.ModelForm):
         fields = ('file', 'implementation', 'user')
         widgets = {'user': forms.HiddenInput(), 'implementation': forms.HiddenInput(),'file': ClearableFileInput()}
 
+
+
+class PrototypeSearchForm(FacetedSearchForm):
+    """ Faceted search form. Selecting a facet without a query term browses all prototypes in that facet. """
+
+    def no_query_found(self):
+        if self.selected_facets:
+            return self.searchqueryset.all()
+        return super(PrototypeSearchForm, self).no_query_found()
+
+    def search(self):
+        if not self.is_valid() or self.cleaned_data.get('q'):
+            return super(PrototypeSearchForm, self).search()
+
+        sqs = self.no_query_found()
+        for facet in self.selected_facets:
+            if ":" not in facet:
+                continue
+            field, value = facet.split(":", 1)
+            if value:
+                sqs = sqs.narrow(u'%s:"%s"' % (field, sqs.query.clean(value)))
+        return sqs
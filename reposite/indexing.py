@@ -0,0 +1,173 @@
+# indexing.py
+"""
+Incremental search indexing.
+
+Saves and deletes of ProjectPrototype, PrototypeMetaElement and ProjectTask put the affected
+prototype id on a durable queue (the IndexQueueEntry table) instead of touching the search
+backend inside the request. The process_index_queue management command drains the queue in
+batches. Ids are debounced: a prototype is only reindexed once it has been quiet for
+`debounce` seconds, and repeated edits collapse into a single update.
+
+To hook the model signals up, point haystack at the queued processor in settings:
+
+    HAYSTACK_SIGNAL_PROCESSOR = 'reposite.indexing.QueuedSignalProcessor'
+
+Metadata written through ProjectPrototype.set_metadata (bulk_create, no signals) is queued
+explicitly from rebuild_metadata_snapshot.
+"""
+
+from datetime import timedelta
+
+from django.core import management
+from django.db import transaction
+from django.db.models import Max, Min
+from django.db.models import signals
+from django.utils import timezone
+
+from haystack import connections
+from haystack.query import SearchQuerySet
+from haystack.signals import BaseSignalProcessor
+
+INDEX_DEBOUNCE_SECONDS = 5
+INDEX_BATCH_SIZE = 100
+
+
+def enqueue_prototypes(prototype_ids):
+    from .models import IndexQueueEntry
+
+    IndexQueueEntry.objects.bulk_create([
+        IndexQueueEntry(prototype_id=pk, action=IndexQueueEntry.UPDATE) for pk in set(prototype_ids) if pk])
+
+
+def enqueue_rebuild():
+    from .models import IndexQueueEntry
+
+    IndexQueueEntry.objects.create(action=IndexQueueEntry.REBUILD)
+
+
+def queue_status():
+    from .models import IndexQueueEntry
+
+    pending = IndexQueueEntry.objects.aggregate(oldest=Min('created'), newest=Max('created'))
+    return {
+        'pending_entries': IndexQueueEntry.objects.count(),
+        'pending_prototypes': IndexQueueEntry.objects.exclude(prototype_id=None).values('prototype_id').distinct().count(),
+        'rebuild_pending': IndexQueueEntry.objects.filter(action=IndexQueueEntry.REBUILD).exists(),
+        'oldest': pending['oldest'],
+        'newest': pending['newest'],
+    }
+
+
+def _prototype_id(sender, instance):
+    from .models import ProjectPrototype
+
+    if sender is ProjectPrototype:
+        return instance.pk
+    return instance.prototype_project_id
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """ Haystack signal processor that only records which prototypes need reindexing. """
+
+    def senders(self):
+        from .models import ProjectPrototype, PrototypeMetaElement, ProjectTask
+
+        return (ProjectPrototype, PrototypeMetaElement, ProjectTask)
+
+    def setup(self):
+        for sender in self.senders():
+            signals.post_save.connect(self.handle_save, sender=sender)
+            signals.post_delete.connect(self.handle_delete, sender=sender)
+
+    def teardown(self):
+        for sender in self.senders():
+            signals.post_save.disconnect(self.handle_save, sender=sender)
+            signals.post_delete.disconnect(self.handle_delete, sender=sender)
+
+    def handle_save(self, sender, instance, **kwargs):
+        enqueue_prototypes([_prototype_id(sender, instance)])
+
+    def handle_delete(self, sender, instance, **kwargs):
+        enqueue_prototypes([_prototype_id(sender, instance)])
+
+
+def process_index_queue(batch_size=INDEX_BATCH_SIZE, debounce=INDEX_DEBOUNCE_SECONDS, using='default'):
+    """
+    Reindex one batch of queued prototypes. Returns (updated, removed, rebuilt) where rebuilt is
+    True if a queued full rebuild was run instead.
+    """
+    from .models import IndexQueueEntry, ProjectPrototype
+
+    cutoff = timezone.now() - timedelta(seconds=debounce)
+
+    rebuild = IndexQueueEntry.objects.filter(action=IndexQueueEntry.REBUILD).aggregate(last=Max('id'))['last']
+    if rebuild:
+        # A full rebuild supersedes everything queued before it.
+        management.call_command('update_index', using=[using], remove=True, verbosity=0)
+        IndexQueueEntry.objects.filter(id__lte=rebuild).delete()
+        return 0, 0, True
+
+    ready = list(
+        IndexQueueEntry.objects.exclude(prototype_id=None).values('prototype_id')
+        .annotate(last=Max('created'), last_id=Max('id')).filter(last__lte=cutoff)
+        .order_by('last')[:batch_size])
+    if not ready:
+        return 0, 0, False
+
+    index = connections[using].get_unified_index().get_index(ProjectPrototype)
+    backend = connections[using].get_backend()
+    ids = [i['prototype_id'] for i in ready]
+
+    objects = list(index.index_queryset(using=using).filter(pk__in=ids))
+    if objects:
+        backend.update(index, objects)
+
+    indexed = set(o.pk for o in objects)
+    removed = [pk for pk in ids if pk not in indexed]
+    for pk in removed:
+        backend.remove('%s.%s' % (ProjectPrototype._meta.label_lower, pk))
+
+    with transaction.atomic():
+        for i in ready:
+            # Entries queued while we were indexing stay behind for the next pass.
+            IndexQueueEntry.objects.filter(prototype_id=i['prototype_id'], id__lte=i['last_id']).delete()
+
+    return len(objects), len(removed), False
+
+
+def indexed_ids(model, using='default', batch_size=INDEX_BATCH_SIZE):
+    """
+    Primary keys of the documents indexed for model. Every backend stores the key as django_id and
+    hands it back as SearchResult.pk; values_list() only sees fields it knows about, which
+    varies by backend and version, so read whole results instead.
+    """
+    documents = SearchQuerySet(using=using).models(model)
+    ids = set()
+    for start in range(0, documents.count(), batch_size):
+        ids.update(int(result.pk) for result in documents[start:start + batch_size])
+    return ids
+
+
+def reconcile_index(using='default', batch_size=INDEX_BATCH_SIZE):
+    """
+    Bring the index in line with index_queryset without a full rebuild: documents for prototypes
+    that were deleted or unpublished are removed, and published prototypes missing from the index
+    are added. Returns (added, removed).
+    """
+    from .models import ProjectPrototype
+
+    index = connections[using].get_unified_index().get_index(ProjectPrototype)
+    backend = connections[using].get_backend()
+
+    indexed = indexed_ids(ProjectPrototype, using, batch_size)
+    live = set(index.index_queryset(using=using).values_list('pk', flat=True))
+
+    stale = sorted(indexed - live)
+    for pk in stale:
+        backend.remove('%s.%s' % (ProjectPrototype._meta.label_lower, pk))
+
+    missing = sorted(live - indexed)
+    for start in range(0, len(missing), batch_size):
+        backend.update(index, index.index_queryset(using=using).filter(pk__in=missing[start:start + batch_size]))
+
+    return len(missing), len(stale)
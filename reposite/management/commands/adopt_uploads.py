@@ -0,0 +1,26 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from reposite.models import ProjectFile, TaskFile, ImplementationFile
+from reposite.storage import adopt_file, blob_storage, digest_from_name, recount_blobs
+
+
+class Command(BaseCommand):
+    help = 'Move file rows that still point at the flat uploads directory onto content-addressed blobs.'
+
+    def handle(self, *args, **options):
+        moved = missing = 0
+        for model in (ProjectFile, TaskFile, ImplementationFile):
+            names = model.objects.order_by().values_list('file', flat=True).distinct()
+            for name in [n for n in names if n and not digest_from_name(n)]:
+                if not blob_storage.exists(name):
+                    missing += 1
+                    self.stderr.write('%s: file not found' % name)
+                    continue
+                with transaction.atomic():
+                    model.objects.filter(file=name, original_name='').update(original_name=os.path.basename(name))
+                    moved += model.objects.filter(file=name).update(file=adopt_file(blob_storage, name))
+        self.stdout.write('Moved %d file reference(s) onto blobs, %d missing.' % (moved, missing))
+        recount_blobs()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from reposite.backup import open_backup, write_backup
+
+
+class Command(BaseCommand):
+    help = 'Stream prototypes, their files and discussions into a JSON-lines backup.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help='Backup file; .gz is compressed, - is stdout (default).')
+        parser.add_argument('--origin', type=int, help='Only this prototype and its flips, recursively.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows serialized per batch (default 500).')
+
+    def handle(self, *args, **options):
+        # With the backup on stdout the summary goes to stderr.
+        report_to = self.stderr if options['output'] == '-' else self.stdout
+
+        def progress(section):
+            rate = section.rows / section.elapsed if section.elapsed else 0
+            report_to.write('%-28s %8d row(s) %10.0f rows/s' % (section.label, section.rows, rate))
+
+        out = open_backup(options['output'], 'w')
+        try:
+            reports = write_backup(out, options['origin'], options['batch_size'], progress)
+        finally:
+            if options['output'] != '-':
+                out.close()
+        report_to.write('Backed up %d row(s).' % sum(r.rows for r in reports))
@@ -0,0 +1,55 @@
+import copy
+import time
+
+from django import forms
+from django.core.management.base import BaseCommand
+from django.utils.datastructures import MultiValueDict
+
+from reposite.schema import LANGUAGES_NISO, METADATA_SCHEMA, SUBJECT_AREAS
+
+
+def timed(function, runs):
+    started = time.perf_counter()
+    for i in range(runs):
+        function()
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = ('Time the vocabulary metadata fields against plain Django choice fields on large payloads: '
+            'cleaning, copying per form instance, and validating records in bulk.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20, help='Cleans of the large payload (default 20).')
+        parser.add_argument('--copies', type=int, default=200, help='Field copies (default 200).')
+        parser.add_argument('--records', type=int, default=2000, help='Records validated in bulk (default 2000).')
+
+    def handle(self, *args, **options):
+        plain = forms.MultipleChoiceField(choices=LANGUAGES_NISO, required=False)
+        vocabulary = METADATA_SCHEMA.form_class.base_fields['language']
+        # Every language four times over; the plain field only accepts exact spellings.
+        payload = [v for v, label in LANGUAGES_NISO] * 4
+
+        record = {'subject': [v for v, label in SUBJECT_AREAS[:3]], 'language': ['Arabic', 'French'],
+                  'ic_heritage_learners': 'yes', 'ic_product_description': 'A newscast.'}
+        records = [record] * options['records']
+
+        def with_forms():
+            for r in records:
+                METADATA_SCHEMA.form_class(data=MultiValueDict(
+                    dict((k, v if isinstance(v, list) else [v]) for k, v in r.items()))).is_valid()
+
+        rows = (
+            ('clean %d values x%d' % (len(payload), options['runs']),
+             timed(lambda: plain.clean(payload), options['runs']),
+             timed(lambda: vocabulary.clean(payload), options['runs'])),
+            ('copy language field x%d' % options['copies'],
+             timed(lambda: copy.deepcopy(plain), options['copies']),
+             timed(lambda: copy.deepcopy(vocabulary), options['copies'])),
+            ('validate %d records' % options['records'],
+             timed(with_forms, 1),
+             timed(lambda: METADATA_SCHEMA.clean_records(records), 1)),
+        )
+        self.stdout.write('%-32s %10s %10s %8s' % ('', 'old', 'new', 'speedup'))
+        for label, old, new in rows:
+            self.stdout.write('%-32s %9.3fs %9.3fs %7.1fx' % (label, old, new, old / new if new else float('inf')))
@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from reposite.cloning import clone_prototype
+from reposite.models import ProjectPrototype
+
+
+class Command(BaseCommand):
+    help = 'Flip (clone) one or more prototypes for a user in batch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('prototype_ids', nargs='+', type=int)
+        parser.add_argument('--user', required=True, help='Username that will own the flips.')
+        parser.add_argument('--copies', type=int, default=1, help='Number of flips per prototype.')
+        parser.add_argument('--files', action='store_true', help='Also attach the source file references.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('No such user: %s' % options['user'])
+
+        prototypes = ProjectPrototype.objects.in_bulk(options['prototype_ids'])
+        missing = set(options['prototype_ids']) - set(prototypes)
+        if missing:
+            raise CommandError('No such prototype(s): %s' % ', '.join(str(i) for i in sorted(missing)))
+
+        total_rows, total_time = 0, 0.0
+        for pk in options['prototype_ids']:
+            for n in range(options['copies']):
+                report = clone_prototype(prototypes[pk], user, include_files=options['files'])
+                rows = sum(report.rows.values())
+                total_rows += rows
+                total_time += report.elapsed
+                self.stdout.write('%s -> %s (id %d): %d rows in %.3fs' % (
+                    report.source.title, report.clone.title, report.clone.pk, rows, report.elapsed))
+
+        self.stdout.write('Copied %d rows in %.3fs.' % (total_rows, total_time))
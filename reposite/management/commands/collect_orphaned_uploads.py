@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from reposite.chunked import expire_uploads
+from reposite.uploadgc import collect_orphans
+
+
+class Command(BaseCommand):
+    help = 'Delete upload files that no file row, prototype icon or rich-text link references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report orphans without deleting them.')
+        parser.add_argument('--grace-hours', type=float, default=24, help='Leave files younger than this alone (default 24).')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files per deletion batch (default 500).')
+        parser.add_argument('--expire-days', type=float, default=7, help='Drop unfinished chunked uploads idle this long (default 7).')
+        parser.add_argument('--workers', type=int, default=4, help='Deletion batches run concurrently (default 4).')
+
+    def handle(self, *args, **options):
+        log = None
+        if options['verbosity'] > 1:
+            log = lambda stored: self.stdout.write('%s (%d bytes)' % (stored.name, stored.size))
+
+        if not options['dry_run']:
+            expired = expire_uploads(now() - timedelta(days=options['expire_days']))
+            self.stdout.write('Expired %d unfinished chunked upload(s).' % expired)
+
+        report = collect_orphans(
+            grace=options['grace_hours'] * 3600, dry_run=options['dry_run'],
+            batch_size=options['batch_size'], workers=options['workers'], log=log)
+
+        if options['dry_run']:
+            self.stdout.write('%d orphaned file(s), %d bytes reclaimable; %d within the grace period.' % (
+                report.orphans, report.bytes, report.skipped))
+        else:
+            self.stdout.write('Deleted %d of %d orphaned file(s), reclaimed %d bytes; %d within the grace period.' % (
+                report.deleted, report.orphans, report.bytes, report.skipped))
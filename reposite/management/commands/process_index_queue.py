@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from reposite.indexing import process_index_queue, reconcile_index, INDEX_BATCH_SIZE, INDEX_DEBOUNCE_SECONDS
+
+
+class Command(BaseCommand):
+    help = 'Drain the incremental search index queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=INDEX_BATCH_SIZE)
+        parser.add_argument('--debounce', type=int, default=INDEX_DEBOUNCE_SECONDS,
+                            help='Seconds a prototype must be left alone before it is reindexed.')
+        parser.add_argument('--using', default='default', help='Haystack connection to update.')
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling the queue.')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds between polls when the queue is idle.')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Remove stale documents and add missing ones instead of draining the queue (nightly).')
+
+    def handle(self, *args, **options):
+        if options['reconcile']:
+            added, removed = reconcile_index(using=options['using'], batch_size=options['batch_size'])
+            self.stdout.write('Reconciled the search index: added %d, removed %d prototype(s).' % (added, removed))
+            return
+
+        while True:
+            updated, removed, rebuilt = process_index_queue(
+                batch_size=options['batch_size'], debounce=options['debounce'], using=options['using'])
+
+            if rebuilt:
+                self.stdout.write('Rebuilt the search index.')
+            elif updated or removed:
+                self.stdout.write('Indexed %d, removed %d prototype(s).' % (updated, removed))
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
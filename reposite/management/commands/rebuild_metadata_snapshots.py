@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from reposite.models import ProjectPrototype
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the denormalized metadata snapshot stored on each ProjectPrototype. '
+            'Run with --missing after upgrading to backfill prototypes that predate it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', action='store_true', help='Only rebuild prototypes without a snapshot.')
+
+    def handle(self, *args, **options):
+        prototypes = ProjectPrototype.objects.all()
+        if options['missing']:
+            prototypes = prototypes.filter(metadata_snapshot__isnull=True)
+
+        count = 0
+        for prototype in prototypes.iterator():
+            prototype.rebuild_metadata_snapshot(touch=False)
+            count += 1
+
+        self.stdout.write('Rebuilt metadata snapshots for %d prototype(s).' % count)
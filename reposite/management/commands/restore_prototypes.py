@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reposite.backup import restore_backup
+
+
+class Command(BaseCommand):
+    help = 'Restore a backup written by backup_prototypes, in bulk and in one transaction.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Backup file; .gz is read compressed, - is stdin.')
+        parser.add_argument('--origin', type=int, help='Only restore this prototype and its flips, recursively.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk insert (default 500).')
+
+    def handle(self, *args, **options):
+        try:
+            reports = restore_backup(options['input'], options['batch_size'], options['origin'])
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for label, rows, elapsed in reports:
+            rate = rows / elapsed if elapsed else 0
+            self.stdout.write('%-28s %8d row(s) %10.0f rows/s' % (label, rows, rate))
+        self.stdout.write('Restored %d row(s).' % sum(rows for label, rows, elapsed in reports))
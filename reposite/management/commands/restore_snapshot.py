@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from reposite.changelog import restore_to
+
+
+class Command(BaseCommand):
+    help = 'Restore a snapshot directory into an empty database, optionally as of a point in time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Snapshot directory written by snapshot_changes.')
+        parser.add_argument('--until', help='ISO timestamp to restore to (default: everything).')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk insert (default 500).')
+
+    def handle(self, *args, **options):
+        until = None
+        if options['until']:
+            until = parse_datetime(options['until'])
+            if until is None:
+                raise CommandError('--until must be an ISO timestamp.')
+            if settings.USE_TZ and timezone.is_naive(until):
+                until = timezone.make_aware(until)
+            elif not settings.USE_TZ and timezone.is_aware(until):
+                until = timezone.make_naive(until)
+
+        try:
+            reports = restore_to(options['directory'], until, options['batch_size'])
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for label, rows, elapsed in reports:
+            rate = rows / elapsed if elapsed else 0
+            self.stdout.write('%-28s %8d row(s) %10.0f rows/s' % (label, rows, rate))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reposite.changelog import current_watermark, prune_changes, write_base, write_segment
+
+
+class Command(BaseCommand):
+    help = 'Write an incremental change-log segment (or a full base snapshot) into a snapshot directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Snapshot directory.')
+        parser.add_argument('--full', action='store_true', help='Write a new base snapshot (default when there is none).')
+        parser.add_argument('--prune', action='store_true', help='Afterwards delete change records the snapshots cover.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows serialized per batch for a base (default 500).')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if options['full'] or current_watermark(directory) is None:
+            report = write_base(directory, options['batch_size'])
+        else:
+            try:
+                report = write_segment(directory)
+            except (IOError, ValueError) as e:
+                raise CommandError(str(e))
+
+        if report is None:
+            self.stdout.write('No new changes.')
+        else:
+            self.stdout.write('Wrote %s: %d row(s) in %.1fs.' % (report.path, report.rows, report.elapsed))
+        if options['prune']:
+            self.stdout.write('Pruned %d change record(s).' % prune_changes(directory))
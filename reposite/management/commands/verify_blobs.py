@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reposite.models import StoredBlob
+from reposite.storage import blob_storage, recount_blobs, verify_blob
+
+
+class Command(BaseCommand):
+    help = 'Re-hash every stored blob in parallel and report missing or corrupt ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Blobs hashed concurrently (default 4).')
+        parser.add_argument('--recount', action='store_true', help='Also rebuild reference counts from the file tables.')
+
+    def handle(self, *args, **options):
+        blobs = list(StoredBlob.objects.only('sha256', 'name', 'size'))
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            results = pool.map(lambda blob: (blob, verify_blob(blob_storage, blob)), blobs)
+            problems = [(blob, problem) for blob, problem in results if problem]
+
+        for blob, problem in problems:
+            self.stderr.write('%s: %s' % (blob.name, problem))
+        self.stdout.write('Verified %d blob(s), %d problem(s).' % (len(blobs), len(problems)))
+
+        if options['recount']:
+            self.stdout.write('Corrected %d reference count(s).' % recount_blobs())
+        if problems:
+            raise CommandError('%d blob(s) failed verification.' % len(problems))
@@ -1,17 +1,95 @@
-import string
-import random
+import json
+import os
+import threading
+import uuid
 from collections import OrderedDict, namedtuple
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_init, post_save
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils.timezone import now
 
 from model_utils.models import TimeStampedModel
 from filebrowser.fields import FileBrowseField
 
-from discussions.models import Post
-
-from .schema import PrototypeMetadataForm, METADATA_CATEGORIES, METADATA_TYPES, METADATA_TYPES_TO_CATEGORIES
+from discussions.models import DiscussionLog, Post
+
+from .changelog import TRACKED_MODELS, capture_delete, capture_save, record_deletes, record_rows
+from .cloning import clone_prototype
+from .facets import invalidate_facet_counts
+from .indexing import enqueue_prototypes
+from .pagecache import bump_prototype_versions, invalidate_prototype_listings
+from .storage import blob_storage, release_blobs, retain_blobs
+from .schema import METADATA_CATEGORIES, METADATA_SCHEMA, METADATA_TYPES, METADATA_TYPES_TO_CATEGORIES
+
+# Display string and data items of one metadata type, for get_data_dict().
+MetaElement = namedtuple('MetaElement', 'metaprefix displayname datalist')
+
+
+def _count(queryset):
+    """ Subquery counting the rows of a correlated queryset. """
+    return models.Subquery(
+        queryset.order_by().annotate(n=models.Func(models.F('pk'), function='COUNT')).values('n')[:1],
+        output_field=models.IntegerField())
+
+
+class ProjectPrototypeQuerySet(models.QuerySet):
+    """
+    Named loading profiles so each view fetches a prototype and the related rows its template
+    walks in a fixed number of queries, e.g. ProjectPrototype.objects.profile('document').
+    """
+    PROFILES = {
+        'list': {
+            'select_related': ('creator', 'origin'),
+            'prefetch_related': (),
+        },
+        'detail': {
+            'select_related': ('creator', 'origin'),
+            'prefetch_related': ('tasks', 'flips'),
+        },
+        'document': {
+            'select_related': ('creator', 'origin'),
+            'prefetch_related': (
+                'tasks__task_files', 'implementation_info__implementation_files', 'project_files', 'flips',
+                'project_discussion__thread'),
+        },
+        'edit': {
+            'select_related': ('creator', 'origin'),
+            'prefetch_related': (),
+        },
+    }
+
+    def profile(self, name):
+        profile = self.PROFILES[name]
+        return self.select_related(*profile['select_related']).prefetch_related(*profile['prefetch_related'])
+
+    def activity(self, user=None):
+        """
+        When the first prototype in this queryset last changed anywhere its pages show, for
+        conditional GET. Task, implementation item, file and metadata writes already bump its
+        'modified'; flips, discussion posts and the user's own read marker are looked up
+        alongside it. Flips and posts are counted too, since deleting one that is not the newest
+        leaves the latest timestamp as it was. One query. Returns a dict of those timestamps and
+        counts, or None if there is no row.
+        """
+        flips = ProjectPrototype.objects.filter(origin=models.OuterRef('pk'))
+        posts = Post.objects.filter(
+            models.Q(project_thread__project=models.OuterRef('pk')) |
+            models.Q(parent_post__project_thread__project=models.OuterRef('pk')))
+        activity = self.annotate(
+            flipped=models.Subquery(flips.order_by('-modified').values('modified')[:1]),
+            flip_count=_count(flips),
+            discussed=models.Subquery(posts.order_by('-modified').values('modified')[:1]),
+            post_count=_count(posts))
+        fields = ['pk', 'modified', 'flipped', 'flip_count', 'discussed', 'post_count']
+        if user is not None and user.is_authenticated():
+            activity = activity.annotate(visited=models.Subquery(
+                DiscussionLog.objects.filter(
+                    user=user, discussion__project_thread__project=models.OuterRef('pk')
+                ).order_by('-modified').values('modified')[:1]))
+            fields.append('visited')
+        return activity.order_by().values(*fields).first()
 
 
 class ProjectPrototype(TimeStampedModel):
@@ -33,94 +111,156 @@ class ProjectPrototype(TimeStampedModel):
     featured = models.BooleanField(default=False)
     featured_by_line = models.TextField(null=True, blank=True)
     driving_question = models.TextField()
+    metadata_snapshot = models.TextField(
+        null=True, blank=True, editable=False,
+        help_text="JSON copy of this project's metadata elements, keyed by element_type")
+    metadata_version = models.PositiveIntegerField(default=0, editable=False)
 
-    def clone_project(self, user):
-        rstr = ''.join(
-            random.choice(string.ascii_lowercase + string.digits) for x in range(4))
-        new_title = self.title + '-' + user.last_name + '-' + rstr
+    objects = ProjectPrototypeQuerySet.as_manager()
 
-        try:
-            # Copy object attributes
-            clone = ProjectPrototype(
-                title=new_title, creator=user, origin=self, description=self.description, publisher=self.publisher, rights=self.rights)
-            clone.save()
-
-            # Copy object metadata
-            for i in self.data.all():
-                pm = PrototypeMetaElement(
-                    prototype_project=clone, element_type=i.element_type, element_data=i.element_data)
-                pm.save()
-
-            # Copy object tasks
-            for i in self.tasks.all():
-                new_t = i.clone_task()
-                new_t.prototype_project = clone
-                new_t.save()
+    def clone_project(self, user, include_files=False):
+        """ Flip this project for user. See reposite.cloning for the bulk clone engine. """
+        return clone_prototype(self, user, include_files=include_files).clone
 
-        except:
-            pass
+    def meta_data_schema(self):
+        return METADATA_SCHEMA
 
-        return clone
+    def set_metadata(self, elements):
+        """
+        Replace this project's metadata with the given (element_type, element_data) pairs.
+        Only the difference against the stored rows is written: one filtered delete for removed
+        pairs and one bulk_create for added ones, inside a single transaction.
+        """
+        wanted = OrderedDict(((t, str(d)), None) for t, d in elements)
+
+        with transaction.atomic():
+            existing = {(t, d): pk for pk, t, d in self.data.values_list('id', 'element_type', 'element_data')}
+
+            removed = [pk for pair, pk in existing.items() if pair not in wanted]
+            added = [
+                PrototypeMetaElement(
+                    prototype_project=self, element_type=t, element_data=d,
+                    element_category=METADATA_TYPES_TO_CATEGORIES.get(t))
+                for t, d in wanted if (t, d) not in existing]
+
+            if removed:
+                # Nothing references metadata elements, so skip the collector and its per-row signals;
+                # the change log and the index queue are written once below.
+                removed_rows = self.data.filter(id__in=removed)
+                removed_rows._raw_delete(removed_rows.db)
+                record_deletes(PrototypeMetaElement, removed)
+            if added:
+                PrototypeMetaElement.objects.bulk_create(added)
+                record_rows(self.data.exclude(id__in=existing.values()))
+            if removed or added or self.metadata_snapshot is None:
+                self.rebuild_metadata_snapshot()
+
+        return len(added), len(removed)
+
+    def rebuild_metadata_snapshot(self, touch=True):
+        """
+        Re-materialize metadata_snapshot from the PrototypeMetaElement rows and bump metadata_version.
+        Call this after any write to self.data. Uses a queryset update so the thread bookkeeping in
+        save() is not re-run. With touch, 'modified' is bumped as well so delta reindexing sees the edit.
+        """
+        snapshot = self.read_metadata()
+        self.metadata_snapshot = json.dumps(snapshot)
+        self.metadata_version = self.metadata_version + 1
+        changes = {'metadata_snapshot': self.metadata_snapshot, 'metadata_version': models.F('metadata_version') + 1}
+        if touch:
+            self.modified = changes['modified'] = now()
+        ProjectPrototype.objects.filter(pk=self.pk).update(**changes)
+        record_rows(ProjectPrototype.objects.filter(pk=self.pk))
+        self.__dict__.pop('_metadata_cache', None)
+        # Expire caches only once the rows are committed: earlier, a concurrent request could
+        # recompute them from the old rows and keep the result (the facets until the next write).
+        prototype_id = self.pk
+        transaction.on_commit(lambda: expire_metadata_caches(prototype_id))
+        enqueue_prototypes([self.pk])
+        return snapshot
+
+    def read_metadata(self):
+        """ Metadata straight from the PrototypeMetaElement rows, in snapshot shape. """
+        snapshot = OrderedDict()
+        for element_type, element_data in self.data.order_by('element_type', 'id').values_list('element_type', 'element_data'):
+            snapshot.setdefault(element_type, []).append(element_data)
+        return snapshot
+
+    @property
+    def metadata(self):
+        """
+        Snapshot of metadata as a dict of element_type -> [element_data, ...]. Rows that predate the
+        snapshot are read from the elements but not written back; reads never write. Backfill them
+        with the rebuild_metadata_snapshots command.
+        """
+        try:
+            return self.__dict__['_metadata_cache']
+        except KeyError:
+            pass
 
-    def meta_data_schema(self):
-        return PrototypeMetadataForm()
+        if self.metadata_snapshot is None:
+            snapshot = self.read_metadata()
+        else:
+            snapshot = json.loads(self.metadata_snapshot, object_pairs_hook=OrderedDict)
+        self.__dict__['_metadata_cache'] = snapshot
+        return snapshot
 
     def get_element_data(self, element_type):
-        data = [i.element_data for i in self.data.filter(
-            element_type=element_type)]
-        return data
+        return list(self.metadata.get(element_type, []))
 
     def get_languages(self):
         return self.get_element_data('language')
 
     def get_data_list(self):
-        return {i.element_type: i.element_data for i in self.data.all().order_by('element_category')}
-                   
+        return {k: v[-1] for k, v in self.metadata.items()}
+
     def get_data_dict(self):
         """ Group element data by element_type. Returns a dict keyed by element_type name. """
-
-        """
-        Using a namedtuple here to gather display string and data items.
-        """
-        MetaElement = namedtuple(
-            'MetaElement', 'metaprefix displayname datalist')
         data_dict = OrderedDict()
-        field_order = self.meta_data_schema().fields.items()
-
-        for field_name, field_type in field_order:
-            data_dict[field_name] = MetaElement(
-                metaprefix=field_type.label,
-                displayname=field_type.label_suffix,
+        for spec in METADATA_SCHEMA:
+            data_dict[spec.id] = MetaElement(
+                metaprefix=spec.label,
+                displayname=spec.label_suffix,
                 datalist=[]
             )
 
-        for i in self.data.all().order_by('element_type'):
+        for element_type in sorted(self.metadata):
             try:
-                data_dict[i.element_type].datalist.append(i.element_data)
+                data_dict[element_type].datalist.extend(self.metadata[element_type])
             except:
-                data_dict[i.element_type] = []
-                data_dict[i.element_type].append(i.element_data)
+                data_dict[element_type] = list(self.metadata[element_type])
 
         return data_dict
 
     def get_data(self):
+        type_display = METADATA_SCHEMA.type_labels
         data_dict = {}
-        for i in self.data.all().order_by('element_category'):
-            try:
-                data_dict[i.element_category].append((i.get_element_type_display, i.element_data))
-            except:
-                data_dict[i.element_category] = []
-                data_dict[i.element_category].append((i.get_element_type_display, i.element_data))        
+        for element_type, element_data in self.metadata.items():
+            category = METADATA_TYPES_TO_CATEGORIES.get(element_type)
+            for i in element_data:
+                data_dict.setdefault(category, []).append((type_display.get(element_type, element_type), i))
         return data_dict
 
     def save(self, *args, **kwargs):
         """ Create comment thread if one does not exist"""
+        adding = self._state.adding
+        if adding and self.metadata_snapshot is None:
+            self.metadata_snapshot = '{}'  # no elements yet; reads of older rows fall back to the table
         super(ProjectPrototype, self).save(*args, **kwargs)
+        invalidate_facet_counts()  # publishing/unpublishing changes the counts
+        bump_prototype_versions([self.pk, self.origin_id if adding else None])  # a new flip shows on its origin's pages
+        invalidate_prototype_listings()
         if not ProjectComment.objects.filter(project=self):
             thread = Post(text='Project Comments', creator=self.creator, subject='Comments for project')
             thread.save()
             ProjectComment(thread=thread, project=self).save()
 
+    def delete(self, *args, **kwargs):
+        bump_prototype_versions([self.pk, self.origin_id])
+        super(ProjectPrototype, self).delete(*args, **kwargs)
+        invalidate_prototype_listings()
+        invalidate_facet_counts()
+
     def get_absolute_url(self):
         return reverse('view_prototype', args=[self.id])
 
@@ -131,6 +271,65 @@ class ProjectPrototype(TimeStampedModel):
         pass
 
 
+def expire_metadata_caches(prototype_id):
+    """ Everything cached from a prototype's metadata: its pages, the listings (languages) and the facets. """
+    bump_prototype_versions([prototype_id])
+    invalidate_prototype_listings()
+    invalidate_facet_counts()
+
+
+def touch_prototype(prototype_id):
+    """ Bump a prototype's 'modified' timestamp after one of its child rows changed. """
+    ProjectPrototype.objects.filter(pk=prototype_id).update(modified=now())
+    record_rows(ProjectPrototype.objects.filter(pk=prototype_id))
+    bump_prototype_versions([prototype_id])
+
+
+class MetadataRebuild(object):
+    """
+    on_commit callback rebuilding one prototype's metadata snapshot. Every element save in a
+    transaction registers the same instance; only its first run at commit does the work.
+    """
+
+    def __init__(self, prototype_id):
+        self.prototype_id = prototype_id
+        self.done = False
+
+    def __call__(self):
+        if self.done:
+            return
+        self.done = True
+        if _pending_rebuilds().get(self.prototype_id) is self:
+            del _pending_rebuilds()[self.prototype_id]
+        for prototype in ProjectPrototype.objects.filter(pk=self.prototype_id):
+            prototype.rebuild_metadata_snapshot()
+
+
+_rebuilds = threading.local()
+
+
+def _pending_rebuilds():
+    """ This thread's {prototype_id: MetadataRebuild} not yet run. """
+    try:
+        return _rebuilds.pending
+    except AttributeError:
+        _rebuilds.pending = {}
+        return _rebuilds.pending
+
+
+def rebuild_metadata_on_commit(prototype_id):
+    """
+    Rebuild a prototype's metadata snapshot once the current transaction commits (immediately in
+    autocommit). Saving N elements in one transaction then costs one rebuild, not N. A rebuild
+    left pending by a rolled-back transaction never ran, so the next one simply reuses it.
+    """
+    pending = _pending_rebuilds()
+    rebuild = pending.get(prototype_id)
+    if rebuild is None or rebuild.done:
+        rebuild = pending[prototype_id] = MetadataRebuild(prototype_id)
+    transaction.on_commit(rebuild)
+
+
 class PrototypeMetaElement(models.Model):
     prototype_project = models.ForeignKey(
         ProjectPrototype, related_name='data')
@@ -139,12 +338,16 @@ class PrototypeMetaElement(models.Model):
     element_category = models.CharField(max_length=512, blank=True, null=True, choices=METADATA_CATEGORIES)
 
     def save(self, *args, **kwargs):
-        super(PrototypeMetaElement, self).save(*args, **kwargs)
         try:
             self.element_category = METADATA_TYPES_TO_CATEGORIES[self.element_type]
-            super(PrototypeMetaElement, self).save(*args, **kwargs)
         except:
             print ('Error while trying to assign a category to element. Refer to schema.py')
+        super(PrototypeMetaElement, self).save(*args, **kwargs)
+        rebuild_metadata_on_commit(self.prototype_project_id)
+
+    def delete(self, *args, **kwargs):
+        super(PrototypeMetaElement, self).delete(*args, **kwargs)
+        rebuild_metadata_on_commit(self.prototype_project_id)
 
     class Meta:
         unique_together = (
@@ -200,6 +403,14 @@ class ProjectTask(models.Model):
         t1.save()
         return t1
 
+    def save(self, *args, **kwargs):
+        super(ProjectTask, self).save(*args, **kwargs)
+        touch_prototype(self.prototype_project_id)
+
+    def delete(self, *args, **kwargs):
+        super(ProjectTask, self).delete(*args, **kwargs)
+        touch_prototype(self.prototype_project_id)
+
     def get_absolute_url(self):
         return reverse('view_task', args=[self.prototype_project.id, self.id])
 
@@ -233,6 +444,14 @@ class ProjectImplementationInfo(models.Model):
     def creator(self):
         return self.prototype_project.creator
 
+    def save(self, *args, **kwargs):
+        super(ProjectImplementationInfo, self).save(*args, **kwargs)
+        touch_prototype(self.prototype_project_id)
+
+    def delete(self, *args, **kwargs):
+        super(ProjectImplementationInfo, self).delete(*args, **kwargs)
+        touch_prototype(self.prototype_project_id)
+
     def get_absolute_url(self):
         return reverse('view_implementation_item', args=[self.prototype_project.id, self.id])
 
@@ -274,21 +493,184 @@ class RepoPage(TimeStampedModel):
         app_label = 'reposite' 
 
 
-class ProjectFile(TimeStampedModel):
+class IndexQueueEntry(models.Model):
+    """ Prototype ids waiting to be (re)indexed. See reposite.indexing. """
+    UPDATE = 'update'
+    REBUILD = 'rebuild'
+    ACTIONS = (
+        (UPDATE, 'Update prototype'),
+        (REBUILD, 'Rebuild index'),
+    )
+
+    prototype_id = models.IntegerField(null=True, blank=True, db_index=True)
+    action = models.CharField(max_length=16, choices=ACTIONS, default=UPDATE)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '%s %s' % (self.action, self.prototype_id or '')
+
+    class Meta:
+        ordering = ['id']
+
+
+class ChangeRecord(models.Model):
+    """ One captured insert, update or delete of a tracked row. See reposite.changelog. """
+    INSERT = 'I'
+    UPDATE = 'U'
+    DELETE = 'D'
+    ACTIONS = (
+        (INSERT, 'Insert'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    )
+
+    model = models.CharField(max_length=64)
+    object_id = models.IntegerField()
+    action = models.CharField(max_length=1, choices=ACTIONS)
+    data = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '%s %s %s' % (self.action, self.model, self.object_id)
+
+    class Meta:
+        ordering = ['id']
+
+
+class StoredBlob(models.Model):
+    """
+    One content-addressed upload on disk, keyed by its path; refcount counts the file rows that
+    point at it. The same bytes under two extensions are two blobs, so sha256 is not unique.
+    """
+    sha256 = models.CharField(max_length=64, db_index=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ChunkedUpload(TimeStampedModel):
+    """ A resumable upload in progress; the first `received` bytes of `size` are in its part file. """
+    OPEN = 'open'
+    COMPLETE = 'complete'
+    STATUSES = (
+        (OPEN, 'Open'),
+        (COMPLETE, 'Complete'),
+    )
+    TARGETS = (
+        ('project', 'Project Prototype'),
+        ('task', 'Task'),
+        ('implementation', 'Implementation Information Item'),
+    )
+
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)
+    received = models.BigIntegerField(default=0)
+    target_type = models.CharField(max_length=16, choices=TARGETS)
+    target_id = models.IntegerField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=OPEN)
+
+    def __str__(self):
+        return '%s (%d/%d)' % (self.filename, self.received, self.size)
+
+
+class UploadedFile(TimeStampedModel):
+    """
+    Shared by the file models. Stored names are content hashes (see storage.py), so the name
+    the file was uploaded under is kept in original_name; show display_name to users.
+    """
+    original_name = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def display_name(self):
+        return self.original_name or os.path.basename(self.file.name)
+
+    def save(self, *args, **kwargs):
+        # Before the first save the field still holds the upload, named as the user sent it.
+        if not self.original_name and self.file and not self.file._committed:
+            self.original_name = os.path.basename(self.file.name)[:255]
+        super(UploadedFile, self).save(*args, **kwargs)
+
+
+class ProjectFile(UploadedFile):
     file = models.FileField(
-        upload_to='uploads')
+        upload_to='uploads', storage=blob_storage)
     project = models.ForeignKey(ProjectPrototype, related_name='project_files')
     user = models.ForeignKey(User, related_name='uploaded_files')
 
 
-class TaskFile(TimeStampedModel):
-    file = models.FileField(upload_to='uploads')
+class TaskFile(UploadedFile):
+    file = models.FileField(upload_to='uploads', storage=blob_storage)
     task = models.ForeignKey(ProjectTask, related_name='task_files')
     user = models.ForeignKey(User, related_name='uploaded_task_files')
 
 
-class ImplementationFile(TimeStampedModel):
+class ImplementationFile(UploadedFile):
     file = models.FileField(
-        upload_to='uploads')
+        upload_to='uploads', storage=blob_storage)
     implementation = models.ForeignKey(ProjectImplementationInfo, related_name='implementation_files')
     user = models.ForeignKey(User, related_name='uploaded_implementation_files')
+
+
+FILE_MODELS = (ProjectFile, TaskFile, ImplementationFile)
+
+
+def touch_file_owner(instance):
+    """ Bump the 'modified' timestamp of the prototype a file row hangs off. """
+    if isinstance(instance, ProjectFile):
+        prototype_id = instance.project_id
+    elif isinstance(instance, TaskFile):
+        prototype_id = ProjectTask.objects.filter(pk=instance.task_id).values_list('prototype_project', flat=True).first()
+    else:
+        prototype_id = ProjectImplementationInfo.objects.filter(
+            pk=instance.implementation_id).values_list('prototype_project', flat=True).first()
+    if prototype_id:
+        touch_prototype(prototype_id)
+
+
+def remember_file_name(sender, instance, **kwargs):
+    instance._stored_file_name = instance.file.name
+
+
+def count_file_reference(sender, instance, created, **kwargs):
+    """ Keep StoredBlob.refcount in step with file rows; bulk writes call retain_blobs() themselves. """
+    previous = getattr(instance, '_stored_file_name', None)
+    if created or previous != instance.file.name:
+        retain_blobs([instance.file.name])
+        if not created:
+            release_blobs([previous])
+    instance._stored_file_name = instance.file.name
+    touch_file_owner(instance)
+
+
+def release_file_reference(sender, instance, **kwargs):
+    release_blobs([instance.file.name])
+    touch_file_owner(instance)
+
+
+for file_model in FILE_MODELS:
+    post_init.connect(remember_file_name, sender=file_model)
+    post_save.connect(count_file_reference, sender=file_model)
+    post_delete.connect(release_file_reference, sender=file_model)
+
+def bump_discussion_prototypes(sender, instance, **kwargs):
+    """ A post changed: new versions for the prototypes whose comment thread it is in. """
+    thread_id = instance.parent_post_id or instance.pk
+    bump_prototype_versions(ProjectComment.objects.filter(thread_id=thread_id).values_list('project_id', flat=True))
+
+
+post_save.connect(bump_discussion_prototypes, sender=Post)
+post_delete.connect(bump_discussion_prototypes, sender=Post)
+
+for tracked in TRACKED_MODELS:
+    post_save.connect(capture_save, sender=tracked)
+    post_delete.connect(capture_delete, sender=tracked)
@@ -0,0 +1,143 @@
+# pagecache.py
+"""
+Versioned page and fragment caching for the prototype document and detail pages.
+
+Each prototype has a version number kept in the cache. Every write path that changes what its
+pages show bumps it:
+- saves and deletes of the prototype and its metadata, tasks, implementation items and files
+  (through touch_prototype() and rebuild_metadata_snapshot())
+- flips, for the origin's flip list
+- discussion posts
+Cache keys embed the version, so nothing is ever invalidated by hand or by guessing a TTL. Entries
+for an old version are simply never asked for again and age out of the backend.
+
+Two levels use it:
+- AnonymousPageCacheMixin caches whole responses for anonymous visitors.
+- prototype_fragment_cache() feeds {% cache %} tags around the task outline, the metadata panel
+  and the file listing, for everyone else. Those fragments contain edit links, so their keys
+  also carry whether the user owns the prototype and whether they are staff.
+
+The backend is any Django cache alias shared by every worker: memcached, redis, or a file-based
+cache on a single host. A locmem cache (Django's default when CACHES is not configured) is private
+to each process, so a bump made in one worker would never reach the others and they would keep
+serving the old pages. With a locmem alias the page and fragment caches therefore stay off unless
+CACHE_SINGLE_PROCESS declares that one process serves everything (see core.cache).
+
+    PAGE_CACHE_ALIAS = 'default'
+    PAGE_CACHE_TIMEOUT = 24 * 3600
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+
+from core.cache import process_local, tiered_cache
+
+VERSION_KEY = 'reposite:prototype-version:%s'
+PAGE_KEY = 'reposite:page:%s'
+PROTOTYPES_TAG = 'prototypes'
+
+
+def page_cache_alias():
+    return getattr(settings, 'PAGE_CACHE_ALIAS', 'default')
+
+
+def page_cache_timeout():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 24 * 3600)
+
+
+def page_cache_enabled():
+    return not process_local(caches[page_cache_alias()])
+
+
+def _fresh_version():
+    # After an eviction the counter restarts from the clock, above any version handed out before.
+    return int(time.time() * 1000)
+
+
+def prototype_version(prototype_id):
+    cache = caches[page_cache_alias()]
+    key = VERSION_KEY % prototype_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _fresh_version(), None)
+        version = cache.get(key) or _fresh_version()
+    return version
+
+
+def bump_prototype_versions(prototype_ids):
+    """
+    Move the given prototypes to a new version, so every page and fragment cached for them misses.
+    Inside a transaction the bump waits for the commit; bumped earlier, a page rendered from the
+    old rows in the meantime would be cached under the new version.
+    """
+    prototype_ids = set(pk for pk in prototype_ids if pk)
+    if prototype_ids:
+        transaction.on_commit(lambda: _bump_now(prototype_ids))
+
+
+def _bump_now(prototype_ids):
+    cache = caches[page_cache_alias()]
+    for prototype_id in prototype_ids:
+        try:
+            cache.incr(VERSION_KEY % prototype_id)
+        except ValueError:
+            cache.set(VERSION_KEY % prototype_id, _fresh_version(), None)
+
+
+def invalidate_prototype_listings():
+    """
+    Expire the prototype listings kept in the tiered cache (tagged "prototypes"). Only writes to
+    what a listing shows call this: the prototype row itself and its metadata. Tasks, files and
+    comments leave the listings alone; the 'modified' date they show may lag by up to the
+    listing's timeout.
+    """
+    tiered_cache.invalidate_tags([PROTOTYPES_TAG])
+
+
+def prototype_fragment_cache(prototype, user):
+    """ Context for the {% cache %} tags on prototype pages; see the templates. """
+    return {
+        'alias': page_cache_alias(),
+        'timeout': page_cache_timeout() if page_cache_enabled() else 0,  # 0: stored already expired
+        'version': prototype_version(prototype.pk),
+        'role': '%d%d' % (prototype.creator_id == user.pk, user.is_staff),
+    }
+
+
+class AnonymousPageCacheMixin(object):
+    """
+    Serve anonymous GETs whole from the page cache. Views implement get_page_version(), which
+    should be cheap (no queries) and return None to skip caching a request.
+    """
+
+    def get_page_version(self):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        version = None
+        if page_cache_enabled() and not request.user.is_authenticated() and not len(get_messages(request)):
+            version = self.get_page_version()
+        if version is None:
+            return super(AnonymousPageCacheMixin, self).get(request, *args, **kwargs)
+
+        cache = caches[page_cache_alias()]
+        key = PAGE_KEY % hashlib.md5(('%s|%s' % (request.get_full_path(), version)).encode('utf-8')).hexdigest()
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = super(AnonymousPageCacheMixin, self).get(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            if hasattr(response, 'render'):
+                response.render()
+            # A page holding a CSRF token belongs to one visitor.
+            if not request.META.get('CSRF_COOKIE_USED'):
+                cache.set(key, (response.content, response['Content-Type']), page_cache_timeout())
+        return response
@@ -62,7 +62,9 @@ form used to create metadata elements are properly associated.
 Additionally, a controlled vocabulary may be defined for each metatdata form to constrain the data. 
 """
 
+import copy
 from collections import OrderedDict, namedtuple
+from types import MappingProxyType
 
 MetaElementDef = namedtuple('MetaElementDef', 'id id_display category category_display')
 
@@ -190,11 +192,10 @@ METADATA_TYPES                  = tuple([(m.id, m.id_display) for m in METADATA]
 
 METADATA_TYPES_TO_CATEGORIES    = {m.id: m.category for m in METADATA}
 
+METADATA_BY_ID                  = {m.id: m for m in METADATA}
+
 def meta_lookup(element_identifier=None):
-    for e in METADATA:
-        if e.id == element_identifier:
-            return e
-    return None
+    return METADATA_BY_ID.get(element_identifier)
 
 """
 CONTROLLED VOCABULARLY FOR BASE AND EXTENDED DESCRIPTORS
@@ -380,12 +381,63 @@ Alert: the category attribute is required for each form widget. This should refl
 """
 
 from django import forms
+from django.utils.encoding import force_text
+
+
+def normalize_term(value):
+    """ Matching key for a vocabulary term: case-folded, with runs of whitespace collapsed. """
+    return ' '.join(force_text(value).split()).casefold()
+
+
+class VocabularyFieldMixin(object):
+    """
+    Validates against a dict built once from the choices (normalized term -> stored value) rather
+    than scanning the choices for every submitted value, and cleans values to their stored
+    spelling, so ' arabic' is accepted as 'Arabic'. Copies share the (immutable) choices, which
+    matters for the ~500 LANGUAGES_NISO entries copied on every form instance.
+    """
+
+    def _set_choices(self, value):
+        super(VocabularyFieldMixin, self)._set_choices(value)
+        if not callable(value):
+            self._choices = self.widget.choices = tuple(self._choices)
+        self.vocabulary_lookup = {}
+        for key, label in self._choices:
+            for k, v in (label if isinstance(label, (list, tuple)) else [(key, label)]):
+                self.vocabulary_lookup.setdefault(normalize_term(k), force_text(k))
+
+    choices = property(forms.ChoiceField._get_choices, _set_choices)
+
+    def __deepcopy__(self, memo):
+        return forms.Field.__deepcopy__(self, memo)
+
+    def canonical(self, value):
+        """ The stored spelling of value, or value unchanged when it is not in the vocabulary. """
+        return self.vocabulary_lookup.get(normalize_term(value), value)
+
+    def valid_value(self, value):
+        return normalize_term(value) in self.vocabulary_lookup
+
+
+class VocabularyChoiceField(VocabularyFieldMixin, forms.ChoiceField):
+
+    def to_python(self, value):
+        value = super(VocabularyChoiceField, self).to_python(value)
+        return self.canonical(value) if value else value
+
+
+class VocabularyMultipleChoiceField(VocabularyFieldMixin, forms.MultipleChoiceField):
+
+    def to_python(self, value):
+        values = super(VocabularyMultipleChoiceField, self).to_python(value)
+        return list(OrderedDict.fromkeys(self.canonical(i) for i in values))
+
 
 class PrototypeMetadataForm(forms.Form):
     default_input_size = '60'
 
     element = meta_lookup('subject')
-    subject = forms.MultipleChoiceField(
+    subject = VocabularyMultipleChoiceField(
         choices=SUBJECT_AREAS,
         label=element.category_display,
         label_suffix=element.id_display,
@@ -394,7 +446,7 @@ class PrototypeMetadataForm(forms.Form):
         required=True)
 
     element = meta_lookup('language')
-    language = forms.MultipleChoiceField(
+    language = VocabularyMultipleChoiceField(
         choices=LANGUAGES_NISO,
         label=element.category_display,
         label_suffix=element.id_display,
@@ -403,7 +455,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('ic_heritage_learners')
-    ic_heritage_learners = forms.ChoiceField(
+    ic_heritage_learners = VocabularyChoiceField(
         choices=INSTRUCTIONAL_CONTEXTS['heritage-learners'],
         label=element.category_display,
         label_suffix=element.id_display,
@@ -446,7 +498,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('lp_actfl_scale')
-    lp_actfl_scale = forms.MultipleChoiceField(
+    lp_actfl_scale = VocabularyMultipleChoiceField(
         choices=LANGUAGE_PROFICIENCY['actfl'],
         label=element.category_display,
         label_suffix=element.id_display,
@@ -455,7 +507,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('lp_ilr_scale_listening')
-    lp_ilr_scale_listening = forms.MultipleChoiceField(
+    lp_ilr_scale_listening = VocabularyMultipleChoiceField(
         choices=LANGUAGE_PROFICIENCY['ilr-listening'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -464,7 +516,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('lp_ilr_scale_reading')
-    lp_ilr_scale_reading = forms.MultipleChoiceField(
+    lp_ilr_scale_reading = VocabularyMultipleChoiceField(
         choices=LANGUAGE_PROFICIENCY['ilr-reading'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -473,7 +525,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('lp_ilr_scale_speaking')
-    lp_ilr_scale_speaking = forms.MultipleChoiceField(
+    lp_ilr_scale_speaking = VocabularyMultipleChoiceField(
         choices=LANGUAGE_PROFICIENCY['ilr-speaking'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -482,7 +534,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('lp_ilr_scale_writing')
-    lp_ilr_scale_writing = forms.MultipleChoiceField(
+    lp_ilr_scale_writing = VocabularyMultipleChoiceField(
         choices=LANGUAGE_PROFICIENCY['ilr-writing'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -491,7 +543,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('wr_goal_area_communication')
-    wr_goal_area_communication = forms.MultipleChoiceField(
+    wr_goal_area_communication = VocabularyMultipleChoiceField(
         choices=WR_GOAL_AREA['communication'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -500,7 +552,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('wr_goal_area_cultures')
-    wr_goal_area_cultures = forms.MultipleChoiceField(
+    wr_goal_area_cultures = VocabularyMultipleChoiceField(
         choices=WR_GOAL_AREA['cultures'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -509,7 +561,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('wr_goal_area_connections')
-    wr_goal_area_connections = forms.MultipleChoiceField(
+    wr_goal_area_connections = VocabularyMultipleChoiceField(
         choices=WR_GOAL_AREA['connections'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -518,7 +570,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('wr_goal_area_comparisons')
-    wr_goal_area_comparisons = forms.MultipleChoiceField(
+    wr_goal_area_comparisons = VocabularyMultipleChoiceField(
         choices=WR_GOAL_AREA['comparisons'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -527,7 +579,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('wr_goal_area_communities')
-    wr_goal_area_communities = forms.MultipleChoiceField(
+    wr_goal_area_communities = VocabularyMultipleChoiceField(
         choices=WR_GOAL_AREA['communities'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -536,7 +588,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('cs_interdisciplinary_themes')
-    cs_interdisciplinary_themes = forms.MultipleChoiceField(
+    cs_interdisciplinary_themes = VocabularyMultipleChoiceField(
         choices=CENTURY_SKILLS['interdisciplinary-themes'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -545,7 +597,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('cs_info_media_technology_skills')
-    cs_info_media_technology_skills = forms.MultipleChoiceField(
+    cs_info_media_technology_skills = VocabularyMultipleChoiceField(
         choices=CENTURY_SKILLS['information-media-technology-skills'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -554,7 +606,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     element = meta_lookup('cs_like_career_skills')
-    cs_like_career_skills = forms.MultipleChoiceField(
+    cs_like_career_skills = VocabularyMultipleChoiceField(
         choices=CENTURY_SKILLS['like-career-skills'],
         widget=forms.CheckboxSelectMultiple(attrs={'class': '', 'data_value': element.id}),
         label=element.category_display,
@@ -563,7 +615,7 @@ class PrototypeMetadataForm(forms.Form):
         required=False)
 
     def multiple_choice_fields(self):
-        return [field_name for field_name, field_type in self.fields.items() if type(field_type) == forms.MultipleChoiceField]
+        return [name for name in self.fields if name in METADATA_SCHEMA.multiple]
 
     
     def display_order_fields(self):
@@ -571,3 +623,118 @@ class PrototypeMetadataForm(forms.Form):
         return self.fields.keys()
 
 
+"""
+METADATA_SCHEMA is the compiled, read-only form of everything above. It is built once at import
+from METADATA and PrototypeMetadataForm.base_fields, so code that only needs to read the schema
+(field order, labels, categories, which fields take several values, vocabularies) looks it up
+here instead of instantiating PrototypeMetadataForm, which deep-copies every field and choice list.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+
+MetaFieldSpec = namedtuple(
+    'MetaFieldSpec',
+    'id label label_suffix category category_display required multiple choices choice_labels vocabulary lookup')
+
+
+class MetadataSchema(object):
+    """
+    fields: element_type -> MetaFieldSpec, in form order. A spec's vocabulary is a frozenset of
+    the allowed values (None for free text), lookup maps normalize_term() of a value to its
+    stored spelling and choice_labels maps value -> display string.
+    """
+
+    def __init__(self, form_class, elements):
+        by_id = {e.id: e for e in elements}
+        missing = set(by_id).symmetric_difference(form_class.base_fields)
+        if missing:
+            raise ImproperlyConfigured(
+                'METADATA and %s disagree on: %s' % (form_class.__name__, ', '.join(sorted(missing))))
+
+        specs = OrderedDict()
+        for name, field in form_class.base_fields.items():
+            element = by_id[name]
+            choices = tuple(tuple(i) for i in getattr(field, 'choices', ()))
+            specs[name] = MetaFieldSpec(
+                id=name,
+                label=field.label,
+                label_suffix=field.label_suffix,
+                category=element.category,
+                category_display=element.category_display,
+                required=field.required,
+                multiple=isinstance(field, forms.MultipleChoiceField),
+                choices=choices,
+                choice_labels=MappingProxyType(dict(choices)),
+                vocabulary=frozenset(value for value, label in choices) if choices else None,
+                lookup=MappingProxyType(dict(field.vocabulary_lookup)) if choices else None)
+
+        categories = OrderedDict((category, []) for category in CATEGORY_DEFINITIONS)
+        for spec in specs.values():
+            categories[spec.category].append(spec.id)
+
+        self.form_class = form_class
+        self.fields = MappingProxyType(specs)
+        self.order = tuple(specs)
+        self.multiple = frozenset(name for name, spec in specs.items() if spec.multiple)
+        self.required = tuple(name for name, spec in specs.items() if spec.required)
+        self.categories = MappingProxyType(OrderedDict((k, tuple(v)) for k, v in categories.items()))
+        self.type_labels = MappingProxyType({e.id: e.id_display for e in elements})
+
+    def __getitem__(self, element_type):
+        return self.fields[element_type]
+
+    def __contains__(self, element_type):
+        return element_type in self.fields
+
+    def __iter__(self):
+        return iter(self.fields.values())
+
+    def form_fields(self):
+        """ Fresh (name, field) copies in display order, for forms that embed the metadata fields. """
+        return [(name, copy.deepcopy(field)) for name, field in self.form_class.base_fields.items()]
+
+    def clean_records(self, records, partial=False):
+        """
+        Validate many metadata records at once, for bulk importers and the API, without building a
+        form per record. Each record maps element_type to a value or a list of values. Returns
+        [(elements, errors)] in input order: elements are (element_type, element_data) pairs in
+        stored spelling, ready for set_metadata(); errors maps element_type to messages. With
+        partial, required types may be absent.
+        """
+        results = []
+        for record in records:
+            elements, errors = [], {}
+            for element_type, value in record.items():
+                spec = self.fields.get(element_type)
+                if spec is None:
+                    errors[element_type] = ['Unknown metadata type.']
+                    continue
+                values = [i for i in (value if isinstance(value, (list, tuple, set, frozenset)) else [value])
+                          if i not in (None, '')]
+                if len(values) > 1 and not spec.multiple:
+                    errors[element_type] = ['Enter a single value.']
+                    continue
+                cleaned = OrderedDict()
+                for i in values:
+                    if spec.lookup is None:
+                        text = force_text(i).strip()
+                        if text:
+                            cleaned[text] = None
+                    elif normalize_term(i) in spec.lookup:
+                        cleaned[spec.lookup[normalize_term(i)]] = None
+                    else:
+                        errors.setdefault(element_type, []).append(
+                            '%s is not one of the available choices.' % force_text(i))
+                elements.extend((element_type, i) for i in cleaned)
+            if not partial:
+                present = set(t for t, d in elements)
+                for element_type in self.required:
+                    if element_type not in present and element_type not in errors:
+                        errors[element_type] = ['This field is required.']
+            results.append((elements, errors))
+        return results
+
+
+METADATA_SCHEMA = MetadataSchema(PrototypeMetadataForm, METADATA)
+
+
@@ -1,7 +1,18 @@
 # search_indexes.py
+from django.utils.html import strip_tags
+
 from haystack import indexes
 
 from .models import ProjectPrototype
+from .schema import METADATA_SCHEMA
+
+""" Vocabulary labels keyed by metadata field, used to index readable facet values (e.g. 'Novice Low' rather than '1'). """
+CHOICE_LABELS = {spec.id: spec.choice_labels for spec in METADATA_SCHEMA if spec.choices}
+
+ILR_FIELDS = ('lp_ilr_scale_listening', 'lp_ilr_scale_reading', 'lp_ilr_scale_speaking', 'lp_ilr_scale_writing')
+WORLD_READINESS_FIELDS = (
+    'wr_goal_area_communication', 'wr_goal_area_cultures', 'wr_goal_area_connections',
+    'wr_goal_area_comparisons', 'wr_goal_area_communities')
 
 
 class ProjectPrototypeIndex(indexes.SearchIndex, indexes.Indexable):
@@ -11,9 +22,52 @@ class ProjectPrototypeIndex(indexes.SearchIndex, indexes.Indexable):
     creator = indexes.CharField(model_attr='creator')
     origin = indexes.CharField(model_attr='origin', default=None)
 
+    # Facets, prepared from the prototype's metadata snapshot
+    language = indexes.MultiValueField(faceted=True)
+    subject = indexes.MultiValueField(faceted=True)
+    actfl_level = indexes.MultiValueField(faceted=True)
+    ilr_level = indexes.MultiValueField(faceted=True)
+    world_readiness = indexes.MultiValueField(faceted=True)
+
+    # Prepared from the prefetched tasks
+    task_titles = indexes.MultiValueField()
+    task_descriptions = indexes.MultiValueField()
+
     def get_model(self):
         return ProjectPrototype
 
     def index_queryset(self, using=None):
-        """Used when the entire index for model is updated."""
-        return self.get_model().objects.all()
+        """Used when the entire index for model is updated. Only published prototypes are searchable."""
+        return self.get_model().objects.filter(active=True).select_related('creator', 'origin').prefetch_related('tasks')
+
+    def get_updated_field(self):
+        """Lets update_index --age/--start run deltas. Task and metadata edits bump the prototype's modified."""
+        return 'modified'
+
+    def labels(self, obj, *element_types):
+        values = []
+        for element_type in element_types:
+            labels = CHOICE_LABELS.get(element_type, {})
+            values.extend(labels.get(i, i) for i in obj.get_element_data(element_type))
+        return values
+
+    def prepare_language(self, obj):
+        return obj.get_element_data('language')
+
+    def prepare_subject(self, obj):
+        return obj.get_element_data('subject')
+
+    def prepare_actfl_level(self, obj):
+        return self.labels(obj, 'lp_actfl_scale')
+
+    def prepare_ilr_level(self, obj):
+        return self.labels(obj, *ILR_FIELDS)
+
+    def prepare_world_readiness(self, obj):
+        return self.labels(obj, *WORLD_READINESS_FIELDS)
+
+    def prepare_task_titles(self, obj):
+        return [i.title for i in obj.tasks.all()]
+
+    def prepare_task_descriptions(self, obj):
+        return [strip_tags(i.short_description + ' ' + i.description) for i in obj.tasks.all()]
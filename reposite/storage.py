@@ -0,0 +1,171 @@
+# storage.py
+"""
+Content-addressed storage for uploaded project, task and implementation files.
+
+Uploads are hashed while they are streamed to a temporary file, then moved to
+blobs/ab/cd/<sha256><ext>. The same bytes uploaded twice with the same extension end up in one
+blob. Each blob path has a StoredBlob row (bytes stored under two extensions are two rows) whose
+refcount is the number of ProjectFile, TaskFile and ImplementationFile rows
+pointing at it. The file models keep it current through retain_blobs()/release_blobs(), and
+recount_blobs() rebuilds it from the three tables.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import Counter
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+BLOB_ROOT = 'blobs'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def blob_name(digest, original_name=''):
+    """ Sharded path of a blob; the original extension is kept so URLs serve with the right type. """
+    ext = os.path.splitext(original_name)[1].lower()
+    return '/'.join((BLOB_ROOT, digest[:2], digest[2:4], digest + ext))
+
+
+def digest_from_name(name):
+    """ The sha256 in a blob path, or None for files outside the blob layout. """
+    if not name or not name.startswith(BLOB_ROOT + '/'):
+        return None
+    digest = os.path.splitext(os.path.basename(name))[0]
+    return digest if len(digest) == 64 else None
+
+
+def hash_file(path):
+    """ (sha256 hex digest, size) of a file on disk, read in chunks. """
+    sha, size = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """ FileSystemStorage that names files by the sha256 of their content. """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is chosen in _save from the content; identical names mean identical bytes.
+        return name
+
+    def _save(self, name, content):
+        tmp_dir = self.path(os.path.join(BLOB_ROOT, 'tmp'))
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        sha, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode('utf-8')
+                    sha.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+            return self.place(tmp_path, name, sha.hexdigest(), size)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def place(self, tmp_path, name, digest, size):
+        """
+        Move an already hashed file (on the same filesystem) into the blob layout and record its
+        StoredBlob. If the blob exists the file is dropped instead. Returns the blob path.
+        """
+        final_name = blob_name(digest, name)
+        final_path = self.path(final_name)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+            # Refresh the mtime so the upload garbage collector's grace period covers the new reference.
+            os.utime(final_path, None)
+        else:
+            if not os.path.isdir(os.path.dirname(final_path)):
+                os.makedirs(os.path.dirname(final_path))
+            os.rename(tmp_path, final_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(final_path, self.file_permissions_mode)
+
+        self.record(final_name, digest, size)
+        return final_name
+
+    def record(self, name, digest, size):
+        """ Make sure the blob path has its StoredBlob row. """
+        from .models import StoredBlob
+
+        StoredBlob.objects.get_or_create(name=name, defaults={'sha256': digest, 'size': size})
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def _adjust(names, sign):
+    from .models import StoredBlob
+
+    for name, n in Counter(n for n in names if digest_from_name(n)).items():
+        StoredBlob.objects.filter(name=name).update(refcount=F('refcount') + sign * n)
+
+
+def retain_blobs(names):
+    """ Count one more reference per occurrence of each blob path in names. """
+    _adjust(names, 1)
+
+
+def release_blobs(names):
+    """ Drop one reference per occurrence of each blob path in names. """
+    _adjust(names, -1)
+
+
+def referenced_names():
+    """ Counter of file names referenced by the three file models. """
+    from .models import ProjectFile, TaskFile, ImplementationFile
+
+    refs = Counter()
+    for model in (ProjectFile, TaskFile, ImplementationFile):
+        refs.update(model.objects.values_list('file', flat=True).iterator())
+    return refs
+
+
+def recount_blobs():
+    """ Recompute every StoredBlob.refcount from the file tables; returns the number corrected. """
+    from .models import StoredBlob
+
+    refs = referenced_names()
+    corrected = 0
+    for blob in StoredBlob.objects.only('pk', 'name', 'refcount').iterator():
+        if blob.refcount != refs.get(blob.name, 0):
+            StoredBlob.objects.filter(pk=blob.pk).update(refcount=refs.get(blob.name, 0))
+            corrected += 1
+    return corrected
+
+
+def verify_blob(storage, blob):
+    """ None if the blob on disk matches its row, otherwise a short description of the problem. """
+    path = storage.path(blob.name)
+    if not os.path.exists(path):
+        return 'missing'
+    digest, size = hash_file(path)
+    if digest != blob.sha256:
+        return 'hash mismatch (%s)' % digest
+    if size != blob.size:
+        return 'size mismatch (%d bytes on disk)' % size
+    return None
+
+
+def adopt_file(storage, name):
+    """
+    Copy a legacy upload into the blob layout and return its blob path. The original file is
+    left in place for the upload garbage collector.
+    """
+    with open(storage.path(name), 'rb') as src:
+        return storage._save(name, File(src))
@@ -0,0 +1,249 @@
+# uploadgc.py
+"""
+Garbage collection of upload files that no row references any more.
+
+The upload directories and the referencing columns are both streamed in sorted order and
+merged, so memory stays flat no matter how many files there are. Paths found in rich text
+have no column to sort on; they are sorted externally, in runs spilled to temporary files.
+A file is referenced if:
+- a ProjectFile, TaskFile or ImplementationFile row or a prototype icon names it, or
+- its path appears in rich text (descriptions, tasks, posts, pages). Rich text links to uploads
+  that were pasted from the file listings or inserted through the filebrowser.
+Files younger than the grace period are never touched, which protects uploads that are in
+flight. Each file is re-checked just before it is deleted.
+"""
+
+import heapq
+import html
+import os
+import re
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .storage import BLOB_ROOT, blob_storage, digest_from_name
+
+UPLOAD_ROOTS = ('uploads', BLOB_ROOT)
+SORT_RUN_SIZE = 100000
+_ROOTS_PATTERN = '|'.join(re.escape(r) for r in UPLOAD_ROOTS)
+EMBEDDED_PATH = re.compile(r'(?:%s)/[^"\'\s<>?#)]+' % _ROOTS_PATTERN)
+# Quoted attribute values may hold spaces and parentheses that the bare pattern stops at.
+QUOTED_VALUE = re.compile(r'(["\'])([^"\'<>]*)\1')
+QUOTED_PATH = re.compile(r'(?:^|/)((?:%s)/[^?#]+)' % _ROOTS_PATTERN)
+
+StoredFile = namedtuple('StoredFile', 'name size mtime')
+CollectionReport = namedtuple('CollectionReport', 'orphans deleted bytes skipped')
+
+
+def walk_sorted(storage, top):
+    """
+    Yield StoredFile for every file under top, in plain string order of the relative path.
+    Directories sort as "name/" so the walk order matches comparing whole paths.
+    """
+    root = storage.path(top)
+    if not os.path.isdir(root):
+        return
+    entries = sorted(os.scandir(root), key=lambda e: e.name + '/' if e.is_dir(follow_symlinks=False) else e.name)
+    for entry in entries:
+        name = top + '/' + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            for stored in walk_sorted(storage, name):
+                yield stored
+        elif entry.is_file(follow_symlinks=False):
+            st = entry.stat(follow_symlinks=False)
+            yield StoredFile(name, st.st_size, st.st_mtime)
+
+
+def _column_sorted(model, field_name):
+    """ Non-empty values of a file column, in code point order whatever the database collation. """
+    field = model._meta.get_field(field_name)
+    values = model.objects.exclude(**{field_name: ''}).exclude(**{field_name + '__isnull': True})
+    if connection.vendor == 'postgresql':
+        values = values.order_by(RawSQL('%s COLLATE "C"' % connection.ops.quote_name(field.column), ()))
+    else:
+        values = values.order_by(field_name)
+    return values.values_list(field_name, flat=True).iterator()
+
+
+def _spill(run):
+    """ A temporary file holding the sorted names of run, one per line, rewound for reading. """
+    f = tempfile.TemporaryFile('w+', encoding='utf-8')
+    f.writelines(name + '\n' for name in sorted(run))
+    f.seek(0)
+    return f
+
+
+def external_sorted(names, run_size=SORT_RUN_SIZE):
+    """
+    Sort a stream of names (which must not contain newlines) in bounded memory, each once:
+    sorted runs of at most run_size distinct names are spilled to temporary files and merged.
+    """
+    runs = []
+    try:
+        run = set()
+        for name in names:
+            run.add(name)
+            if len(run) >= run_size:
+                runs.append(_spill(run))
+                run = set()
+        if not runs:
+            for name in sorted(run):
+                yield name
+            return
+        if run:
+            runs.append(_spill(run))
+        previous = None
+        for name in heapq.merge(*[(line.rstrip('\n') for line in f) for f in runs]):
+            if name != previous:
+                yield name
+                previous = name
+    finally:
+        for f in runs:
+            f.close()
+
+
+def linked_names(text):
+    """
+    Storage names of the uploads a rich-text value links to. Links are HTML-escaped and
+    percent-encoded ("uploads/my%20notes.pdf"), so every match is decoded before it is compared
+    with names on disk. A name may come out twice, or cut short at a space; both are harmless
+    as extra references.
+    """
+    matches = EMBEDDED_PATH.findall(text)
+    for quote, value in QUOTED_VALUE.findall(text):
+        matches.extend(QUOTED_PATH.findall(value))
+    for match in matches:
+        name = unquote(html.unescape(match))
+        if '\n' not in name:  # never a storage name, and the external sort is line-based
+            yield name
+
+
+def _embedded_paths():
+    from discussions.models import Post
+    from .models import ProjectPrototype, ProjectTask, ProjectImplementationInfo, RepoPage
+
+    sources = (
+        (ProjectPrototype, ('description', 'driving_question', 'contributors', 'featured_by_line')),
+        (ProjectTask, ('short_description', 'description', 'technology_tips', 'task_extension', 'potential_hurdles')),
+        (ProjectImplementationInfo, ('description',)),
+        (RepoPage, ('content',)),
+        (Post, ('text',)),
+    )
+    for model, fields in sources:
+        for row in model.objects.values_list(*fields).iterator():
+            for text in row:
+                if text:
+                    for name in linked_names(text):
+                        yield name
+
+
+def embedded_references(run_size=SORT_RUN_SIZE):
+    """ Sorted upload paths mentioned in rich-text columns, each once. """
+    return external_sorted(_embedded_paths(), run_size)
+
+
+def _checked(names):
+    previous = None
+    for name in names:
+        if previous is not None and name < previous:
+            raise ValueError('Reference stream out of order at %r; check the column collation.' % name)
+        previous = name
+        yield name
+
+
+def referenced_sorted():
+    """ Every referenced upload path, sorted, each once. """
+    from .models import ProjectPrototype, ProjectFile, TaskFile, ImplementationFile
+
+    streams = [_checked(_column_sorted(model, 'file')) for model in (ProjectFile, TaskFile, ImplementationFile)]
+    streams.append(_checked(_column_sorted(ProjectPrototype, 'icon')))
+    streams.append(_checked(embedded_references()))
+    previous = None
+    for name in heapq.merge(*streams):
+        if name != previous:
+            yield name
+            previous = name
+
+
+def find_orphans(storage=blob_storage, roots=UPLOAD_ROOTS, grace=86400):
+    """
+    Merge-join the sorted upload tree against the sorted references. Yields (StoredFile,
+    old_enough) for every unreferenced file; old_enough is False inside the grace period.
+    """
+    cutoff = time.time() - grace
+    files = heapq.merge(*[walk_sorted(storage, root) for root in roots])
+    refs = referenced_sorted()
+    ref = next(refs, None)
+    for stored in files:
+        while ref is not None and ref < stored.name:
+            ref = next(refs, None)
+        if ref == stored.name:
+            continue
+        yield stored, stored.mtime < cutoff
+
+
+def _delete_batch(storage, batch, cutoff):
+    """ Remove a batch of orphan files, skipping any touched since the scan. Returns the removed StoredFiles. """
+    removed = []
+    for stored in batch:
+        path = storage.path(stored.name)
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                continue
+            os.remove(path)
+        except OSError:
+            continue
+        removed.append(stored)
+    return removed
+
+
+def collect_orphans(storage=blob_storage, grace=86400, dry_run=False, batch_size=500, workers=4, log=None):
+    """ Find and (unless dry_run) delete orphaned uploads; returns a CollectionReport. """
+    from .models import StoredBlob
+
+    cutoff = time.time() - grace
+    report = {'orphans': 0, 'deleted': 0, 'bytes': 0, 'skipped': 0}
+    pending = []
+
+    def submit(batch):
+        # Blobs re-referenced since the scan started stay; the database is only touched from this thread.
+        live = set(StoredBlob.objects.filter(
+            name__in=[f.name for f in batch], refcount__gt=0).values_list('name', flat=True))
+        pending.append(pool.submit(_delete_batch, storage, [f for f in batch if f.name not in live], cutoff))
+
+    def drain(limit):
+        while len(pending) > limit:
+            removed = pending.pop(0).result()
+            report['deleted'] += len(removed)
+            report['bytes'] += sum(f.size for f in removed)
+            blobs = [f.name for f in removed if digest_from_name(f.name)]
+            if blobs:
+                StoredBlob.objects.filter(name__in=blobs, refcount=0).delete()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        batch = []
+        for stored, old_enough in find_orphans(storage, grace=grace):
+            if not old_enough:
+                report['skipped'] += 1
+                continue
+            report['orphans'] += 1
+            if log:
+                log(stored)
+            if dry_run:
+                report['bytes'] += stored.size
+                continue
+            batch.append(stored)
+            if len(batch) >= batch_size:
+                submit(batch)
+                batch = []
+                drain(workers * 2)
+        if batch:
+            submit(batch)
+        drain(0)
+
+    return CollectionReport(**report)
@@ -3,20 +3,31 @@ from collections import OrderedDict
 from html.parser import HTMLParser
 
 
-from django.views.generic import TemplateView, CreateView, DetailView, UpdateView, DeleteView, ListView
+from django.views.generic import TemplateView, CreateView, DetailView, UpdateView, DeleteView, ListView, View
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.http.response import HttpResponseRedirect
+from django.http.response import FileResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.contrib import messages
+from django.db import DatabaseError
+from django.db.models import Q
 from django.contrib.messages.views import SuccessMessageMixin
 
-from braces.views import LoginRequiredMixin
-from haystack.generic_views import SearchView
+from braces.views import JSONResponseMixin, LoginRequiredMixin
+from haystack.generic_views import FacetedSearchView
 
-from core.mixins import ListUserFilesMixin
+from core.cache import tiered_cache
+from core.mixins import ConditionalGetMixin, ListUserFilesMixin, CachedObjectMixin
 from discussions.forms import PostReplyForm
+from discussions.feed import feed_live, format_cursor, latest_cursor
+from discussions.models import DiscussionLog
+from discussions.readmarkers import flush as flush_read_markers
 
-from .models import ProjectPrototype, ProjectTask, ProjectImplementationInfo, ProjectFile, ProjectComment, RepoPage, TaskFile, ImplementationFile, TASK_CATEGORIES
-from .forms import ProjectPrototypeCreateForm, ProjectPrototypeUpdateForm, TaskCreateForm, TaskUpdateForm, ImplementationInfoCreateForm,FileUploadForm, TaskFileUploadForm, ImplementationFileUploadForm
+from .chunked import OffsetMismatch, UploadError, complete_upload, start_upload, upload_state, write_chunk
+from .export import bundle_filename, cache_path, stream_bundle
+from .facets import get_facet_counts
+from .pagecache import PROTOTYPES_TAG, AnonymousPageCacheMixin, prototype_fragment_cache, prototype_version
+from .models import ChunkedUpload, ProjectPrototype, ProjectTask, ProjectImplementationInfo, ProjectFile, ProjectComment, RepoPage, TaskFile, ImplementationFile, TASK_CATEGORIES
+from .forms import ProjectPrototypeCreateForm, ProjectPrototypeUpdateForm, TaskCreateForm, TaskUpdateForm, ImplementationInfoCreateForm,FileUploadForm, TaskFileUploadForm, ImplementationFileUploadForm, PrototypeSearchForm
 
 
 class HomeView(TemplateView):
@@ -24,34 +35,48 @@ class HomeView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(HomeView, self).get_context_data(**kwargs)
-        prototypes = ProjectPrototype.objects.all().filter(active=True)
-        context['prototype_list'] = prototypes.filter(featured=False)
-        context['prototype_featured'] = prototypes.filter(featured=True)
+        prototypes = tiered_cache.get_or_compute(
+            'home:prototypes', lambda: list(ProjectPrototype.objects.profile('list').filter(active=True)),
+            timeout=300, tags=(PROTOTYPES_TAG,))
+        context['prototype_list'] = [i for i in prototypes if not i.featured]
+        context['prototype_featured'] = [i for i in prototypes if i.featured]
 
         try:
             context['prototypes_by_creator'] = ProjectPrototype.objects.filter(creator=self.request.user)
         except:
             pass
 
-        languages = {}
-        for i in prototypes:
-            for j in i.get_languages():
-                try:
-                    languages[j] = languages[j] + 1
-                except:
-                    languages[j] = 1
-
-        context['languages'] = languages
+        facets = get_facet_counts()
+        context['facets'] = facets
+        context['languages'] = facets['language']
 
         return context
 
 
+def prototype_validators(prototypes, user):
+    """ (version, last_modified) for ConditionalGetMixin from the first prototype's activity(). """
+    activity = prototypes.activity(user)
+    if activity is None:
+        return None
+    stamps = [activity.get(k) for k in ('modified', 'flipped', 'discussed', 'visited')]
+    version = '%s:%s:%s/%s' % (activity['pk'], ','.join(s.isoformat() if s else '' for s in stamps),
+                               activity['flip_count'], activity['post_count'])
+    return version, max(s for s in stamps if s)
+
+
 # Prototype views
-class ProjectPrototypeDocumentView(DetailView):
+class ProjectPrototypeDocumentView(ConditionalGetMixin, AnonymousPageCacheMixin, CachedObjectMixin, DetailView):
     model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('document')
     template_name = 'project_prototype_doc.html'
     context_object_name = 'project_prototype'
 
+    def get_validators(self):
+        return prototype_validators(ProjectPrototype.objects.filter(pk=self.kwargs['pk']), self.request.user)
+
+    def get_page_version(self):
+        return prototype_version(self.kwargs['pk'])
+
     def get_context_data(self, **kwargs):
         context = super(
             ProjectPrototypeDocumentView, self).get_context_data(**kwargs)
@@ -70,7 +95,7 @@ class ProjectPrototypeDocumentView(DetailView):
 
         implementation_info_items = project.implementation_info.all()
 
-        thread = ProjectComment.objects.get(project=project).thread or None
+        thread = project.project_discussion.all()[0].thread or None
         initial_post_data = {}
         initial_post_data['creator'] = self.request.user
         initial_post_data['subject'] = 'Re: %s' % project.title
@@ -79,10 +104,23 @@ class ProjectPrototypeDocumentView(DetailView):
 
         context['tasks'] = tasks
         context['description'] = project.description
-        context['thread'] = ProjectComment.objects.get(project=project).thread
-        context['comments'] = thread.replies.filter(deleted=False)
+        context['thread'] = thread
+        comments, next_cursor = thread.replies.reply_page(self.request.GET.get('cursor'))
+        last_visit = None
+        if self.request.user.is_authenticated():
+            flush_read_markers(self.request.user)
+            last_visit = DiscussionLog.objects.filter(
+                user=self.request.user, discussion=thread).order_by('-modified').values_list('modified', flat=True).first()
+        context['comments'] = comments
+        context['new_replies'] = [c for c in comments if last_visit and c.modified > last_visit]
+        context['next_cursor'] = next_cursor
+        context['last_visit'] = last_visit.isoformat() if last_visit else ''
+        context['live_comments'] = feed_live() and self.request.user.is_authenticated()
+        if context['live_comments']:
+            context['feed_cursor'] = format_cursor(latest_cursor(thread.pk))
         context['implementation_info_items'] = implementation_info_items
         context['postform'] = form
+        context['fragment_cache'] = prototype_fragment_cache(project, self.request.user)
         try:
             context['filelisting'] = project.project_files.all()
         except:
@@ -90,13 +128,45 @@ class ProjectPrototypeDocumentView(DetailView):
         return context
 
 
-class CloneProjectView(LoginRequiredMixin, DetailView):
+class ProjectPrototypeExportView(CachedObjectMixin, DetailView):
+    """ The whole prototype as a ZIP download, streamed as it is built or served from the bundle cache. """
     model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('document')
+
+    def get_queryset(self):
+        # Unpublished prototypes are only bundled for their creator and staff.
+        queryset = super(ProjectPrototypeExportView, self).get_queryset()
+        user = self.request.user
+        if user.is_staff:
+            return queryset
+        if user.is_authenticated():
+            return queryset.filter(Q(active=True) | Q(creator=user))
+        return queryset.filter(active=True)
+
+    def get(self, request, *args, **kwargs):
+        prototype = self.get_object()
+        cached = cache_path(prototype)
+        try:
+            response = FileResponse(open(cached, 'rb'), content_type='application/zip')
+        except IOError:
+            response = StreamingHttpResponse(stream_bundle(prototype, cached), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % bundle_filename(prototype)
+        return response
+
+
+class CloneProjectView(LoginRequiredMixin, CachedObjectMixin, DetailView):
+    model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('detail')
     template_name = 'project_prototype_detail.html'
     context_object_name = 'project_prototype'
 
     def get(self, request, *args, **kwargs):
-        clone = self.get_object().clone_project(self.request.user)
+        try:
+            clone = self.get_object().clone_project(self.request.user)
+        except DatabaseError:
+            clone = None
+            messages.add_message(request, messages.ERROR, 'Sorry, this project could not be flipped. Please try again.')
+
         if clone:
             objstr = self.get_object().title
             messages.add_message(request, messages.INFO, 'You have just flipped ' + objstr + '! You might want to rename it to give it your special stamp.')
@@ -107,6 +177,7 @@ class CloneProjectView(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super(CloneProjectView, self).get_context_data(**kwargs)
         context['prototype_data'] = self.get_object().get_data_dict()
+        context['fragment_cache'] = prototype_fragment_cache(self.get_object(), self.request.user)
 
         return context
 
@@ -116,39 +187,37 @@ class ProjectPrototypeListView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(ProjectPrototypeListView, self).get_context_data(**kwargs)
-        prototypes = []
-        for i in ProjectPrototype.objects.filter(active=True):
-            proto = (i, i.get_data_dict())
-            prototypes.append(proto)
+        queryset = ProjectPrototype.objects.profile('list')
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(active=True)
 
-        if self.request.user.is_staff:
-            for i in ProjectPrototype.objects.filter(active=False):
-                proto = (i, i.get_data_dict())
-                prototypes.append(proto)
+        # Active prototypes first, then (staff only) inactive ones.
+        prototypes = [(i, i.get_data_dict()) for i in queryset.order_by('-active', 'id')]
 
         try:
             context['prototypes_by_creator'] = ProjectPrototype.objects.filter(creator=self.request.user)
         except:
             pass
-        
-        languages = {}
-        for i in prototypes:
-            for j in i[0].get_languages():
-                try:
-                    languages[j] = languages[j] + 1
-                except:
-                    languages[j] = 1
-
-        context['languages'] = languages
+
+        facets = get_facet_counts(active_only=not self.request.user.is_staff)
+        context['facets'] = facets
+        context['languages'] = facets['language']
         context['prototype_list'] = prototypes
         return context
 
 
-class ProjectPrototypeDetailView(DetailView):
+class ProjectPrototypeDetailView(ConditionalGetMixin, AnonymousPageCacheMixin, CachedObjectMixin, DetailView):
     model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('detail')
     template_name = 'project_prototype_detail.html'
     context_object_name = 'project_prototype'
 
+    def get_validators(self):
+        return prototype_validators(ProjectPrototype.objects.filter(pk=self.kwargs['pk']), self.request.user)
+
+    def get_page_version(self):
+        return prototype_version(self.kwargs['pk'])
+
     def get_context_data(self, **kwargs):
         context = super(
             ProjectPrototypeDetailView, self).get_context_data(**kwargs)
@@ -169,6 +238,7 @@ class ProjectPrototypeDetailView(DetailView):
 
         context['prototype_tasks'] = tasks  # self.get_object().tasks.all()
         context['task_list'] = self.get_object().tasks.all()
+        context['fragment_cache'] = prototype_fragment_cache(self.get_object(), self.request.user)
         return context
 
 
@@ -190,27 +260,25 @@ class ProjectPrototypeCreateView(LoginRequiredMixin, SuccessMessageMixin, Create
         return context
 
 
-class ProjectPrototypeUpdateView(LoginRequiredMixin, UpdateView):
+class ProjectPrototypeUpdateView(LoginRequiredMixin, CachedObjectMixin, UpdateView):
     model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('edit')
     template_name = 'project_prototype_create_update.html'
     context_object_name = 'project_prototype'
     form_class = ProjectPrototypeUpdateForm
 
     def get_initial(self):
         """ Returns the initial metadata to use for forms on this view. """
-        choice_fields = self.get_object().meta_data_schema().multiple_choice_fields()
+        choice_fields = self.get_object().meta_data_schema().multiple
 
         initial = self.initial.copy()
 
         """ Initialize from metadata values """
-        for i in self.get_object().data.all():
-            if i.element_type in choice_fields:
-                try:
-                    initial[i.element_type].append(i.element_data)
-                except:
-                    initial[i.element_type] = [i.element_data]
+        for element_type, element_data in self.get_object().metadata.items():
+            if element_type in choice_fields:
+                initial[element_type] = list(element_data)
             else:
-                initial[i.element_type] = i.element_data
+                initial[element_type] = element_data[-1]
 
         return initial
 
@@ -225,7 +293,7 @@ class ProjectPrototypeUpdateView(LoginRequiredMixin, UpdateView):
         return context
 
 
-class ProjectPrototypeDeleteView(LoginRequiredMixin, DeleteView):
+class ProjectPrototypeDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = ProjectPrototype
     template_name = 'project_prototype_delete_confirm.html'
     context_object_name = 'project_prototype'
@@ -233,8 +301,9 @@ class ProjectPrototypeDeleteView(LoginRequiredMixin, DeleteView):
 
 
 # Task Views
-class ProjectTaskListView(LoginRequiredMixin, DetailView):
+class ProjectTaskListView(LoginRequiredMixin, CachedObjectMixin, DetailView):
     model = ProjectPrototype
+    queryset = ProjectPrototype.objects.profile('document')
     template_name = 'task_detail.html'
 
     def get_context_data(self, **kwargs):
@@ -251,17 +320,23 @@ class ProjectTaskListView(LoginRequiredMixin, DetailView):
         return context
 
 
-class ProjectTaskDetailView(ListUserFilesMixin, DetailView):
+class ProjectTaskDetailView(ConditionalGetMixin, ListUserFilesMixin, CachedObjectMixin, DetailView):
     model = ProjectTask
+    queryset = ProjectTask.objects.select_related('prototype_project__creator')
     template_name = 'task_detail.html'
     context_object_name = 'project_task'
+    # Signed-in users also see their own uploads from every prototype.
+    conditional_anonymous_only = True
+
+    def get_validators(self):
+        return prototype_validators(ProjectPrototype.objects.filter(tasks__pk=self.kwargs['pk']), self.request.user)
 
     def get_context_data(self, **kwargs):
         context = super(
             ProjectTaskDetailView, self).get_context_data(**kwargs)
         self.project = self.get_object().prototype_project
         context['prototype_project'] = self.project
-        context['task_list'] = context['prototype_project'].tasks.all()
+        context['task_list'] = context['prototype_project'].tasks.prefetch_related('task_files')
         # context['user_is_coeditor'] = context['prototype_project'].coeditors.filter(coeditor=self.request.user)
         # if not context['user_is_coeditor']:
 
@@ -304,8 +379,9 @@ class ProjectTaskCreateView(LoginRequiredMixin, CreateView):
         return context
 
 
-class ProjectTaskUpdateView(LoginRequiredMixin, ListUserFilesMixin, UpdateView):
+class ProjectTaskUpdateView(LoginRequiredMixin, ListUserFilesMixin, CachedObjectMixin, UpdateView):
     model = ProjectTask
+    queryset = ProjectTask.objects.select_related('prototype_project')
     template_name = 'task_create_update.html'
     context_object_name = 'project_task'
     form_class = TaskUpdateForm
@@ -325,8 +401,9 @@ class ProjectTaskUpdateView(LoginRequiredMixin, ListUserFilesMixin, UpdateView):
         return context
 
 
-class ProjectTaskDeleteView(LoginRequiredMixin, DeleteView):
+class ProjectTaskDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = ProjectTask
+    queryset = ProjectTask.objects.select_related('prototype_project')
     template_name = 'task_delete_confirm.html'
     context_object_name = 'project_task'
 
@@ -335,8 +412,9 @@ class ProjectTaskDeleteView(LoginRequiredMixin, DeleteView):
 
 
 # Implementation Info Views
-class ProjectImplementationInfoItemView(LoginRequiredMixin, DetailView):
+class ProjectImplementationInfoItemView(LoginRequiredMixin, CachedObjectMixin, DetailView):
     model = ProjectImplementationInfo
+    queryset = ProjectImplementationInfo.objects.select_related('prototype_project__creator', 'prototype_project__origin')
     template_name = 'implementation_info_detail.html'
     context_object_name = 'information_item'
 
@@ -375,8 +453,9 @@ class ProjectImplementationInfoItemCreateView(LoginRequiredMixin, CreateView):
         return context
         
 
-class ProjectImplementationInfoItemUpdateView(LoginRequiredMixin, ListUserFilesMixin, UpdateView):
+class ProjectImplementationInfoItemUpdateView(LoginRequiredMixin, ListUserFilesMixin, CachedObjectMixin, UpdateView):
     model = ProjectImplementationInfo
+    queryset = ProjectImplementationInfo.objects.select_related('prototype_project')
     template_name = 'implementation_info_create_update.html'
     context_object_name = 'information_item'
     form_class = ImplementationInfoCreateForm
@@ -399,8 +478,9 @@ class ProjectImplementationInfoItemUpdateView(LoginRequiredMixin, ListUserFilesM
         return context
 
 
-class ProjectImplementationInfoItemDeleteView(LoginRequiredMixin, DeleteView):
+class ProjectImplementationInfoItemDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = ProjectImplementationInfo
+    queryset = ProjectImplementationInfo.objects.select_related('prototype_project')
     template_name = 'implementation_info_delete_confirm.html'
     context_object_name = 'information_item'
 
@@ -409,7 +489,7 @@ class ProjectImplementationInfoItemDeleteView(LoginRequiredMixin, DeleteView):
 
 
 # Repo site pages
-class RepoPageView(DetailView):
+class RepoPageView(ConditionalGetMixin, CachedObjectMixin, DetailView):
     model = RepoPage
     template_name = 'repo_page.html'
     context_object_name = 'page'
@@ -419,6 +499,10 @@ class RepoPageView(DetailView):
             return redirect('staff_page_view', item=self.get_object().id)
         return super(RepoPageView, self).get(request, *args, **kwargs)
 
+    def get_validators(self):
+        page = self.get_object()
+        return '%s:%s' % (page.pk, page.modified.isoformat()), page.modified
+
     def get_context_data(self, **kwargs):
         context = super(RepoPageView, self).get_context_data(**kwargs)
         context['admin_edit'] = reverse('admin:reposite_repopage_change', args=(self.get_object().id,))
@@ -456,6 +540,7 @@ class FileUploadView(LoginRequiredMixin, CreateView):
         file_tree['project'] = self.request.user.uploaded_files.filter(project=self.project_obj)
         context['filelisting'] = file_tree
         context['upload_target'] = 'Project Prototype'
+        context['chunked_target'] = 'project'
         context['upload_target_object'] = self.project_obj
         context['project_obj'] = self.project_obj
 
@@ -497,6 +582,7 @@ class TaskFileUploadView(LoginRequiredMixin, CreateView):
 
         context['filelisting'] = file_tree 
         context['upload_target'] = 'Task'
+        context['chunked_target'] = 'task'
         context['upload_target_object'] = self.task_obj
         context['project_obj'] = project
         return context
@@ -535,13 +621,70 @@ class ImplementationInfoFileUploadView(LoginRequiredMixin, CreateView):
 
         context['filelisting'] = file_tree
         context['upload_target'] = 'Implementation Information Item'
+        context['chunked_target'] = 'implementation'
         context['upload_target_object'] = self.info_obj
         context['project_obj'] = project
         return context
 
 
-class ProjectFileDeleteView(LoginRequiredMixin, DeleteView):
+class ChunkedUploadStartView(LoginRequiredMixin, JSONResponseMixin, View):
+    """ Declare a resumable upload: target, target_id, filename, size and (optionally) sha256. """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            upload = start_upload(
+                request.user, request.POST.get('target'), request.POST.get('target_id'),
+                request.POST.get('filename'), request.POST.get('size'), request.POST.get('sha256'))
+        except UploadError as e:
+            return self.render_json_response({'error': str(e)}, status=400)
+        return self.render_json_response(upload_state(upload), status=201)
+
+
+class ChunkedUploadView(LoginRequiredMixin, JSONResponseMixin, View):
+    """ GET reports the offset to resume from; POST ?offset=N carries the next chunk as the raw body. """
+
+    def get_upload(self):
+        return get_object_or_404(ChunkedUpload, upload_id=self.kwargs['upload_id'], user=self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        return self.render_json_response(upload_state(self.get_upload()))
+
+    def post(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        try:
+            write_chunk(upload, int(request.GET.get('offset', '')), request)
+        except ValueError:
+            return self.render_json_response({'error': 'offset is required.'}, status=400)
+        except OffsetMismatch as e:
+            data = upload_state(upload)
+            data['offset'], data['error'] = e.expected, str(e)
+            return self.render_json_response(data, status=409)
+        except UploadError as e:
+            return self.render_json_response({'error': str(e)}, status=400)
+        return self.render_json_response(upload_state(upload))
+
+
+class ChunkedUploadCompleteView(ChunkedUploadView):
+    """ Verify the assembled upload and attach it to its project, task or implementation item. """
+
+    def get(self, request, *args, **kwargs):
+        return self.http_method_not_allowed(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        try:
+            attached = complete_upload(upload)
+        except UploadError as e:
+            return self.render_json_response({'error': str(e)}, status=400)
+        data = upload_state(upload)
+        data['file_id'] = attached.pk
+        data['url'] = attached.file.url
+        return self.render_json_response(data)
+
+
+class ProjectFileDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = ProjectFile
+    queryset = ProjectFile.objects.select_related('project')
     template_name = 'project_file_delete_confirm.html'
 
     def get_success_url(self):
@@ -553,8 +696,9 @@ class ProjectFileDeleteView(LoginRequiredMixin, DeleteView):
         return context
 
 
-class TaskFileDeleteView(LoginRequiredMixin, DeleteView):
+class TaskFileDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = TaskFile
+    queryset = TaskFile.objects.select_related('task__prototype_project')
     template_name = 'project_file_delete_confirm.html'
 
     def get_success_url(self):
@@ -566,8 +710,9 @@ class TaskFileDeleteView(LoginRequiredMixin, DeleteView):
         return context
 
 
-class ImplementationFileDeleteView(LoginRequiredMixin, DeleteView):
+class ImplementationFileDeleteView(LoginRequiredMixin, CachedObjectMixin, DeleteView):
     model = ImplementationFile
+    queryset = ImplementationFile.objects.select_related('implementation__prototype_project')
     template_name = 'project_file_delete_confirm.html'
 
     def get_success_url(self):
@@ -580,13 +725,15 @@ class ImplementationFileDeleteView(LoginRequiredMixin, DeleteView):
 
 
 # Search views
-class SearchHaystackView(SearchView):
+class SearchHaystackView(FacetedSearchView):
+    form_class = PrototypeSearchForm
+    facet_fields = ['language', 'subject', 'actfl_level', 'ilr_level', 'world_readiness']
+
     def get_queryset(self):
         queryset = super(SearchHaystackView, self).get_queryset()
         return queryset
 
     def get_context_data(self, *args, **kwargs):
         context = super(SearchHaystackView, self).get_context_data(*args, **kwargs)
-        
+        context['selected_facets'] = self.request.GET.getlist('selected_facets')
         return context
-
@@ -0,0 +1,84 @@
+// chunked_upload.js
+// Resumable uploads for large files: declare, send fixed-size chunks, resume from the server's offset, complete.
+jQuery(function($) {
+
+    var form = $("#chunked_upload");
+    if (!form.length) {
+        return;
+    }
+    var csrf = form.find("input[name=csrfmiddlewaretoken]").val();
+    var progress = $("#chunked_progress");
+
+    function sendFrom(file, state) {
+        if (state.offset >= state.size) {
+            $.ajax({
+                url : form.attr('data-chunk_url').replace('00000000000000000000000000000000', state.upload_id) + 'complete/',
+                type : "POST",
+                headers : {'X-CSRFToken': csrf},
+                dataType : "json",
+                success : function(json) {
+                    progress.text('Upload complete.');
+                    window.location.reload();
+                },
+                error : function(xhr) {
+                    progress.text((xhr.responseJSON && xhr.responseJSON.error) || 'Upload failed.');
+                }
+            });
+            return;
+        }
+        var end = Math.min(state.offset + state.chunk_size, state.size);
+        $.ajax({
+            url : form.attr('data-chunk_url').replace('00000000000000000000000000000000', state.upload_id) + '?offset=' + state.offset,
+            type : "POST",
+            headers : {'X-CSRFToken': csrf},
+            data : file.slice(state.offset, end),
+            processData : false,
+            contentType : 'application/octet-stream',
+            dataType : "json",
+            success : function(json) {
+                progress.text(Math.floor(100 * json.offset / json.size) + '%');
+                sendFrom(file, json);
+            },
+            // on a dropped connection or an out-of-order chunk, ask where to carry on from
+            error : function(xhr) {
+                if (xhr.status === 400) {
+                    progress.text((xhr.responseJSON && xhr.responseJSON.error) || 'Upload failed.');
+                    return;
+                }
+                setTimeout(function() {
+                    $.getJSON(form.attr('data-chunk_url').replace('00000000000000000000000000000000', state.upload_id), function(json) {
+                        sendFrom(file, json);
+                    });
+                }, 3000);
+            }
+        });
+    }
+
+    form.submit(function( event ) {
+        event.preventDefault();
+        var file = form.find("input[type=file]")[0].files[0];
+        if (!file) {
+            return;
+        }
+        $.ajax({
+            url : form.attr('action'),
+            type : "POST",
+            data : {
+                csrfmiddlewaretoken: csrf,
+                target: form.attr('data-target'),
+                target_id: form.attr('data-target_id'),
+                // no sha256: hashing the whole file here would mean reading all of it into memory
+                filename: file.name,
+                size: file.size
+            },
+            dataType : "json",
+            success : function(json) {
+                sendFrom(file, json);
+            },
+            error : function(xhr) {
+                progress.text((xhr.responseJSON && xhr.responseJSON.error) || 'Upload failed.');
+            }
+        });
+    });
+
+});
@@ -15,7 +15,34 @@ jQuery(function($) {
     // });
 
 
-    $(".post_delete").submit(function( event ) {
+    // markup for a reply coming back from the list_replies / thread_changes endpoints.
+    // Subjects and names go in as text; reply text is editor HTML, shown as-is like {{ j.text|safe }}.
+    function renderReply(reply, deleteUrl) {
+        var csrf = $("input[name=csrfmiddlewaretoken]").first().val();
+        var item = $('<div class="well" style="margin-left: 30px"></div>')
+            .attr('id', 'post_' + reply.id)
+            .css('background', reply.is_new ? '#FFCC99' : '#fff');
+        var hdr = $('<dt></dt>').text(reply.subject);
+        if (reply.can_edit) {
+            var edit = $('<a class="btn btn-primary btn-xs">edit</a>').attr('href', reply.edit_url);
+            hdr.append($('<small style="float: right"></small>').append('&nbsp;', edit, '&nbsp;'));
+        }
+        hdr.append($('<small class="pull-right"></small>').text(' ' + reply.modified + ' '));
+        hdr.append('<br>', $('<small></small>').text(' by ' + (reply.is_owner ? 'me' : reply.creator_name)));
+        item.append(hdr, $('<dd></dd>').html(reply.text));
+        if (reply.can_edit && csrf && deleteUrl) {
+            var form = $('<form class="post_delete" method="post"></form>')
+                .attr({'data-reply-target': 'post_' + reply.id, 'action': deleteUrl})
+                .append($('<input type="hidden" name="csrfmiddlewaretoken"/>').val(csrf))
+                .append($('<input type="hidden" name="post"/>').val(reply.id))
+                .append('<input type="submit" class="btn btn-xs btn-yield" title="Delete this post?" value="remove"/>');
+            item.append($('<div style="text-align: right"></div>').append(form));
+        }
+        return item;
+    }
+
+
+    $(document).on("submit", ".post_delete", function( event ) {
         event.preventDefault();
         var container = $("#" + $(this).attr('data-reply-target'));
         $.ajax({
@@ -58,9 +85,13 @@ jQuery(function($) {
 
 
             success : function(json) {
-                var hdr = '<div class="well" style="margin-left: 30px"><dt>' + json.subject + ' <small> ' + json.creator + '</small><small style="float: right"> ' + json.modified + '</small><small style="float: right">&nbsp;<a href="/discussions/post/' + json.id + '/edit/">edit</a>&nbsp;</small></dt>';
-                var body = '<dd>' + json.text + '</dd></div>';
-                var msg = hdr + ' ' + body;
+                var hdr = $('<dt></dt>').text(json.subject + ' ')
+                    .append($('<small></small>').text(' ' + json.creator))
+                    .append($('<small style="float: right"></small>').text(' ' + json.modified))
+                    .append($('<small style="float: right"></small>').append(
+                        '&nbsp;', $('<a>edit</a>').attr('href', '/discussions/post/' + json.id + '/edit/'), '&nbsp;'));
+                var msg = $('<div class="well" style="margin-left: 30px"></div>').attr('id', 'post_' + json.id)
+                    .append(hdr, ' ', $('<dd></dd>').html(json.text));
 
                 // $('#posts').append(msg);
                 $("#"+reply_thread).prepend(msg);
@@ -75,6 +106,86 @@ jQuery(function($) {
     });
 
 
+    $(".load_replies").click(function( event ) {
+        event.preventDefault();
+        var button = $(this);
+        var container = $("#" + button.attr('data-reply_target'));
+        $.ajax({
+            url : button.attr('data-url'),
+            type : "GET",
+            data : {cursor: button.attr('data-cursor'), since: button.attr('data-since')},
+            dataType : "json",
+
+            // append the older page and move the cursor along
+            success : function(json) {
+                $.each(json.replies, function(i, reply) {
+                    container.append(renderReply(reply, button.attr('data-delete_url')));
+                });
+                if (json.next_cursor) {
+                    button.attr('data-cursor', json.next_cursor);
+                } else {
+                    button.remove();
+                }
+            },
+
+            // handle a non-successful response
+            error : function(xhr, errmsg, err) {
+                // console.log(xhr.status + ": " + errmsg ); // provide a bit more info about the error to the console
+            }
+        });
+    });
+
+
+    // long-poll the thread's change feed and patch new, edited and removed replies into place.
+    // The page only has #reply_feed for logged-in users when live updates are on; a hidden tab stops listening.
+    var feed = $("#reply_feed");
+    if (feed.length) {
+        var container = $("#" + feed.attr('data-reply_target'));
+        // every answer repeats the last few seconds before the cursor; skip replies already patched in as they are
+        var served = {};
+        var poll = function() {
+            if (document.hidden) {
+                $(document).one('visibilitychange', poll);
+                return;
+            }
+            $.ajax({
+                url : feed.attr('data-url'),
+                type : "GET",
+                data : {since: feed.attr('data-cursor')},
+                dataType : "json",
+
+                success : function(json) {
+                    if (json.cursor) {
+                        feed.attr('data-cursor', json.cursor);
+                    }
+                    $.each(json.replies, function(i, reply) {
+                        var seen = JSON.stringify(reply);
+                        if (served[reply.id] === seen) {
+                            return;
+                        }
+                        served[reply.id] = seen;
+                        var existing = $("#post_" + reply.id);
+                        if (reply.deleted) {
+                            existing.remove();
+                        } else if (existing.length) {
+                            existing.replaceWith(renderReply(reply, feed.attr('data-delete_url')));
+                        } else {
+                            container.prepend(renderReply(reply, feed.attr('data-delete_url')));
+                        }
+                    });
+                    poll();
+                },
+
+                // back off before reconnecting
+                error : function(xhr, errmsg, err) {
+                    setTimeout(poll, 10000);
+                }
+            });
+        };
+        poll();
+    }
+
+
     $(document).ready(function() {
 
     });